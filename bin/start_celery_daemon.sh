@@ -1,13 +1,21 @@
 #!/bin/bash
 
-# start 8 celery workers for processing the various functions.
-# Workers 1, 2 and 3 will work together to manage the detect_provider queue
-# Workers 3, 4, 5 and 6 will work together to manage the provider_licence queue
-# Worker 7 will be responsible for processing the store_results queue
-# Worker 8 will be responsible for processing the flush_buffer queue
-celery multi start 8 -A openarticlegauge.slavedriver -l info --pidfile=%n.pid --logfile=%n.log -Q:1-3 detect_provider -Q:4-6 provider_licence -Q:7 store_results -Q:8 flush_buffer
+# start 11 celery workers for processing the various functions.
+# Workers 1 to 5 are dedicated to the interactive lane, so that small lookups (e.g. from
+# the web UI) are never stuck behind large batches:
+# Workers 1 and 2 will work together to manage the detect_provider queue
+# Workers 3 and 4 will work together to manage the provider_licence queue
+# Worker 5 will be responsible for processing the store_results queue
+# Workers 6 to 10 do the same for the bulk lane (see config.PRIORITY_QUEUE_SUFFIXES):
+# Workers 6 and 7 will work together to manage the detect_provider_bulk queue
+# Workers 8 and 9 will work together to manage the provider_licence_bulk queue
+# Worker 10 will be responsible for processing the store_results_bulk queue
+# Worker 11 will be responsible for processing the flush_buffer and housekeeping queues
+# To give more or less capacity to either lane, change the number of workers on its queues
+celery multi start 11 -A openarticlegauge.slavedriver -l info --pidfile=%n.pid --logfile=%n.log -Q:1-2 detect_provider -Q:3-4 provider_licence -Q:5 store_results -Q:6-7 detect_provider_bulk -Q:8-9 provider_licence_bulk -Q:10 store_results_bulk -Q:11 flush_buffer,housekeeping
 
 # start a celery beat instance which will publish flush_buffer requests
-# to the flush_buffer queue (managed by Worker 8 above)
+# to the flush_buffer queue and periodic maintenance tasks to the housekeeping
+# queue (both managed by Worker 11 above)
 celery beat --app=openarticlegauge.slavedriver --pidfile=beat.pid --logfile=beat.log -l info --detach
 
@@ -2,6 +2,6 @@
 
 # Run celery in a commandline window to monitor it
 # Running in 'screen' might be an idea...
-celery worker --app=openarticlegauge.slavedriver -B -l info -Q detect_provider,provider_licence,store_results,flush_buffer
+celery worker --app=openarticlegauge.slavedriver -B -l info -Q detect_provider,provider_licence,store_results,detect_provider_bulk,provider_licence_bulk,store_results_bulk,flush_buffer,housekeeping
 
 # (Of course there is the daemonised way to run it.)
@@ -1,7 +1,7 @@
 #!/bin/bash
 
-# Stop the 8 celery workers
-celery multi stop 8 -A openarticlegauge.slavedriver -l info --pidfile=%n.pid --logfile=%n.log -Q:1-3 detect_provider -Q:4-6 provider_licence -Q:7 store_results -Q:8 flush_buffer
+# Stop the 11 celery workers
+celery multi stop 11 -A openarticlegauge.slavedriver -l info --pidfile=%n.pid --logfile=%n.log -Q:1-2 detect_provider -Q:3-4 provider_licence -Q:5 store_results -Q:6-7 detect_provider_bulk -Q:8-9 provider_licence_bulk -Q:10 store_results_bulk -Q:11 flush_buffer,housekeeping
 
 # send a kill request for the pid in the beat.pid file.  This means, of course, that you need to run this script in the right directory
 kill -TERM `cat beat.pid`
@@ -6,6 +6,9 @@ from openarticlegauge.view.contact import blueprint as contact
 from openarticlegauge.view.query import blueprint as query
 from openarticlegauge.view.issue import blueprint as issue
 from openarticlegauge.view.lookup import blueprint as lookup
+from openarticlegauge.view.stats import blueprint as stats
+from openarticlegauge.view.export import blueprint as export
+from openarticlegauge.view.admin import blueprint as admin
 
 from openarticlegauge.core import app
 
@@ -13,6 +16,9 @@ app.register_blueprint(contact, url_prefix='/contact')
 app.register_blueprint(query, url_prefix='/query')
 app.register_blueprint(issue, url_prefix='/issue')
 app.register_blueprint(lookup, url_prefix='/lookup')
+app.register_blueprint(stats, url_prefix='/stats')
+app.register_blueprint(export, url_prefix='/export')
+app.register_blueprint(admin, url_prefix='/admin')
 
 
 # static front page
@@ -0,0 +1,531 @@
+"""
+The storage back ends for the archive, behind the DAO (see dao.py).  Which one is used is set by
+ARCHIVE_BACKEND in config.py:
+
+elasticsearch -- an Elasticsearch index over HTTP (see ELASTIC_SEARCH_HOST and ELASTIC_SEARCH_DB)
+sqlite -- an embedded SQLite database in a single file (see SQLITE_ARCHIVE_PATH), for single node
+    deployments and testing, where running a search cluster just to look records up by id is not
+    worth it
+
+Each back end stores json documents of several types (record, issue, log, license, ...) by id, and
+supports:
+
+get -- a document by id, in the form Elasticsearch returns it ({"_id" : ..., "_source" : {...}})
+mget -- many documents by id at once
+save, bulk, bulk_update, delete -- writes, of one or many documents
+scroll -- iteration over every document matching a query, a page at a time
+search -- a query, answered in the form Elasticsearch answers it ({"hits" : {"total" : ..., "hits" : [...]}})
+
+Queries are in the Elasticsearch query language.  The SQLite back end understands the parts of it
+which OAG uses itself: match_all, term, terms, range, ids, exists, missing, and, or, not, bool,
+filtered queries, field:value and free text query strings, and the partition script used by
+invalidate.py, with sorting on any field, from and size.  It works through the documents of the
+type, narrowing them down in SQL by id and last_checked (which it keeps in an indexed column) where
+the query allows, so it is intended for archives of a size which one machine can comfortably scan.
+
+"""
+
+import os, threading, sqlite3, time, requests
+from openarticlegauge import codec, storage
+from openarticlegauge.settings import SETTINGS
+
+# the script filter which selects a partition of the records by a hash of their id (see invalidate.py).
+# The SQLite back end evaluates it itself, as it has no scripting
+PARTITION_SCRIPT = "Math.abs(doc['id.exact'].value.hashCode() % partitions) == partition"
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+def archive():
+    """
+    Get the configured archive back end (see ARCHIVE_BACKEND in config.py).  There is one of each
+    in a process, which is safe to use from any thread, and after a fork
+
+    """
+    name = SETTINGS['ARCHIVE_BACKEND']
+    backend = _archives.get(name)
+    if backend is None:
+        with _archives_lock:
+            backend = _archives.get(name)
+            if backend is None:
+                if name not in BACKENDS:
+                    raise StorageException("unknown archive back end '" + str(name) + "', must be one of " + ", ".join(sorted(BACKENDS.keys())))
+                backend = BACKENDS[name]()
+                _archives[name] = backend
+    return backend
+
+class ElasticsearchBackend(object):
+    """
+    The archive in an Elasticsearch index, over HTTP
+
+    """
+    def target(self, type_):
+        return storage.es_index() + '/' + type_ + '/'
+
+    def get(self, type_, id_):
+        r = requests.get(self.target(type_) + id_)
+        if r.status_code == 404:
+            return None
+        return codec.loads(r.content)
+
+    def mget(self, type_, ids):
+        if len(ids) == 0:
+            return []
+        r = requests.post(self.target(type_) + '_mget', data=codec.dumps({'ids' : ids}))
+        docs = codec.loads(r.content).get('docs', [])
+        return [d.get('_source') if d.get('exists', d.get('found', False)) else None for d in docs]
+
+    def save(self, type_, id_, doc):
+        r = requests.post(self.target(type_) + id_, data=codec.dumps(doc))
+        return codec.loads(r.content)
+
+    def bulk(self, type_, docs, refresh=False):
+        data = ''
+        for doc in docs:
+            data += codec.dumps( {'index':{'_id':doc['id']}} ) + '\n'
+            data += codec.dumps( doc ) + '\n'
+        r = requests.post(self.target(type_) + '_bulk', data=data)
+        if refresh:
+            self.refresh(type_)
+        return codec.loads(r.content)
+
+    def bulk_update(self, type_, updates, refresh=False):
+        data = ''
+        for id_, doc in updates:
+            data += codec.dumps( {'update':{'_id':id_}} ) + '\n'
+            data += codec.dumps( {'doc':doc} ) + '\n'
+        r = requests.post(self.target(type_) + '_bulk', data=data)
+        if refresh:
+            self.refresh(type_)
+        return codec.loads(r.content)
+
+    def delete(self, type_, id_):
+        requests.delete(self.target(type_) + id_)
+
+    def refresh(self, type_):
+        r = requests.post(self.target(type_) + '_refresh')
+        return codec.loads(r.content)
+
+    def scroll(self, type_, query, page_size, keepalive):
+        query = dict(query)
+        query['size'] = page_size
+        r = requests.post(self.target(type_) + '_search?search_type=scan&scroll=' + keepalive, data=codec.dumps(query))
+        scroll_id = codec.loads(r.content).get('_scroll_id')
+
+        scroll_url = storage.es_host() + '/_search/scroll?scroll=' + keepalive
+        while scroll_id is not None:
+            r = requests.post(scroll_url, data=scroll_id)
+            result = codec.loads(r.content)
+            hits = result.get('hits', {}).get('hits', [])
+            if len(hits) == 0:
+                break
+            for hit in hits:
+                yield hit.get('_source', {})
+            scroll_id = result.get('_scroll_id')
+
+    def search(self, type_, query, endpoint='_search'):
+        if endpoint.endswith('_mapping'):
+            r = requests.get(self.target(type_) + endpoint)
+        else:
+            r = requests.post(self.target(type_) + endpoint, data=codec.dumps(query))
+        return codec.loads(r.content)
+
+class SQLiteBackend(object):
+    """
+    The archive in an embedded SQLite database.  Each thread (and process) has its own connection,
+    and the database is in write-ahead logging mode, so that readers don't wait for writers
+
+    """
+    # the number of ids to look up in each statement, below SQLite's limit on parameters
+    MGET_BATCH_SIZE = 500
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else SETTINGS['SQLITE_ARCHIVE_PATH']
+        self._local = threading.local()
+
+    def get(self, type_, id_):
+        row = self._connection().execute("SELECT doc, version FROM docs WHERE type = ? AND id = ?", (type_, _text(id_))).fetchone()
+        if row is None:
+            return None
+        return {'_type' : type_, '_id' : id_, '_version' : row[1], 'exists' : True, '_source' : codec.loads(row[0])}
+
+    def mget(self, type_, ids):
+        found = {}
+        for i in range(0, len(ids), self.MGET_BATCH_SIZE):
+            batch = [_text(id_) for id_ in ids[i:i + self.MGET_BATCH_SIZE]]
+            sql = "SELECT id, doc FROM docs WHERE type = ? AND id IN (" + ",".join(["?"] * len(batch)) + ")"
+            for id_, doc in self._connection().execute(sql, [type_] + list(batch)):
+                found[id_] = codec.loads(doc)
+        return [found.get(_text(id_)) for id_ in ids]
+
+    def save(self, type_, id_, doc):
+        with self._connection() as conn:
+            self._put(conn, type_, id_, doc)
+        return {'ok' : True, '_type' : type_, '_id' : id_}
+
+    def bulk(self, type_, docs, refresh=False):
+        items = []
+        with self._connection() as conn:
+            for doc in docs:
+                self._put(conn, type_, doc['id'], doc)
+                items.append({'index' : {'_type' : type_, '_id' : doc['id'], 'ok' : True}})
+        return {'items' : items}
+
+    def bulk_update(self, type_, updates, refresh=False):
+        items = []
+        with self._connection() as conn:
+            for id_, partial in updates:
+                row = conn.execute("SELECT doc FROM docs WHERE type = ? AND id = ?", (type_, _text(id_))).fetchone()
+                if row is None:
+                    items.append({'update' : {'_type' : type_, '_id' : id_, 'error' : 'DocumentMissingException'}})
+                    continue
+                doc = codec.loads(row[0])
+                _merge(doc, partial)
+                self._put(conn, type_, id_, doc)
+                items.append({'update' : {'_type' : type_, '_id' : id_, 'ok' : True}})
+        return {'items' : items}
+
+    def delete(self, type_, id_):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM docs WHERE type = ? AND id = ?", (type_, _text(id_)))
+
+    def refresh(self, type_):
+        # writes are visible as soon as they are committed
+        return {'ok' : True}
+
+    def scroll(self, type_, query, page_size, keepalive):
+        # page through in id order, so that documents changed while iterating (which keep their ids) are
+        # neither skipped nor repeated, and only a page is held in memory at a time
+        where, params = _prefilter(query)
+        matcher = _Matcher(query)
+        last = None
+        while True:
+            sql = "SELECT id, doc FROM docs WHERE type = ?" + where
+            args = [type_] + params
+            if last is not None:
+                sql += " AND id > ?"
+                args.append(last)
+            rows = self._connection().execute(sql + " ORDER BY id LIMIT ?", args + [page_size]).fetchall()
+            if len(rows) == 0:
+                break
+            for id_, s in rows:
+                doc = codec.loads(s)
+                if matcher.matches(id_, doc):
+                    yield doc
+            last = rows[-1][0]
+
+    def search(self, type_, query, endpoint='_search'):
+        if endpoint.endswith('_mapping'):
+            # there are no mappings; documents are stored as they are
+            return {}
+        if endpoint != '_search':
+            raise StorageException("the sqlite archive does not support the " + endpoint + " endpoint")
+        if query.get('facets'):
+            raise StorageException("the sqlite archive does not support facets")
+
+        started = time.time()
+        where, params = _prefilter(query)
+        matcher = _Matcher(query)
+        hits = []
+        for id_, s in self._connection().execute("SELECT id, doc FROM docs WHERE type = ?" + where + " ORDER BY id", [type_] + params):
+            doc = codec.loads(s)
+            if matcher.matches(id_, doc):
+                hits.append({'_type' : type_, '_id' : id_, '_source' : doc})
+
+        for field, descending, missing_first in reversed(_sort_fields(query.get('sort'))):
+            hits = _sorted(hits, field, descending, missing_first)
+
+        start = int(query.get('from', 0))
+        size = int(query.get('size', 10))
+        return {
+            'took' : int((time.time() - started) * 1000),
+            'hits' : {'total' : len(hits), 'hits' : hits[start:start + size]}
+        }
+
+    def _put(self, conn, type_, id_, doc):
+        last_checked = doc.get('last_checked')
+        if not isinstance(last_checked, (int, long, float)):
+            last_checked = None
+        conn.execute("INSERT OR REPLACE INTO docs (type, id, doc, last_checked, version) VALUES (?, ?, ?, ?, " +
+                     "COALESCE((SELECT version FROM docs WHERE type = ? AND id = ?), 0) + 1)",
+                     (type_, _text(id_), _text(codec.dumps(doc)), last_checked, type_, _text(id_)))
+
+    def _connection(self):
+        # a connection for this thread, or a new one if we're in a child process forked since it was made
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS docs (type TEXT NOT NULL, id TEXT NOT NULL, doc TEXT NOT NULL, " +
+                             "last_checked INTEGER, version INTEGER NOT NULL, PRIMARY KEY (type, id))")
+                conn.execute("CREATE INDEX IF NOT EXISTS docs_last_checked ON docs (type, last_checked)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+BACKENDS = {
+    "elasticsearch" : ElasticsearchBackend,
+    "sqlite" : SQLiteBackend
+}
+
+class StorageException(Exception):
+    """
+    Exception class to handle any problems arising in the archive back ends (such as a query the
+    back end does not support)
+
+    """
+    def __init__(self, message):
+        self.message = message
+        super(StorageException, self).__init__(self, message)
+
+############################################################################
+# Queries, for the SQLite back end
+############################################################################
+
+def _prefilter(query):
+    """
+    Get an SQL condition (and its parameters) which narrows down the documents which can match the
+    query, for those parts of it on the columns kept alongside each document (id and last_checked).
+    Every document the query matches must pass it; the rest of the query is left to the _Matcher
+
+    """
+    conditions, params = [], []
+    for clause in _required_clauses(query):
+        if "ids" in clause:
+            values = [_text(v) for v in clause["ids"].get("values", [])]
+            if len(values) <= SQLiteBackend.MGET_BATCH_SIZE:
+                conditions.append("id IN (" + ",".join(["?"] * len(values)) + ")")
+                params += values
+        elif "range" in clause and clause["range"].keys() == ["last_checked"]:
+            for op, sql_op in [("gt", ">"), ("gte", ">="), ("lt", "<"), ("lte", "<="), ("from", ">="), ("to", "<=")]:
+                value = clause["range"]["last_checked"].get(op)
+                if isinstance(value, (int, long, float)):
+                    conditions.append("last_checked " + sql_op + " ?")
+                    params.append(value)
+    if len(conditions) == 0:
+        return "", []
+    return " AND " + " AND ".join(conditions), params
+
+def _required_clauses(clause):
+    # the clauses which every match of the query must satisfy, found by descending through the
+    # conjunctions (and, bool must, filtered)
+    if not isinstance(clause, dict):
+        return []
+    required = [clause]
+    for key in ["query", "filter"]:
+        if key in clause:
+            required += _required_clauses(clause[key])
+    if "filtered" in clause:
+        required += _required_clauses(clause["filtered"])
+    if "and" in clause:
+        conjuncts = clause["and"].get("filters", []) if isinstance(clause["and"], dict) else clause["and"]
+        for c in conjuncts:
+            required += _required_clauses(c)
+    if "bool" in clause:
+        for c in _as_list(clause["bool"].get("must", [])):
+            required += _required_clauses(c)
+    return required
+
+class _Matcher(object):
+    """
+    Decides whether documents match an Elasticsearch query (the "query" and the top level "filter"
+    of a search request)
+
+    """
+    def __init__(self, query):
+        self.clauses = [query[k] for k in ["query", "filter"] if k in query]
+
+    def matches(self, id_, doc):
+        for clause in self.clauses:
+            if not self._evaluate(clause, id_, doc):
+                return False
+        return True
+
+    def _evaluate(self, clause, id_, doc):
+        if len(clause) == 0:
+            return True
+        for kind, body in clause.iteritems():
+            if kind in ["_cache", "_name", "boost"]:
+                continue
+            method = getattr(self, "_" + kind, None)
+            if method is None:
+                raise StorageException("the sqlite archive does not support '" + kind + "' queries")
+            if not method(body, id_, doc):
+                return False
+        return True
+
+    def _match_all(self, body, id_, doc):
+        return True
+
+    def _term(self, body, id_, doc):
+        return all([_contains(_values(id_, doc, field), value) for field, value in _fields(body)])
+
+    def _terms(self, body, id_, doc):
+        return all([any([_contains(_values(id_, doc, field), v) for v in _as_list(values)]) for field, values in _fields(body, ["execution", "minimum_match"])])
+
+    def _range(self, body, id_, doc):
+        for field, bounds in _fields(body):
+            found = [v for v in _values(id_, doc, field) if _in_range(v, bounds)]
+            if len(found) == 0:
+                return False
+        return True
+
+    def _ids(self, body, id_, doc):
+        return id_ in [_text(v) for v in body.get("values", [])]
+
+    def _exists(self, body, id_, doc):
+        return len(_values(id_, doc, body["field"])) > 0
+
+    def _missing(self, body, id_, doc):
+        return len(_values(id_, doc, body["field"])) == 0
+
+    def _and(self, body, id_, doc):
+        filters = body.get("filters", []) if isinstance(body, dict) else body
+        return all([self._evaluate(f, id_, doc) for f in filters])
+
+    def _or(self, body, id_, doc):
+        filters = body.get("filters", []) if isinstance(body, dict) else body
+        return any([self._evaluate(f, id_, doc) for f in filters])
+
+    def _not(self, body, id_, doc):
+        return not self._evaluate(body.get("filter", body), id_, doc)
+
+    def _bool(self, body, id_, doc):
+        if not all([self._evaluate(c, id_, doc) for c in _as_list(body.get("must", []))]):
+            return False
+        if any([self._evaluate(c, id_, doc) for c in _as_list(body.get("must_not", []))]):
+            return False
+        should = _as_list(body.get("should", []))
+        if len(should) > 0 and len(_as_list(body.get("must", []))) == 0:
+            return any([self._evaluate(c, id_, doc) for c in should])
+        return True
+
+    def _filtered(self, body, id_, doc):
+        return self._evaluate(body.get("query", {}), id_, doc) and self._evaluate(body.get("filter", {}), id_, doc)
+
+    def _query(self, body, id_, doc):
+        # e.g. a query wrapped up as a filter
+        return self._evaluate(body, id_, doc)
+
+    def _query_string(self, body, id_, doc):
+        q = body.get("query", "").strip()
+        if q in ["", "*"]:
+            return True
+        # field:value, compared as a whole (case insensitively, as an analysed field would be) ...
+        if ":" in q and " " not in q.split(":", 1)[0]:
+            field, value = q.split(":", 1)
+            value = value.strip('"').lower()
+            return any([unicode(v).lower() == value for v in _values(id_, doc, field)])
+        # ... otherwise free text, found anywhere in the document
+        return q.strip('"').lower() in _text(codec.dumps(doc)).lower()
+
+    def _match_phrase(self, body, id_, doc):
+        return all([self._query_string({"query" : field + ":" + unicode(value)}, id_, doc) for field, value in _fields(body)])
+
+    def _match(self, body, id_, doc):
+        return self._match_phrase(body, id_, doc)
+
+    def _script(self, body, id_, doc):
+        if body.get("script") != PARTITION_SCRIPT:
+            raise StorageException("the sqlite archive only supports the partition script filter")
+        params = body.get("params", {})
+        return abs(_java_remainder(_java_hash(doc.get("id", id_)), params["partitions"])) == params["partition"]
+
+def _fields(body, ignore=None):
+    ignore = ["_cache", "_name", "boost"] + (ignore or [])
+    return [(k, v) for k, v in body.iteritems() if k not in ignore]
+
+def _as_list(x):
+    return x if isinstance(x, list) else [x]
+
+def _values(id_, doc, field):
+    # all the values at the (dotted) path in the document, through any lists on the way.  The
+    # ".exact" sub-fields in the Elasticsearch mappings are the fields themselves here
+    if field == "_id":
+        return [id_]
+    if field.endswith(".exact"):
+        field = field[:-len(".exact")]
+    values = [doc]
+    for part in field.split("."):
+        found = []
+        for v in values:
+            if isinstance(v, dict) and part in v:
+                found.append(v[part])
+        values = []
+        for v in found:
+            if isinstance(v, list):
+                values += v
+            else:
+                values.append(v)
+    return [v for v in values if v is not None and not isinstance(v, dict)]
+
+def _contains(values, value):
+    return value in values or (isinstance(value, basestring) and value.lower() in [v.lower() for v in values if isinstance(v, basestring)])
+
+def _in_range(value, bounds):
+    for op, test in [("gt", lambda a, b: a > b), ("gte", lambda a, b: a >= b), ("lt", lambda a, b: a < b), ("lte", lambda a, b: a <= b),
+                     ("from", lambda a, b: a >= b), ("to", lambda a, b: a <= b)]:
+        bound = bounds.get(op)
+        if bound is not None and not test(value, bound):
+            return False
+    return True
+
+def _sort_fields(sort):
+    # the (field, descending, missing first) triples, in order, from any of the ways of giving a sort
+    if sort is None:
+        return []
+    fields = []
+    for s in _as_list(sort):
+        if isinstance(s, basestring):
+            fields.append((s, False, False))
+        else:
+            for field, order in s.iteritems():
+                missing = order.get("missing", "_last") if isinstance(order, dict) else "_last"
+                order = order.get("order", "asc") if isinstance(order, dict) else order
+                fields.append((field, order == "desc", missing == "_first"))
+    return fields
+
+def _sorted(hits, field, descending, missing_first=False):
+    # sort the hits by the field, keeping those without it at the end whichever the direction (unless asked
+    # to put them first), as Elasticsearch does.  The sort is stable, so sorting by each field in reverse
+    # order sorts by all of them
+    def key(hit):
+        values = _values(hit["_id"], hit["_source"], field)
+        if len(values) == 0:
+            return None
+        return max(values) if descending else min(values)
+    present = [h for h in hits if key(h) is not None]
+    missing = [h for h in hits if key(h) is None]
+    if missing_first:
+        return missing + sorted(present, key=key, reverse=descending)
+    return sorted(present, key=key, reverse=descending) + missing
+
+def _merge(doc, partial):
+    # merge a partial document into a document, as an Elasticsearch partial update does: objects are
+    # merged, and anything else is replaced
+    for k, v in partial.iteritems():
+        if isinstance(v, dict) and isinstance(doc.get(k), dict):
+            _merge(doc[k], v)
+        else:
+            doc[k] = v
+
+def _text(s):
+    # SQLite takes text as unicode, not encoded strings
+    return s.decode("utf-8") if isinstance(s, str) else s
+
+def _java_hash(s):
+    # java.lang.String.hashCode, over the UTF-16 code units of the string
+    if isinstance(s, str):
+        s = s.decode("utf-8")
+    units = s.encode("utf-16-be")
+    h = 0
+    for i in range(0, len(units), 2):
+        h = (31 * h + (ord(units[i]) << 8 | ord(units[i + 1]))) & 0xFFFFFFFF
+    return h - 0x100000000 if h & 0x80000000 else h
+
+def _java_remainder(a, b):
+    # java's %, which takes the sign of the dividend
+    r = abs(a) % abs(b)
+    return -r if a < 0 else r
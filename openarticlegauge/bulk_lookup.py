@@ -0,0 +1,323 @@
+""" offline licence lookups for large lists of identifiers, run in-process instead of through the web application and Celery """
+
+"""
+Usage:
+
+1/ Look up every identifier in a file, writing the results to another file:
+
+bulk_lookup.py -i identifiers.ndjson -o results.ndjson
+
+2/ The same, with 16 processes, using anything already in the cache or the archive, and storing
+   what is looked up there for later:
+
+bulk_lookup.py -i identifiers.csv -o results.ndjson -j 16 -c -a -s
+
+If the run is interrupted, run the same command again: identifiers already in the output file are
+not looked up again.
+
+Definition of options:
+
+-i - the input file (required).  Either NDJSON, with one identifier per line as a string or an object
+     such as {"id" : "10.1371/journal.pone.0035089", "type" : "doi"} (a line which is not JSON is taken
+     as a bare identifier), or CSV, with the identifier in the first column and, optionally, its type
+     in the second.  A CSV header row starting "id" or "identifier" is ignored
+-o - the output file (required).  Results are appended to it, one json object per line (see lookup_one)
+-f - the format of the input file, "ndjson" or "csv" (optional).  Defaults to csv for files ending .csv,
+     otherwise ndjson
+-j - the number of processes to run in parallel (optional, defaults to the number of CPUs).  With
+     1, everything is done in this process
+-c - use records from the cache, where they are not stale (optional)
+-a - use records from the archive, where they are not stale (optional)
+-s - store the records which are looked up in the archive and the cache, as the web application
+     would (optional)
+
+Without -c, -a or -s, no records are read from or written to Redis or Elasticsearch: only the plugins
+are run.  Their requests still go through the breakers of the hosts they call (see outbound), which
+are kept in Redis, so that a batch run and the web application back off from a failing host together.
+
+"""
+from openarticlegauge import workflow, model_exceptions, codec
+import os, time, csv, itertools, multiprocessing, logging
+
+log = logging.getLogger(__name__)
+
+# how often, in seconds, to report progress
+REPORT_INTERVAL = 10
+
+# the number of identifiers handed to a worker process at a time.  Each lookup is dominated by
+# the plugins' requests to the providers, so there is nothing to gain from batching them
+CHUNK_SIZE = 1
+
+def run(input_path, output_path, processes=None, input_format=None, use_cache=False, use_archive=False, store=False, reporter=None):
+    """
+    Look up the licence of every identifier in the input file, writing the results to the
+    output file as they are completed.  Identifiers which already have a result in the output
+    file (from an earlier, interrupted, run) or which appear earlier in the input are skipped
+
+    arguments:
+    input_path -- the path to the file of identifiers (see read_identifiers)
+    output_path -- the path to the file to append the results to, one json object per line (see lookup_one)
+    processes -- the number of processes to run the lookups in.  Defaults to the number of CPUs.  With 1
+        (or fewer), the lookups are done in this process
+    input_format -- the format of the input file, "ndjson" or "csv".  Defaults to csv for files ending .csv,
+        otherwise ndjson
+    use_cache -- use records from the cache, where they are not stale
+    use_archive -- use records from the archive, where they are not stale
+    store -- store the records which are looked up in the archive and the cache
+    reporter -- a callback function which can be used to report on the progress of this method.  Used for command line or logging integration
+
+    returns:
+    a dictionary of statistics about the run: the number of identifiers looked up, skipped, found
+        in the cache or archive and in error, the time taken and the rate in identifiers per second
+
+    """
+    if reporter is None:
+        reporter = lambda x: None
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    done = _completed(output_path)
+    seen = set()
+    stats = {"processed" : 0, "skipped" : 0, "cache" : 0, "archive" : 0, "errors" : 0}
+    if len(done) > 0:
+        reporter("resuming: " + str(len(done)) + " identifiers already have results in " + output_path)
+
+    def todo():
+        for identifier in read_identifiers(input_path, input_format):
+            key = identifier.get("id")
+            if key in done or key in seen:
+                stats["skipped"] += 1
+                continue
+            seen.add(key)
+            yield (identifier, use_cache, use_archive, store)
+
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_lookup_job, todo(), CHUNK_SIZE)
+    else:
+        results = itertools.imap(_lookup_job, todo())
+
+    started = time.time()
+    last_report = started
+    try:
+        with open(output_path, "ab") as out:
+            for result in results:
+                out.write(_dumps(result) + "\n")
+                out.flush()
+
+                stats["processed"] += 1
+                if result.get("error") is not None:
+                    stats["errors"] += 1
+                elif result.get("source") in ["cache", "archive"]:
+                    stats[result["source"]] += 1
+
+                if time.time() - last_report >= REPORT_INTERVAL:
+                    last_report = time.time()
+                    reporter(_progress(stats, started))
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            # does nothing to a pool which has already been closed, and stops the workers of one which hasn't
+            pool.terminate()
+            pool.join()
+
+    stats["seconds"] = time.time() - started
+    stats["rate"] = stats["processed"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+    reporter(_progress(stats, started) + " - finished")
+    return stats
+
+def lookup_one(identifier, use_cache=False, use_archive=False, store=False):
+    """
+    Look up the licence of a single identifier, in the same way as the workflow does, but in this
+    process: detect and verify its type, canonicalise it, optionally check the cache and archive,
+    then run the provider and licence plugins
+
+    arguments:
+    identifier -- a dictionary with the "id" of the identifier and, optionally, its "type"
+    use_cache -- use the record from the cache, if it is there and not stale
+    use_archive -- use the record from the archive, if it is there and not stale
+    store -- store the looked up record in the archive and the cache (see workflow.store_results)
+
+    returns:
+    a dictionary with the "input" id, and either the "identifier" (with its type and canonical form),
+        the "bibjson" record with its licences, and the "source" of the record ("cache", "archive" or
+        "lookup"), or an "error" message
+
+    """
+    result = {"input" : identifier.get("id")}
+    record = {"identifier" : dict(identifier)}
+    try:
+        # Step 1: identifier type detection/verification, and canonicalisation
+        workflow._detect_verify_type(record)
+        if record['identifier'].get("type") is None:
+            raise model_exceptions.LookupException("unable to determine the type of the identifier")
+        workflow._canonicalise_identifier(record)
+        result['identifier'] = record['identifier']
+
+        # Step 2: use an existing record, if we've been asked to and it is not stale.  Stale copies
+        # which the workflow would serve while refreshing them are looked up again instead
+        if use_cache:
+            cached = workflow._check_cache(record)
+            if cached is not None and cached.has_key("bibjson") and not record.pop("stale", False):
+                result["bibjson"] = cached["bibjson"]
+                result["source"] = "cache"
+                return result
+
+        if use_archive:
+            archived = workflow._check_archive(record)
+            if archived is not None and not record.pop("stale", False):
+                result["bibjson"] = archived
+                result["source"] = "archive"
+                return result
+
+        # Step 3: run the provider and licence plugins
+        record = workflow.detect_provider(record)
+        if record.get("error") is None:
+            record = workflow.provider_licence(record)
+
+        # Step 4: store the result, or just finish it off as storing it would
+        if store:
+            record = workflow.store_results(record)
+        if record.get("error") is not None:
+            result["error"] = record["error"]
+            return result
+        if not store:
+            workflow._ensure_license(record)
+            workflow._add_identifier_to_bibjson(record['identifier'], record['bibjson'])
+
+        result["bibjson"] = record["bibjson"]
+        result["source"] = "lookup"
+    except model_exceptions.LookupException as e:
+        result["error"] = e.message
+    except Exception as e:
+        # one broken identifier (or plugin) should not bring down the whole run
+        log.exception("unexpected error looking up " + repr(identifier))
+        result["error"] = "unexpected error: " + str(e)
+    return result
+
+def read_identifiers(path, input_format=None):
+    """
+    Read the identifiers from the input file
+
+    arguments:
+    path -- the path to the file
+    input_format -- "ndjson" or "csv".  Defaults to csv for files ending .csv, otherwise ndjson
+
+    returns:
+    a generator of dictionaries with the "id" of each identifier and, if the file gives it, its "type"
+
+    """
+    if input_format is None:
+        input_format = "csv" if path.lower().endswith(".csv") else "ndjson"
+    if input_format not in ["ndjson", "csv"]:
+        raise ValueError("unknown input format '" + str(input_format) + "', must be one of ndjson or csv")
+
+    with open(path, "rb") as f:
+        if input_format == "csv":
+            for identifier in _read_csv(f):
+                yield identifier
+        else:
+            for identifier in _read_ndjson(f):
+                yield identifier
+
+def _read_ndjson(f):
+    for line in f:
+        line = line.strip()
+        if line == "":
+            continue
+        try:
+            obj = codec.loads(line)
+        except ValueError:
+            # not json, so take it to be a bare identifier
+            obj = line.decode("utf-8")
+        if isinstance(obj, dict):
+            identifier = {"id" : obj.get("id")}
+            if obj.get("type") is not None:
+                identifier["type"] = obj["type"]
+        else:
+            identifier = {"id" : obj}
+        yield _normalise(identifier)
+
+def _read_csv(f):
+    first = True
+    for row in csv.reader(f):
+        if len(row) == 0 or row[0].strip() == "":
+            continue
+        if first and row[0].strip().lower() in ["id", "identifier"]:
+            first = False
+            continue
+        first = False
+        identifier = {"id" : row[0].strip().decode("utf-8")}
+        if len(row) > 1 and row[1].strip() != "":
+            identifier["type"] = row[1].strip().decode("utf-8")
+        yield identifier
+
+def _normalise(identifier):
+    # plugins expect identifiers as strings, but json can give us numbers (e.g. pmids)
+    if identifier.get("id") is not None and not isinstance(identifier["id"], basestring):
+        identifier["id"] = unicode(identifier["id"])
+    return identifier
+
+def _completed(output_path):
+    """
+    get the ids of the identifiers which already have results in the output file, and cut off any
+    result which was only partly written when an earlier run was interrupted
+
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as f:
+        complete = 0
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            complete += len(line)
+            try:
+                done.add(codec.loads(line).get("input"))
+            except ValueError:
+                log.warning("ignoring a line of " + output_path + " which is not json: " + line)
+        f.truncate(complete)
+    return done
+
+def _lookup_job(job):
+    # run in the worker processes, so must be a module level function
+    identifier, use_cache, use_archive, store = job
+    return lookup_one(identifier, use_cache, use_archive, store)
+
+def _dumps(result):
+    s = codec.dumps(result)
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    return s
+
+def _progress(stats, started):
+    elapsed = time.time() - started
+    rate = stats["processed"] / elapsed if elapsed > 0 else 0.0
+    return ("looked up " + str(stats["processed"]) + " identifiers in " + str(int(elapsed)) + "s (" + ("%.1f" % rate) + "/s): " +
+            str(stats["cache"]) + " from the cache, " + str(stats["archive"]) + " from the archive, " +
+            str(stats["errors"]) + " errors, " + str(stats["skipped"]) + " skipped")
+
+def stdout_reporter(msg):
+    print msg
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i", "--input", help="the file of identifiers to look up, NDJSON or CSV", required=True)
+    parser.add_argument("-o", "--output", help="the file to append the results to, as NDJSON.  If the run is interrupted, run the same command again to resume it", required=True)
+    parser.add_argument("-f", "--format", help="the format of the input file (defaults to csv for files ending .csv, otherwise ndjson)", choices=["ndjson", "csv"])
+    parser.add_argument("-j", "--processes", help="the number of processes to run in parallel (defaults to the number of CPUs)", type=int)
+    parser.add_argument("-c", "--cache", help="use records from the cache, where they are not stale", action="store_true")
+    parser.add_argument("-a", "--archive", help="use records from the archive, where they are not stale", action="store_true")
+    parser.add_argument("-s", "--store", help="store the records which are looked up in the archive and the cache", action="store_true")
+
+    args = parser.parse_args()
+
+    # the workflow logs every step at debug level, which would drown out the progress reports
+    logging.getLogger().setLevel(logging.WARNING)
+
+    run(args.input, args.output, args.processes, args.format, args.cache, args.archive, args.store, stdout_reporter)
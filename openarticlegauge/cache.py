@@ -7,13 +7,133 @@ serialised copies of python data structures passed in.  Keys used are up to the
 implementing code, but should be the canonical representations of the record being cached
 identifier.
 
+Depending on config.CACHE_ENCODING, entries are stored either as plain json (the original
+format, which is always readable) or in a compact binary encoding, prefixed by a header which
+identifies the format version and the encoding used:
+
+    \\x00OAG <format version byte> <encoding byte> <payload>
+
+Plain json can never start with a null byte, so entries with and without the header can
+live side by side, and readers handle both transparently.  See recode_cache.py for a tool
+which rewrites existing entries into the configured encoding.
+
+Cached records can be invalidated en masse with generation counters, held in a hash in Redis:
+
+- the "global" generation namespaces the keys of all records: when it is not 0, records are
+  stored under "g<generation>:<key>".  Bumping it invalidates everything in the cache at once.
+- per-handler counters ("handler:<name>" and "handler:<name>@<version>", or "handler:" for
+  licences which have no handler) are stamped into each record that has a licence from that
+  handler (under "_gen"), and checked when it is read.  Bumping one invalidates just the records
+  with licences from that handler (version).
+- per-licence type counters ("license:<type>", and "license:<type>:handler:..." for the licences of
+  that type from a handler) are stamped and checked in the same way, so that the records with a
+  particular type of licence (from a particular handler) can be invalidated without touching the rest.
+
+Invalidated records are simply never read again, and are left to expire in their own time.  See
+bump_generation, which invalidate.py uses.
+
+Optionally (see config.LOCAL_CACHE_TIMEOUT), each process also keeps the records it has read most
+recently, already decoded, in memory in front of Redis, so that repeated lookups of popular
+identifiers need no round trip at all.  Whenever a record is written or invalidated, its key is
+published on a Redis channel, and every other process drops its copy (and bumping a generation drops
+everything).  Each copy also expires after config.LOCAL_CACHE_TIMEOUT seconds, which bounds how
+stale it can be if a message is missed.  Records queued for processing are not kept, as they are about to change.
+tier_stats gives the hit ratios of the two levels.
+
 """
 
-import redis, json, datetime, logging
-import config
+import time, logging, zlib, threading, os, uuid
+import config, codec, recordmanager, storage, lrucache
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
 
 log = logging.getLogger(__name__)
 
+# prefix for keys in the negative cache, and the timeout for any failure class which
+# is not listed in config.NEGATIVE_CACHE_TIMEOUTS
+NEGATIVE_PREFIX = "negative:"
+NEGATIVE_DEFAULT_TIMEOUT = 3600
+
+# prefix for the keys which record that a request has claimed an identifier for processing
+CLAIM_PREFIX = "claim:"
+
+# sorted set of the identifiers currently claimed for processing, scored by the time at
+# which their lease runs out.  Anything left in here past that time has been orphaned
+INFLIGHT_KEY = "inflight"
+
+# renew the claim at KEYS[1] with token ARGV[1] for ARGV[2] seconds, and its entry ARGV[4] in the in-flight
+# set at KEYS[2] until ARGV[3], unless it is held with another token.  A lapsed claim is taken again
+RENEW_CLAIM_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then return 0 end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[4])
+return 1
+"""
+
+# release the claim at KEYS[1], and its entry ARGV[2] in the in-flight set at KEYS[2], unless it is
+# held with a token other than ARGV[1]
+RELEASE_CLAIM_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then return 0 end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[2])
+return 1
+"""
+
+# sorted set of canonical identifiers, scored by the number of times they have been looked up
+POPULARITY_KEY = "popularity"
+
+# hash of statistics about the proactive refresh sweeper (see workflow.sweep_stale)
+SWEEP_STATS_KEY = "sweep:stats"
+
+# sorted set of canonical identifiers whose refresh failed, scored by the time until which the
+# sweeper leaves them alone (see back_off_sweep)
+SWEEP_BACKOFF_KEY = "sweep:backoff"
+
+# hash of generation counters (see the module documentation)
+GENERATIONS_KEY = "generations"
+
+# get a cache entry from the namespace of the current global generation, along with all the
+# generation counters, in one round trip
+READ_SCRIPT = """
+local generation = redis.call('HGET', KEYS[1], 'global')
+local key = ARGV[1]
+if generation and generation ~= '0' then key = 'g' .. generation .. ':' .. key end
+return {redis.call('GET', key) or false, redis.call('HGETALL', KEYS[1])}
+"""
+
+# the channel on which the keys of changed records are published, for the local caches to drop
+# them (see the module documentation), and the key which means that everything has changed.  Messages
+# are "<origin> <key>", where the origin identifies the local cache of the process which sent them
+INVALIDATIONS_CHANNEL = "cache:invalidations"
+INVALIDATE_ALL = "*"
+
+# how long (in seconds) a process waits for its listener to subscribe to the channel before using the local cache
+LISTENER_START_TIMEOUT = 1
+
+# header which marks a cache entry as being in one of the binary encodings
+FORMAT_MAGIC = b"\x00OAG"
+FORMAT_VERSION = 1
+
+# the encodings which may be specified in config.CACHE_ENCODING, and the byte which
+# identifies them in the header.  "json" is the original header-less format
+ENCODINGS = {
+    "json" : None,
+    "json+zlib" : 1,
+    "msgpack" : 2,
+    "msgpack+zlib" : 3,
+    "json+lz4" : 4
+}
+
 def check_cache(key):
     """
     check the cache for an object stored under the given key, and convert it
@@ -27,27 +147,54 @@ def check_cache(key):
     - A python data structure if one can be found, which will hopefully be a bibjson record if you stored it right
     
     """
-    client = redis.StrictRedis(host=config.REDIS_CACHE_HOST, port=config.REDIS_CACHE_PORT, db=config.REDIS_CACHE_DB)
-    s = client.get(key)
+    local = _local_cache()
+    if local is not None:
+        obj = local.get(_local_key(key))
+        if obj is not None:
+            return _copy(obj)
+    
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    s, flat = client.register_script(READ_SCRIPT)(keys=[GENERATIONS_KEY], args=[key])
     
     if s is None:
+        _redis_counts["misses"] += 1
         return None
     
     try:
-        obj = json.loads(s)
+        obj = decode(s)
+    except UnsupportedFormatException as e:
+        # written by a newer version of the application, so leave it alone
+        log.debug("unable to read cache entry for " + str(key) + ": " + e.message)
+        return None
     except ValueError as e:
         # cache is corrupt, just get rid of it
         invalidate(key)
         return None
     
+    # if a handler which supplied one of its licences has been invalidated since the record
+    # was cached, then it doesn't count
+    generations = dict([(flat[i], int(flat[i + 1])) for i in range(0, len(flat), 2)])
+    if isinstance(obj, dict):
+        if not _is_current(obj, generations):
+            log.debug("cache entry for " + str(key) + " has been invalidated")
+            _redis_counts["misses"] += 1
+            return None
+        obj.pop("_gen", None)
+    _redis_counts["hits"] += 1
+    
+    if local is not None and isinstance(obj, dict) and not obj.get("queued", False):
+        local.set(_local_key(key), obj, len(s))
+        return _copy(obj)
     return obj
     
 def is_stale(bibjson):
     """
-    Check to see if the bibjson record in the supplied record is stale.  Look
-    in bibjson['license'][n]['provenance']['date'] for all n.  If the newest date
-    is older than the stale time, then the record is stale.  If the record does
-    not have a licence, it is stale.
+    Check to see if the bibjson record in the supplied record is stale.  This uses the
+    bibjson['last_checked'] timestamp (seconds since the epoch) maintained by store_results
+    and recordmanager.add_license.  If the record pre-dates that timestamp, then it is
+    worked out once from bibjson['license'][n]['provenance']['date'] for all n, and
+    remembered on the object.  If the last check is older than the stale time, then the
+    record is stale.  If the record does not have a licence, it is stale.
     
     arguments:
     bibjson -- a bibjson record in a python datastructure.  It may contain zero or more
@@ -60,42 +207,262 @@ def is_stale(bibjson):
     
     """
     # check that the record has a licence at all
-    if not "license" in bibjson:
+    if len(bibjson.get("license") or []) == 0:
         return True
     
-    # get the date strings of all the licences
-    log.debug("stale check on: " + str(bibjson))
-    date_strings = [licence.get("provenance", {}).get("date") 
-                for licence in bibjson.get("license", []) 
-                if licence.get("provenance", {}).get("date") is not None]
+    checked = last_checked(bibjson)
     
-    # check that there were any dates, if not then the record is necessarily stale
-    if len(date_strings) == 0:
+    # if there is no valid date on any licence, then the record is necessarily stale
+    if checked is None:
         return True
     
-    # convert all the viable date strings to datetimes
-    dates = []
-    for d in date_strings:
-        try:
-            dt = datetime.datetime.strptime(d, config.date_format)
-            dates.append(dt)
-        except ValueError as e:
-            continue
-    
-    # check that at least one date has parsed, and if not assume that the record is stale
-    if len(dates) == 0:
-        return True
+    return checked + config.licence_stale_time < time.time()
+
+def is_servable_stale(bibjson):
+    """
+    Check to see if a stale bibjson record may still be served while it is refreshed.  It may be, as
+    long as it has a licence which was last checked less than config.STALE_MAX_AGE seconds ago
+    
+    arguments:
+    bibjson -- a bibjson record in a python datastructure
+    
+    returns:
+    - True if the record can be served
+    - False if it cannot, or serving stale records is switched off (config.STALE_MAX_AGE is 0)
+    
+    """
+    if config.STALE_MAX_AGE <= 0 or not "license" in bibjson:
+        return False
+    
+    checked = last_checked(bibjson)
+    if checked is None:
+        return False
+    
+    return checked + config.STALE_MAX_AGE >= time.time()
+
+def last_checked(bibjson):
+    """
+    Get the time at which the licence of the bibjson record was last checked, in seconds
+    since the epoch.  For legacy records without a bibjson['last_checked'] field, this
+    is computed from the licence dates and stored on the object for next time.
+    
+    arguments:
+    bibjson -- a bibjson record in a python datastructure
+    
+    returns:
+    the time of the last check in seconds since the epoch, or None if it cannot be determined
+    
+    """
+    checked = bibjson.get("last_checked")
+    if checked is None:
+        checked = recordmanager.compute_last_checked(bibjson)
+        if checked is not None:
+            bibjson["last_checked"] = checked
+    return checked
+    
+def check_negative(key):
+    """
+    check the negative cache for a failure recorded against the given key
+    
+    arguments:
+    key -- the key to look up in the negative cache.  This should be the canonical identifier of the item being looked
+        up, or a representation of the raw identifier if it could not be canonicalised
+    
+    returns
+    - None if no failure is recorded (or the recorded failure is unreadable)
+    - A dictionary with the "failure" class and the "error" message, as passed to cache_negative
+    
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    s = client.get(NEGATIVE_PREFIX + key)
+    
+    if s is None:
+        return None
+    
+    try:
+        return decode(s)
+    except ValueError as e:
+        return None
+
+def cache_negative(key, failure_class, error):
+    """
+    record in the negative cache that processing of the item at the given key failed.  The entry
+    expires after the timeout configured for the failure class in config.NEGATIVE_CACHE_TIMEOUTS
+    
+    arguments:
+    key -- the key under which to store the failure.  This should be the canonical identifier of the item, or a
+        representation of the raw identifier if it could not be canonicalised
+    failure_class -- the class of the failure (see config.NEGATIVE_CACHE_TIMEOUTS)
+    error -- the error message to report for the item while the failure is cached
+    
+    """
+    timeout = config.NEGATIVE_CACHE_TIMEOUTS.get(failure_class, NEGATIVE_DEFAULT_TIMEOUT)
+    if timeout <= 0:
+        return
+    s = encode({"failure" : failure_class, "error" : error})
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    client.setex(NEGATIVE_PREFIX + key, timeout, s)
+
+def claim(key):
+    """
+    atomically claim the item at the given key for processing.  Only one claim on a key can be
+    held at a time, so when several requests for the same item arrive together, exactly one of them
+    wins.  The claim is a lease which lapses after config.QUEUED_LEASE_TIMEOUT seconds unless it
+    is renewed (see renew_claim), so that it is not held forever if processing dies part way through
+    
+    arguments:
+    key -- the key of the item to claim.  This should be the canonical identifier of the item
+    
+    returns:
+    a token which identifies this claim, to be passed to renew_claim and release_claim, or None if
+        the item is already claimed
+    
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    token = uuid.uuid4().hex
+    if not client.set(CLAIM_PREFIX + key, token, ex=config.QUEUED_LEASE_TIMEOUT, nx=True):
+        return None
+    client.zadd(INFLIGHT_KEY, int(time.time()) + config.QUEUED_LEASE_TIMEOUT, key)
+    return token
+
+def renew_claim(key, token):
+    """
+    renew the lease on the claim on the item at the given key, for another config.QUEUED_LEASE_TIMEOUT
+    seconds.  This should be called by each stage of processing, to show that it is still alive.  If
+    the claim has already lapsed it is taken again, unless someone else has claimed the item since
+    
+    arguments:
+    key -- the key of the claimed item.  This should be the canonical identifier of the item
+    token -- the token returned by claim
+    
+    returns:
+    True if the claim is still held, False if it has been taken by someone else, in which case
+        processing should stop
+    
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    expires = int(time.time()) + config.QUEUED_LEASE_TIMEOUT
+    return client.register_script(RENEW_CLAIM_SCRIPT)(keys=[CLAIM_PREFIX + key, INFLIGHT_KEY],
+                                                      args=[token, config.QUEUED_LEASE_TIMEOUT, expires, key]) == 1
+
+def release_claim(key, token):
+    """
+    release the claim held on the item at the given key, once processing is complete.  If the
+    claim has been taken by someone else since, it is theirs, and is left alone
+    
+    arguments:
+    key -- the key of the claimed item.  This should be the canonical identifier of the item
+    token -- the token returned by claim
+    
+    returns:
+    True if the claim was released (or had lapsed), False if it is held by someone else
+    
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    return client.register_script(RELEASE_CLAIM_SCRIPT)(keys=[CLAIM_PREFIX + key, INFLIGHT_KEY], args=[token, key]) == 1
+
+def orphaned_claims():
+    """
+    find, and forget about, the items whose claim lapsed without being released; that is, those whose
+    processing died part way through.  Their queued markers in the cache will have lapsed at the same
+    time, so the next lookup of any of them will send it for processing again
+    
+    returns:
+    a list of the keys of the orphaned items
+    
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    now = int(time.time())
+    pipe = client.pipeline()
+    pipe.zrangebyscore(INFLIGHT_KEY, "-inf", now)
+    pipe.zremrangebyscore(INFLIGHT_KEY, "-inf", now)
+    orphans, removed = pipe.execute()
+    return orphans
+
+def count_request(key):
+    """
+    count a request for the item at the given key, so that the most popular items can be found
+    
+    arguments:
+    key -- the key of the requested item.  This should be the canonical identifier of the item
+    
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    client.zincrby(POPULARITY_KEY, key, 1)
+
+def most_requested(n):
+    """
+    get the keys of the most requested items, most requested first.  Only config.POPULARITY_MAX_ITEMS
+    items are remembered; the least requested of any beyond that are forgotten
+    
+    arguments:
+    n -- the number of keys to return
+    
+    returns:
+    a list of keys
+    
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    client.zremrangebyrank(POPULARITY_KEY, 0, -(config.POPULARITY_MAX_ITEMS + 1))
+    return client.zrevrange(POPULARITY_KEY, 0, n - 1)
+
+def update_sweep_stats(stats):
+    """
+    record statistics from a run of the proactive refresh sweeper.  Counts whose names start with
+    "total_" are added to the running totals; everything else replaces the previous value
+    
+    arguments:
+    stats -- a dictionary of statistics
+    
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    pipe = client.pipeline()
+    for k, v in stats.iteritems():
+        if k.startswith("total_"):
+            pipe.hincrby(SWEEP_STATS_KEY, k, v)
+        else:
+            pipe.hset(SWEEP_STATS_KEY, k, v)
+    pipe.execute()
+
+def back_off_sweep(key):
+    """
+    have the proactive refresh sweeper leave the item at the given key alone for config.SWEEP_FAILURE_BACKOFF
+    seconds, as refreshing it has failed.  Only config.SWEEP_BACKOFF_MAX_ITEMS items are left alone at
+    a time; beyond that, those due back soonest are let back in
+    
+    arguments:
+    key -- the key of the item.  This should be the canonical identifier of the item
+    
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    pipe = client.pipeline()
+    pipe.zadd(SWEEP_BACKOFF_KEY, int(time.time()) + config.SWEEP_FAILURE_BACKOFF, key)
+    pipe.zremrangebyrank(SWEEP_BACKOFF_KEY, 0, -(config.SWEEP_BACKOFF_MAX_ITEMS + 1))
+    pipe.execute()
+
+def sweep_backed_off():
+    """
+    get the keys of the items which the proactive refresh sweeper is leaving alone (see back_off_sweep)
     
-    # get the most recent date by sorting the list (reverse, most recent date first)
-    dates.sort(reverse=True)
-    most_recent = dates[0]
+    returns:
+    a list of keys
     
-    # now determine if the most recent date is older or newer than the stale timeout
-    td = datetime.timedelta(seconds=config.licence_stale_time)
-    n = datetime.datetime.now()
-    stale_date = most_recent + td
-    return stale_date < n
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    client.zremrangebyscore(SWEEP_BACKOFF_KEY, "-inf", int(time.time()))
+    return client.zrange(SWEEP_BACKOFF_KEY, 0, -1)
+
+def sweep_stats():
+    """
+    get the statistics recorded by the proactive refresh sweeper
+    
+    returns:
+    a dictionary of statistics (values as strings, as stored)
     
+    """
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    return client.hgetall(SWEEP_STATS_KEY)
+
 def invalidate(key):
     """
     remove anything identified by the supplied key from the cache
@@ -104,10 +471,13 @@ def invalidate(key):
     key -- the key to be removed from the cache.  This should be the canonical identifier of the record concerned
     
     """
-    client = redis.StrictRedis(host=config.REDIS_CACHE_HOST, port=config.REDIS_CACHE_PORT, db=config.REDIS_CACHE_DB)
-    client.delete(key)
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    pipe = client.pipeline(transaction=False)
+    pipe.delete(_namespaced(key, {"global" : int(client.hget(GENERATIONS_KEY, "global") or 0)}))
+    _changed(pipe, key)
+    pipe.execute()
     
-def cache(key, obj):
+def cache(key, obj, timeout=None):
     """
     take the provided python data structure, serialise it via json to a string, and
     store it at the provided key with the appropriate timeout.  This may be
@@ -116,16 +486,359 @@ def cache(key, obj):
     arguments:
     key -- the key under which to store the item in the cache.  This shold be the canonical identifier of the record concerned
     obj -- a python data structure which is serialisable to json
+    timeout -- the number of seconds for which to keep the item.  Defaults to config.REDIS_CACHE_TIMEOUT
     
     """
+    if timeout is None:
+        timeout = config.REDIS_CACHE_TIMEOUT
+    
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    generations = get_generations(client)
+    
+    # stamp the record with the generations of the handlers whose licences it contains
+    if isinstance(obj, dict):
+        stamp = _stamp(obj, generations)
+        if len(stamp) > 0:
+            obj = dict(obj)
+            obj["_gen"] = stamp
+    
     try:
-        s = json.dumps(obj)
+        s = encode(obj)
     except TypeError:
-        raise CacheException("can only cache python objects that can be sent through json.dumps")
+        raise CacheException("can only cache python objects that can be serialised to json")
+    
+    pipe = client.pipeline(transaction=False)
+    pipe.setex(_namespaced(key, generations), timeout, s)
+    _changed(pipe, key)
+    pipe.execute()
+
+def bump_generation(handler=None, handler_version=None, treat_none_as_missing=False, license_type=None):
+    """
+    invalidate, at once, all the cached records with licences from the given handler.  The arguments
+    mean the same as they do in invalidate.invalidate_license:
+    
+    - no handler, treat_none_as_missing False: all records (the global generation is bumped)
+    - no handler, treat_none_as_missing True: records with licences which have no handler
+    - a handler: records with licences from any version of that handler
+    - a handler and a version: records with licences from that version of the handler
+    
+    and if a licence type is given, only the records with licences of that type from the handler(s)
+    
+    returns:
+    the name of the generation counter that was bumped, and its new value
+    
+    """
+    if handler is None:
+        field = "handler:" if treat_none_as_missing else None
+    elif handler_version is None:
+        field = "handler:" + handler
+    else:
+        field = "handler:" + handler + "@" + handler_version
+    
+    if license_type is not None:
+        field = "license:" + license_type + (":" + field if field is not None else "")
+    elif field is None:
+        field = "global"
+    
+    client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    generation = client.hincrby(GENERATIONS_KEY, field, 1)
+    _changed(client, INVALIDATE_ALL)
+    return field, generation
+
+def tier_stats():
+    """
+    get the hit ratios of the local (in-process) cache and of Redis, in this process.  Reads
+    answered by the local cache don't reach Redis, so aren't counted there
+    
+    returns:
+    a dictionary with a dictionary for each of "local" and "redis" of the numbers of hits and misses,
+        and the hit ratio (None if there have been no reads), and for "local" whether it is enabled,
+        and the number and total size (as stored in Redis) of its entries
+    
+    """
+    local = _local_cache()
+    local_stats = {"enabled" : local is not None, "hits" : 0, "misses" : 0, "entries" : 0, "bytes" : 0}
+    if local is not None:
+        local_stats.update({"hits" : local.hits, "misses" : local.misses, "entries" : len(local), "bytes" : local.bytes})
+    
+    redis_stats = dict(_redis_counts)
+    for stats in [local_stats, redis_stats]:
+        reads = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = float(stats["hits"]) / reads if reads > 0 else None
+    return {"local" : local_stats, "redis" : redis_stats}
+
+def get_generations(client=None):
+    """
+    get the current generation counters
+    
+    arguments:
+    client -- the redis client to use, if one is already to hand
     
-    client = redis.StrictRedis(host=config.REDIS_CACHE_HOST, port=config.REDIS_CACHE_PORT, db=config.REDIS_CACHE_DB)
-    client.setex(key, config.REDIS_CACHE_TIMEOUT, s)
+    returns:
+    a dictionary of counter names to values
+    
+    """
+    if client is None:
+        client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+    return dict([(k, int(v)) for k, v in client.hgetall(GENERATIONS_KEY).iteritems()])
+
+# reads answered by Redis in this process
+_redis_counts = {"hits" : 0, "misses" : 0}
+
+# the local cache, the process whose listener for invalidations is keeping it up to date, and the
+# origin of the invalidations it sends
+_local = None
+_local_pid = None
+_local_origin = None
+_local_lock = threading.Lock()
+
+def _local_cache():
+    """
+    the local cache, or None if it is switched off.  In a new process (including one forked from a process
+    which was already using it) the local cache starts empty, and a listener for invalidations is started
     
+    """
+    global _local, _local_pid, _local_origin
+    if config.LOCAL_CACHE_TIMEOUT <= 0:
+        return None
+    if _local_pid != os.getpid():
+        with _local_lock:
+            if _local_pid != os.getpid():
+                _local = lrucache.LRUCache(config.LOCAL_CACHE_MAX_ITEMS, config.LOCAL_CACHE_TIMEOUT, config.LOCAL_CACHE_MAX_BYTES)
+                _local_origin = uuid.uuid4().hex
+                if config.LOCAL_CACHE_PUBSUB:
+                    listener = _InvalidationListener(_local, _local_origin)
+                    listener.start()
+                    # records read before the listener has subscribed could miss their invalidation
+                    listener.subscribed.wait(LISTENER_START_TIMEOUT)
+                _local_pid = os.getpid()
+    return _local
+
+def _changed(client, key):
+    """
+    tell every process that the record under the key (or with INVALIDATE_ALL, every record) has changed.  The
+    client may be a pipeline, to send the message along with the change.  This process's own local cache is
+    changed straight away, so its listener ignores the message when it comes back
+    
+    """
+    local = _local_cache()
+    if local is None:
+        return
+    key = _local_key(key)
+    if key == INVALIDATE_ALL:
+        local.clear()
+    else:
+        local.invalidate(key)
+    if config.LOCAL_CACHE_PUBSUB:
+        client.publish(INVALIDATIONS_CHANNEL, _local_origin + " " + key)
+
+def _local_key(key):
+    # keys as they come back from Redis in invalidation messages
+    return key.encode("utf-8") if isinstance(key, unicode) else key
+
+class _InvalidationListener(threading.Thread):
+    """
+    Drops records from a local cache as they are changed in other processes (see _changed).  If the connection
+    to Redis is lost, messages may have been missed, so the whole local cache is dropped when it is restored
+    
+    """
+    def __init__(self, local, origin):
+        super(_InvalidationListener, self).__init__(name="cache-invalidation-listener")
+        self.daemon = True
+        self.local = local
+        self.origin = origin
+        self.subscribed = threading.Event()
+    
+    def run(self):
+        client = storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+        while True:
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATIONS_CHANNEL)
+                if self.subscribed.is_set():
+                    self.local.clear()
+                self.subscribed.set()
+                for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    origin, _, key = message["data"].partition(" ")
+                    if origin == self.origin:
+                        continue
+                    if key == INVALIDATE_ALL:
+                        self.local.clear()
+                    else:
+                        self.local.invalidate(key)
+            except Exception as e:
+                log.warning("lost the cache invalidation channel, so dropping the local cache: " + str(e))
+                self.local.clear()
+                self.subscribed.set()
+                time.sleep(1)
+
+def _copy(obj):
+    # copy a decoded record, so that callers can change it without changing the cached copy.  This is
+    # several times faster than copy.deepcopy, as json data has no cycles or shared objects to look after
+    t = type(obj)
+    if t is dict:
+        return {k : _copy(v) if type(v) in (dict, list) else v for k, v in obj.iteritems()}
+    if t is list:
+        return [_copy(v) if type(v) in (dict, list) else v for v in obj]
+    return obj
+
+def _namespaced(key, generations):
+    generation = generations.get("global", 0)
+    if generation == 0:
+        return key
+    return "g" + str(generation) + ":" + key
+
+def _dependencies(obj):
+    """
+    the names of the handler and licence type generation counters that a cached record depends on
+    
+    """
+    bibjson = obj.get("bibjson")
+    if not isinstance(bibjson, dict):
+        return set()
+    deps = set()
+    for l in bibjson.get("license", []):
+        provenance = l.get("provenance", {})
+        handler = provenance.get("handler")
+        if handler is None:
+            handlers = ["handler:"]
+        else:
+            handlers = ["handler:" + handler]
+            if provenance.get("handler_version") is not None:
+                handlers.append("handler:" + handler + "@" + provenance["handler_version"])
+        deps.update(handlers)
+        if l.get("type") is not None:
+            deps.add("license:" + l["type"])
+            deps.update(["license:" + l["type"] + ":" + h for h in handlers])
+    return deps
+
+def _stamp(obj, generations):
+    # counters at 0 are left out; that is what an unstamped record is assumed to have
+    return dict([(d, generations[d]) for d in _dependencies(obj) if generations.get(d, 0) != 0])
+
+def _is_current(obj, generations):
+    stamp = obj.get("_gen", {})
+    for d in _dependencies(obj):
+        if generations.get(d, 0) != stamp.get(d, 0):
+            return False
+    return True
+    
+def encode(obj, encoding=None):
+    """
+    Serialise the python data structure into the string form in which it is stored in
+    the cache
+    
+    arguments:
+    obj -- a python data structure which is serialisable to json
+    encoding -- the name of the encoding to use (see ENCODINGS).  Defaults to config.CACHE_ENCODING
+    
+    returns:
+    the encoded string
+    
+    raises:
+    TypeError if the object cannot be serialised
+    CacheException if the encoding is unknown or the library it requires is not installed
+    
+    """
+    if encoding is None:
+        encoding = getattr(config, "CACHE_ENCODING", "json")
+    if encoding not in ENCODINGS:
+        raise CacheException("unknown cache encoding " + str(encoding))
+    
+    if encoding == "json":
+        return codec.dumps(obj)
+    
+    if encoding.startswith("msgpack"):
+        if msgpack is None:
+            raise CacheException("cache encoding " + encoding + " requires msgpack to be installed")
+        payload = msgpack.packb(obj, use_bin_type=False)
+    else:
+        payload = codec.dumps(obj)
+        if isinstance(payload, unicode):
+            payload = payload.encode("utf-8")
+    
+    if encoding.endswith("+zlib"):
+        payload = zlib.compress(payload, getattr(config, "CACHE_COMPRESSION_LEVEL", 6))
+    elif encoding.endswith("+lz4"):
+        if lz4frame is None:
+            raise CacheException("cache encoding " + encoding + " requires lz4 to be installed")
+        payload = lz4frame.compress(payload)
+    
+    return FORMAT_MAGIC + chr(FORMAT_VERSION) + chr(ENCODINGS[encoding]) + payload
+
+def decode(s):
+    """
+    Deserialise a string from the cache into a python data structure, whichever of the
+    supported encodings it was written in (including header-less plain json)
+    
+    arguments:
+    s -- the string retrieved from the cache
+    
+    returns:
+    the python data structure
+    
+    raises:
+    UnsupportedFormatException if the entry was written in a format version or encoding this code does not know
+    ValueError if the entry is corrupt
+    
+    """
+    encoding = encoding_of(s)
+    if encoding == "json":
+        return codec.loads(s)
+    
+    payload = s[len(FORMAT_MAGIC) + 2:]
+    try:
+        if encoding.endswith("+zlib"):
+            payload = zlib.decompress(payload)
+        elif encoding.endswith("+lz4"):
+            if lz4frame is None:
+                raise UnsupportedFormatException("cache entry encoded with lz4, which is not installed")
+            payload = lz4frame.decompress(payload)
+        
+        if encoding.startswith("msgpack"):
+            if msgpack is None:
+                raise UnsupportedFormatException("cache entry encoded with msgpack, which is not installed")
+            return msgpack.unpackb(payload, raw=False)
+        return codec.loads(payload)
+    except UnsupportedFormatException:
+        raise
+    except Exception as e:
+        # zlib, lz4 and msgpack all have their own exception types for corrupt data
+        raise ValueError("corrupt cache entry: " + str(e))
+
+def encoding_of(s):
+    """
+    Determine the encoding that a string retrieved from the cache was written in
+    
+    arguments:
+    s -- the string retrieved from the cache
+    
+    returns:
+    the name of the encoding (see ENCODINGS)
+    
+    raises:
+    UnsupportedFormatException if the entry was written in a format version or encoding this code does not know
+    ValueError if the header is truncated
+    
+    """
+    if not s.startswith(FORMAT_MAGIC):
+        return "json"
+    
+    header = s[len(FORMAT_MAGIC):len(FORMAT_MAGIC) + 2]
+    if len(header) < 2:
+        raise ValueError("truncated cache entry header")
+    
+    version, encoding_byte = ord(header[0]), ord(header[1])
+    if version > FORMAT_VERSION:
+        raise UnsupportedFormatException("cache entry format version " + str(version) + " is newer than " + str(FORMAT_VERSION))
+    
+    for name, b in ENCODINGS.iteritems():
+        if b == encoding_byte:
+            return name
+    raise UnsupportedFormatException("unknown cache entry encoding " + str(encoding_byte))
+
 class CacheException(Exception):
     """
     Exception class to handle any problems arising in the cache
@@ -134,6 +847,16 @@ class CacheException(Exception):
     def __init__(self, message):
         self.message = message
         super(CacheException, self).__init__(self, message)
+
+class UnsupportedFormatException(ValueError):
+    """
+    Exception raised when a cache entry is in a format which this version of the code
+    is unable to read (e.g. it was written by a newer version of the application)
+    
+    """
+    def __init__(self, message):
+        self.message = message
+        super(UnsupportedFormatException, self).__init__(self, message)
     
     
     
@@ -7,7 +7,7 @@ Standard Celery configuration file, for use in initialising the Celery system fo
 # Workers should run as an unprivileged user.
 # CELERYD_USER = 'celery'
 # CELERYD_GROUP = 'celery'
-import os, config
+import os, config, codec
 from datetime import timedelta
 
 # CELERYD_NODES = 'w1'
@@ -30,16 +30,25 @@ CELERY_CONFIG_MODULE = 'openarticlegauge.celeryconfig'
 
 BROKER_URL = 'redis://localhost'
 CELERY_RESULT_BACKEND = "redis://localhost"
-CELERY_IMPORTS = ('openarticlegauge.workflow', 'openarticlegauge.models')
+CELERY_IMPORTS = ('openarticlegauge.workflow', 'openarticlegauge.models', 'openarticlegauge.stats')
 
-CELERY_TASK_SERIALIZER = 'json'
-CELERY_RESULT_SERIALIZER = 'json'
+# serialise tasks and results with the same (fastest available) JSON codec as the
+# rest of the application.  See codec.py
+CELERY_TASK_SERIALIZER = codec.CELERY_SERIALIZER
+CELERY_RESULT_SERIALIZER = codec.CELERY_SERIALIZER
+CELERY_ACCEPT_CONTENT = [codec.CELERY_SERIALIZER, 'json']
 
+# the default queues for each task.  These are the interactive lane; lookups in other
+# priority lanes send each stage to the queue for that lane instead, e.g. detect_provider_bulk
+# (see config.PRIORITY_QUEUE_SUFFIXES and workflow._start_back_end)
 CELERY_ROUTES = {
     'openarticlegauge.workflow.detect_provider' : {"queue": "detect_provider"},
     'openarticlegauge.workflow.provider_licence' : {"queue" : "provider_licence"},
     'openarticlegauge.workflow.store_results' : {"queue" : "store_results"},
-    'openarticlegauge.models.flush_buffer' : {'queue' : 'flush_buffer'}
+    'openarticlegauge.models.flush_buffer' : {'queue' : 'flush_buffer'},
+    'openarticlegauge.workflow.reap_orphaned_claims' : {'queue' : 'housekeeping'},
+    'openarticlegauge.workflow.sweep_stale' : {'queue' : 'housekeeping'},
+    'openarticlegauge.stats.reconcile' : {'queue' : 'housekeeping'}
 }
 
 CELERYBEAT_SCHEDULE = {
@@ -49,6 +58,27 @@ CELERYBEAT_SCHEDULE = {
         'options' : {
             'queue' : 'flush_buffer'
         }
+    },
+    'reap_orphaned_claims': {
+        'task': 'openarticlegauge.workflow.reap_orphaned_claims',
+        'schedule': timedelta(seconds=config.REAPER_PERIOD),
+        'options' : {
+            'queue' : 'housekeeping'
+        }
+    },
+    'sweep_stale': {
+        'task': 'openarticlegauge.workflow.sweep_stale',
+        'schedule': timedelta(seconds=config.SWEEP_PERIOD),
+        'options' : {
+            'queue' : 'housekeeping'
+        }
+    },
+    'reconcile_stats': {
+        'task': 'openarticlegauge.stats.reconcile',
+        'schedule': timedelta(seconds=config.STATS_RECONCILE_PERIOD),
+        'options' : {
+            'queue' : 'housekeeping'
+        }
     }
 }
 
@@ -0,0 +1,165 @@
+"""
+JSON encoding and decoding for the whole OAG application.
+
+Every hop that a record makes - into and out of the cache, the storage buffer, the
+Celery broker, the archive and the API - goes through the dumps and loads functions
+in this module, rather than through the standard library json module directly.
+
+On import, the fastest available JSON library is selected from the list in
+config.JSON_CODECS (for example orjson, ujson or simplejson with its C speedups),
+falling back to the standard library json module if none of the others can be loaded.
+
+"""
+
+import json as _json
+import logging
+
+from openarticlegauge import config
+
+log = logging.getLogger(__name__)
+
+# the name under which this codec is registered with Celery/Kombu, and the
+# content type that will be used on the messages it produces
+CELERY_SERIALIZER = "oagjson"
+CELERY_CONTENT_TYPE = "application/x-oagjson"
+
+def _load_orjson():
+    import orjson
+    def dumps(obj):
+        # orjson produces bytes, but the rest of the application expects strings
+        return orjson.dumps(obj).decode("utf-8")
+    return dumps, orjson.loads
+
+def _load_ujson():
+    import ujson
+    return ujson.dumps, ujson.loads
+
+def _load_simplejson():
+    import simplejson
+    # simplejson without its C extension is slower than the standard library
+    if not getattr(simplejson, "_speedups", None):
+        raise ImportError("simplejson is installed without its C speedups")
+    return simplejson.dumps, simplejson.loads
+
+def _load_json():
+    return _json.dumps, _json.loads
+
+CODECS = {
+    "orjson" : _load_orjson,
+    "ujson" : _load_ujson,
+    "simplejson" : _load_simplejson,
+    "json" : _load_json
+}
+
+# the name of the JSON library currently in use, and its encode/decode functions
+name = None
+_dumps = None
+_loads = None
+
+def use(codec_name):
+    """
+    Switch the JSON library used by this module
+
+    arguments:
+    codec_name -- the name of the library to use; one of the keys in codec.CODECS
+
+    returns:
+    True if the library could be loaded and is now in use, False if not (in which case
+        the previously selected library remains in use)
+
+    """
+    global name, _dumps, _loads
+    loader = CODECS.get(codec_name)
+    if loader is None:
+        log.warn("unknown JSON codec " + str(codec_name))
+        return False
+    try:
+        d, l = loader()
+    except ImportError as e:
+        log.debug("unable to load JSON codec " + codec_name + ": " + str(e))
+        return False
+    name, _dumps, _loads = codec_name, d, l
+    return True
+
+def select(preferences=None):
+    """
+    Select the first loadable JSON library from the list of preferences, falling
+    back to the standard library json module
+
+    arguments:
+    preferences -- list of codec names in order of preference.  Defaults to config.JSON_CODECS
+
+    returns:
+    the name of the selected library
+
+    """
+    if preferences is None:
+        preferences = getattr(config, "JSON_CODECS", ["json"])
+    for codec_name in preferences:
+        if use(codec_name):
+            break
+    else:
+        use("json")
+    log.debug("using JSON codec " + name)
+    return name
+
+def available():
+    """
+    List the names of all the JSON libraries which can be loaded in this environment
+
+    """
+    return [n for n in ["orjson", "ujson", "simplejson", "json"] if _can_load(n)]
+
+def _can_load(codec_name):
+    try:
+        CODECS[codec_name]()
+        return True
+    except ImportError:
+        return False
+
+def dumps(obj):
+    """
+    Serialise the python data structure to a JSON string
+
+    arguments:
+    obj -- a python data structure which is serialisable to json
+
+    returns:
+    the JSON string
+
+    raises:
+    TypeError if the object cannot be serialised, whichever library is in use
+
+    """
+    try:
+        return _dumps(obj)
+    except (TypeError, ValueError, OverflowError) as e:
+        raise TypeError("unable to serialise object to JSON: " + str(e))
+
+def loads(s):
+    """
+    Deserialise the JSON string into a python data structure
+
+    arguments:
+    s -- the JSON string (or bytes)
+
+    returns:
+    the python data structure
+
+    raises:
+    ValueError if the string is not valid JSON, whichever library is in use
+
+    """
+    return _loads(s)
+
+def register_celery_serializer():
+    """
+    Register this codec with Kombu, so that Celery can use it as its task and result
+    serializer (see CELERY_TASK_SERIALIZER in celeryconfig).  This needs to happen in
+    every process that sends or receives tasks, before any messages are sent.
+
+    """
+    from kombu.serialization import register
+    register(CELERY_SERIALIZER, dumps, loads, content_type=CELERY_CONTENT_TYPE, content_encoding="utf-8")
+
+select()
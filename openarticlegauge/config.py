@@ -13,6 +13,22 @@ NO_QUERY_VIA_API = []
 ANONYMOUS_SEARCH_FILTER = False
 SEARCH_SORT = False
 
+# Searches through the /query pass-through are cached in each web process, keyed by the type
+# being searched and the query, for QUERY_CACHE_TIMEOUT seconds (0 switches the cache off).
+# At most QUERY_CACHE_MAX_ITEMS results are kept, the least recently used being dropped first.
+# Searches of the types listed in NO_QUERY_CACHE always go to the index
+QUERY_CACHE_TIMEOUT = 30
+QUERY_CACHE_MAX_ITEMS = 500
+NO_QUERY_CACHE = []
+
+# Exports of the archive (see export.py, and /export, which is not available if "record" is in
+# NO_QUERY_VIA_API) are compressed with EXPORT_COMPRESSION (gzip, zstd - which requires the
+# zstandard library - or none), split into shards of at most EXPORT_SHARD_SIZE bytes after
+# compression, and read from the index EXPORT_PAGE_SIZE records per shard per request
+EXPORT_COMPRESSION = "gzip"
+EXPORT_SHARD_SIZE = 256 * 1024 * 1024
+EXPORT_PAGE_SIZE = 500
+
 # provide an email address for receiving errors or dispute warning
 CONTACT_EMAIL = ''
 
@@ -58,15 +74,150 @@ license_detection = [
     "openarticlegauge.plugins.ubiquitous.UbiquitousPlugin",
 ]
 
+# Plugins can also be discovered, rather than listed above: any plugin in the "openarticlegauge.plugins"
+# entry point group of an installed package, or in a module in one of the PLUGIN_DIRECTORIES, is
+# registered for whatever its capabilities() say it can do (see plugin_registry.py).  Running processes
+# pick up new or changed plugins, without restarting, when the registry version is bumped (plugin_registry.py -b)
+# or when they are sent PLUGIN_RELOAD_SIGNAL (None to not listen for a signal)
+PLUGIN_DIRECTORIES = []
+PLUGIN_RELOAD_SIGNAL = "SIGUSR2"
+
+# Proactive refresh.  Celery beat runs a sweeper (workflow.sweep_stale) every SWEEP_PERIOD seconds,
+# which sends up to SWEEP_BATCH_SIZE archived records for refreshing (in the bulk lane) if their
+# licence will become stale within SWEEP_LEAD_TIME seconds.  So the refresh rate is at most
+# SWEEP_BATCH_SIZE records per SWEEP_PERIOD.  Frequently requested records are refreshed first.
+# The sweeper only runs between the hours (UTC) given in SWEEP_WINDOW, so that the load can be
+# kept to off-peak times; the window may span midnight, e.g. (22, 6).  Set it to None to sweep at
+# any time, or SWEEP_BATCH_SIZE to 0 to switch the sweeper off
+SWEEP_PERIOD = 60
+SWEEP_BATCH_SIZE = 50
+SWEEP_LEAD_TIME = 1209600 # 2 weeks
+SWEEP_WINDOW = (1, 6)
+
+# how many of the most requested identifiers the sweeper considers first, and how many
+# identifiers to keep request counts for
+SWEEP_POPULAR_ITEMS = 1000
+POPULARITY_MAX_ITEMS = 100000
+
+# how long, in seconds, the sweeper leaves a record alone after refreshing it has failed, so that
+# records which can't be refreshed (e.g. as their provider is down) don't stay at the front of the
+# backlog and hold up the rest.  At most SWEEP_BACKOFF_MAX_ITEMS records are left alone at a time
+SWEEP_FAILURE_BACKOFF = 86400 # 1 day
+SWEEP_BACKOFF_MAX_ITEMS = 1000
+
+# Priority lanes for processing.  Every lookup is given a priority class, and each stage of
+# processing for it goes to that class's own set of Celery queues, named after the stage plus
+# the suffix given here (so "detect_provider" and "detect_provider_bulk", etc.).  This lets the
+# worker start scripts dedicate capacity to interactive lookups, so that they are not stuck
+# behind large batches.  See bin/start_celery_daemon.sh
+PRIORITY_QUEUE_SUFFIXES = {
+    "interactive" : "",
+    "bulk" : "_bulk"
+}
+
+# Lookups of up to this many identifiers are interactive; larger batches are bulk.  A client may
+# ask for a particular priority, but a batch larger than this can never be interactive
+INTERACTIVE_MAX_BATCH = 20
+
 # Cache configuration
 REDIS_CACHE_HOST = "localhost"
 REDIS_CACHE_PORT = 6379
 REDIS_CACHE_DB = 2
 REDIS_CACHE_TIMEOUT = 7776000 # approximately 3 months
 
+# Whether to empty the cache whenever the web application starts
+FLUSH_CACHE_ON_STARTUP = False
+
+# Each process can keep the records it has read most recently from the cache in memory, in front of
+# Redis, for LOCAL_CACHE_TIMEOUT seconds (0 switches this off).  At most LOCAL_CACHE_MAX_ITEMS records
+# are kept, of at most LOCAL_CACHE_MAX_BYTES in total (measured as they are stored in Redis), the least
+# recently used being dropped first.  With LOCAL_CACHE_PUBSUB, changed records are dropped from every
+# process at once, through Redis pub/sub; without it, keep the timeout to a few seconds, as that is how
+# long a process may go on serving an out of date record.  See cache.py
+LOCAL_CACHE_TIMEOUT = 0
+LOCAL_CACHE_MAX_ITEMS = 10000
+LOCAL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+LOCAL_CACHE_PUBSUB = True
+
+# How to encode entries in the cache.  One of:
+# "json" - plain json, as written by all previous versions of OAG
+# "json+zlib" - json, compressed with zlib
+# "json+lz4" - json, compressed with lz4 (requires the lz4 package)
+# "msgpack" - msgpack (requires the msgpack package)
+# "msgpack+zlib" - msgpack, compressed with zlib (requires the msgpack package)
+# Entries in any of these encodings can always be read, whatever is configured
+# here.  To rewrite existing entries in a new encoding, see recode_cache.py
+CACHE_ENCODING = "json"
+
+# zlib compression level (1-9) for the "+zlib" cache encodings
+CACHE_COMPRESSION_LEVEL = 6
+
+# Negative cache: identifiers which could not be processed are remembered for a short
+# while, so that repeated requests for them are answered immediately with the same error
+# rather than being processed again.  Timeouts in seconds, by class of failure; a timeout
+# of 0 switches off negative caching for that class
+NEGATIVE_CACHE_TIMEOUTS = {
+    "unknown_type" : 3600, # no plugin could determine the type of the identifier
+    "invalid_identifier" : 86400, # the identifier failed validation or canonicalisation
+    "unresolvable" : 21600, # no provider could be found, e.g. the DOI resolver 404s (it may not be registered yet)
+    "unavailable" : 900 # the provider's site was unavailable for too long (see BREAKER_MAX_DEFERRALS)
+}
+
+# When an identifier is sent for processing, it is claimed (atomically) so that concurrent
+# requests for it don't start duplicate processing, and marked as queued in the cache.  Both
+# are leases, renewed by each stage of processing as it starts.  This is the number of seconds
+# after which the lease runs out if it is not renewed - i.e. if processing has died - and the
+# identifier will be sent for processing again on its next lookup.  It must be comfortably
+# longer than an item may wait in a queue plus the time limit on a single task (see CELERYD_OPTS).
+# If it isn't, and the identifier is claimed again in the meantime, the original processing stops
+# when it next tries to renew its claim
+QUEUED_LEASE_TIMEOUT = 1800
+
+# how often (seconds) to look for, and report on, identifiers whose processing died before
+# completing (see workflow.reap_orphaned_claims)
+REAPER_PERIOD = 300
+
+# Timeouts (seconds) for the requests plugins make to publishers and other services (see outbound.py):
+# HTTP_TIMEOUT by default, or as given for a host (or a domain it is in) in HTTP_HOST_TIMEOUTS, e.g.
+# {"ncbi.nlm.nih.gov" : 30}.  Each plugin also has a time budget for all of its requests for one record
+# together: PLUGIN_TIME_BUDGET by default, or as given for the plugin's short name in PLUGIN_TIME_BUDGETS.
+# Keep the budgets of the plugins run by one task well within its time limit (see CELERYD_OPTS)
+HTTP_TIMEOUT = 20
+HTTP_HOST_TIMEOUTS = {}
+PLUGIN_TIME_BUDGET = 60
+PLUGIN_TIME_BUDGETS = {}
+
+# Circuit breakers.  After BREAKER_FAILURES failed requests in a row to a host (errors, timeouts, 5xx
+# responses, or responses taking longer than BREAKER_SLOW_RESPONSE seconds), no requests are made to it
+# for BREAKER_OPEN_TIME seconds.  Records which need the host are put off until then, up to
+# BREAKER_MAX_DEFERRALS times, after which processing them fails (see NEGATIVE_CACHE_TIMEOUTS).  The state
+# of the breakers is served as json from /admin/breakers
+BREAKER_FAILURES = 5
+BREAKER_SLOW_RESPONSE = 15
+BREAKER_OPEN_TIME = 300
+BREAKER_MAX_DEFERRALS = 5
+
 # Number of seconds it takes for a licence record to be considered stale
 licence_stale_time = 15552000 # approximately 6 months
 
+# Licences from a version of a plugin older than the one currently registered are also treated as
+# stale, so that they are refreshed the next time they are looked up.  Particular versions of a
+# plugin may be marked as obsolete here too (e.g. if a plugin is no longer registered, or a bad
+# release had to be rolled back), as a list of [handler, handler_version] pairs, e.g.
+# [["plos", "0.1"], ["bmc", "0.2"]]
+OBSOLETE_HANDLER_VERSIONS = []
+
+# Stale records are still served, flagged as stale, while a fresh copy is obtained in the background.
+# This is the number of seconds after its licence was last checked that a record is too old to be
+# served at all, and the client will have to wait for it to be processed again.  Set to 0 to never
+# serve stale records
+STALE_MAX_AGE = 31104000 # approximately 12 months
+
+# Lookup results are sent with an ETag and a Cache-Control max-age of the time until the first of
+# their licences becomes stale (zero if any identifier is still being processed), so that clients,
+# proxies and CDNs can cache them.  This is the most that max-age will be, in seconds
+LOOKUP_MAX_AGE = 86400
+
 # whether or not we are buffering posts to the index
 BUFFERING = True
 
@@ -89,13 +240,28 @@ REDIS_BUFFER_HOST = "localhost"
 REDIS_BUFFER_PORT = 6379
 REDIS_BUFFER_DB = 3
 
+# Licence statistics configuration (see stats.py).  These are kept in their own database, as the
+# cache database is emptied when the web application starts with FLUSH_CACHE_ON_STARTUP.  The statistics are kept up to date
+# as records are stored, and are recounted from the archive every STATS_RECONCILE_PERIOD seconds
+REDIS_STATS_HOST = "localhost"
+REDIS_STATS_PORT = 6379
+REDIS_STATS_DB = 4
+STATS_RECONCILE_PERIOD = 86400
+
 # elastic search buffer bulk loading block size - the maximum number of items
 # permitted in a single elastic search bulk request
 BUFFER_BLOCK_SIZE = 1000
 
+# where the archive is kept: "elasticsearch", in the index below, or "sqlite", in an embedded database in
+# the file at SQLITE_ARCHIVE_PATH, for single node deployments and testing (see backends.py)
+ARCHIVE_BACKEND = "elasticsearch"
+SQLITE_ARCHIVE_PATH = "oag.sqlite"
+
 # elasticsearch configs
 ELASTIC_SEARCH_HOST = 'http://localhost:9200'
 ELASTIC_SEARCH_DB = 'oag'
+# Whether to set up the index (its mappings, and the licences in the licence index) when the application
+# starts.  This is skipped if the index was last set up with exactly the same mappings and licences
 INITIALISE_INDEX = True
 
 # if index does not exist, it will be created first time round using the mapping below
@@ -126,10 +292,22 @@ MAPPINGS['dispute'] = {'dispute':MAPPINGS['record']['record']}
 MAPPINGS['log'] = {'log':MAPPINGS['record']['record']}
 MAPPINGS['license'] = {'license':MAPPINGS['record']['record']}
 
+# records carry the time their licence was last checked (seconds since the epoch),
+# which is indexed as a number so that it can be used in range queries
+MAPPINGS['record'] = {'record' : dict(MAPPINGS['record']['record'], properties={
+    "last_checked" : {"type" : "long"}
+})}
+
 # OAG version and user agent string
 version = '0.1 alpha'
 agent = 'OpenArticleGauge Service/' + version
 
+# JSON libraries to use for encoding and decoding records (in the cache, the
+# storage buffer, the Celery broker, the archive and the API), in order of preference.
+# The first one which can be loaded will be used; the standard library "json" module
+# is always the fallback.  See codec.py
+JSON_CODECS = ["orjson", "ujson", "simplejson", "json"]
+
 # Date format to be used throughout the system
 date_format = "%Y-%m-%dT%H:%M:%SZ"
 
@@ -1,44 +1,100 @@
-import os, requests, json, redis
+import requests, json, redis, hashlib
 from flask import Flask
 
-from openarticlegauge import config, licenses
+from openarticlegauge import licenses, settings, backends, plugin_registry
 
 def create_app():
     app = Flask(__name__)
     configure_app(app)
     if app.config['INITIALISE_INDEX']: initialise_index(app)
     prep_redis(app)
+    setup_plugins(app)
     setup_error_email(app)
     #login_manager.setup_app(app)
     return app
 
 def configure_app(app):
-    app.config.from_object(config)
-    # parent directory
-    here = os.path.dirname(os.path.abspath( __file__ ))
-    config_path = os.path.join(os.path.dirname(here), 'app.cfg')
-    if os.path.exists(config_path):
-        app.config.from_pyfile(config_path)
+    # config.py, overridden by app.cfg if there is one
+    app.config.update(settings.SETTINGS)
 
 def prep_redis(app):
-    # wipe the redis temp cache (not the non-temp one)
+    # wipe the redis temp cache (not the non-temp one), only if asked to
+    if not app.config.get('FLUSH_CACHE_ON_STARTUP', False):
+        return
     client = redis.StrictRedis(host=app.config['REDIS_CACHE_HOST'], port=app.config['REDIS_CACHE_PORT'], db=app.config['REDIS_CACHE_DB'])
     client.flushdb()
 
+def setup_plugins(app):
+    # reload the plugins when asked to, between requests, and let each request finish with the plugins
+    # it started with (see plugin_registry)
+    plugin_registry.watch()
+    app.before_request(plugin_registry.pin)
+    app.teardown_request(lambda exception: plugin_registry.unpin())
+
+class IndexException(Exception):
+    def __init__(self, message):
+        self.message = message
+        super(IndexException, self).__init__(self, message)
+
+# where the hash of the mappings and licences that the index was last initialised with is kept
+INDEX_MARKER = '/meta/initialised'
+
 def initialise_index(app):
+    # the embedded archive has no mappings, so only needs the licences
+    if app.config.get('ARCHIVE_BACKEND', 'elasticsearch') != 'elasticsearch':
+        backends.archive().bulk('license', [dict(l, id=k) for k, l in licenses.LICENSES.iteritems()])
+        return True
+    
     mappings = app.config["MAPPINGS"]
     i = str(app.config['ELASTIC_SEARCH_HOST']).rstrip('/')
     i += '/' + app.config['ELASTIC_SEARCH_DB']
+    
+    # if the index was initialised with exactly these mappings and licences, there is nothing to do
+    content_hash = index_content_hash(mappings, licenses.LICENSES)
+    marker = requests.get(i + INDEX_MARKER)
+    if marker.status_code == 200 and json.loads(marker.content).get('_source', {}).get('hash') == content_hash:
+        return False
+    
+    # make sure the index exists (if it already does, ES refuses, which is fine), then put every mapping,
+    # so that changes to a mapping are applied to an index which already has one
+    requests.post(i)
     for key, mapping in mappings.iteritems():
-        im = i + '/' + key + '/_mapping'
-        exists = requests.get(im)
-        if exists.status_code != 200:
-            ri = requests.post(i)
-            r = requests.put(im, json.dumps(mapping))
-            print key, r.status_code
-    # put the currently available licences into the licence index
+        r = requests.put(i + '/' + key + '/_mapping', json.dumps(mapping))
+        print key, r.status_code
+        if r.status_code != 200:
+            # most likely the new mapping can't be merged with the one that the index already has
+            raise IndexException("could not put the mapping for " + key + ": " + str(r.content))
+    
+    # put the currently available licences into the licence index, in one request
+    data = ''
     for l in licenses.LICENSES:
-        r = requests.post(i + '/license/' + l, json.dumps(licenses.LICENSES[l]))
+        data += json.dumps({'index' : {'_id' : l}}) + '\n'
+        data += json.dumps(licenses.LICENSES[l]) + '\n'
+    r = requests.post(i + '/license/_bulk', data=data)
+    
+    # only remember that it's done if it was - ES answers a bulk request with 200 even if some of its
+    # items failed, so each of them has to be checked
+    if r.status_code != 200:
+        print 'license', r.status_code
+        return True
+    errors = bulk_errors(json.loads(r.content))
+    if len(errors) > 0:
+        print 'license', errors
+        return True
+    requests.put(i + INDEX_MARKER, json.dumps({'hash' : content_hash}))
+    return True
+
+def bulk_errors(response):
+    # the errors reported for the individual items of an ES bulk request
+    errors = []
+    for item in response.get('items', []):
+        for action, result in item.iteritems():
+            if result.get('error'):
+                errors.append(result.get('_id', '') + ': ' + str(result['error']))
+    return errors
+
+def index_content_hash(mappings, licence_table):
+    return hashlib.sha1(json.dumps({'mappings' : mappings, 'licenses' : licence_table}, sort_keys=True)).hexdigest()
 
 def setup_error_email(app):
     ADMINS = app.config.get('ADMINS', '')
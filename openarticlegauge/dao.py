@@ -2,14 +2,15 @@
 Generic Data Access Object for mediating between the OAG application and the
 storage back end.
 
-This implementation provides storage in an Elasticsearch index.
+The storage itself is done by the archive back end set in the configuration: an
+Elasticsearch index, or an embedded SQLite database (see backends.py).
 
 """
 
-import os, json, UserDict, requests, uuid, logging
+import os, UserDict, uuid, logging
 from datetime import datetime
 
-from openarticlegauge.core import app #, current_user
+from openarticlegauge import codec, storage, backends
 
 class DomainObject(UserDict.IterableUserDict):
     """
@@ -30,10 +31,13 @@ class DomainObject(UserDict.IterableUserDict):
             
     @classmethod
     def target(cls):
-        t = 'http://' + app.config['ELASTIC_SEARCH_HOST'].lstrip('http://').rstrip('/') + '/'
-        t += app.config['ELASTIC_SEARCH_DB'] + '/' + cls.__type__ + '/'
+        t = storage.es_index() + '/' + cls.__type__ + '/'
         return t
     
+    @classmethod
+    def backend(cls):
+        return backends.archive()
+    
     @classmethod
     def makeid(cls):
         '''Create a new id for data object
@@ -50,7 +54,7 @@ class DomainObject(UserDict.IterableUserDict):
 
     @property
     def json(self):
-        return json.dumps(self.data)
+        return codec.dumps(self.data)
 
     def save(self):
         if 'id' in self.data:
@@ -70,25 +74,50 @@ class DomainObject(UserDict.IterableUserDict):
             except:
                 self.data['author'] = "anonymous"
 
-        r = requests.post(self.target() + self.data['id'], data=json.dumps(self.data))
+        self.backend().save(self.__type__, self.data['id'], self.data)
 
 
     @classmethod
     def bulk(cls, bibjson_list, refresh=False):
-        data = ''
-        for r in bibjson_list:
-            data += json.dumps( {'index':{'_id':r['id']}} ) + '\n'
-            data += json.dumps( r ) + '\n'
-        r = requests.post(cls.target() + '_bulk', data=data)
-        if refresh:
-            cls.refresh()
-        return r.json()
+        return cls.backend().bulk(cls.__type__, bibjson_list, refresh)
+
+
+    @classmethod
+    def bulk_update(cls, updates, refresh=False):
+        """
+        Apply partial updates to many objects in one request.  Only the fields supplied are
+        changed; the rest of each document is left as it is
+        
+        arguments:
+        updates -- a list of (id, partial document) tuples
+        refresh -- whether to refresh the index afterwards
+        
+        """
+        return cls.backend().bulk_update(cls.__type__, updates, refresh)
 
+    @classmethod
+    def scroll(cls, q=None, page_size=100, keepalive='5m'):
+        """
+        Iterate over every object matching the query, using a scan search (or, in the SQLite
+        archive, a walk through the ids in order).  Changes made to the objects while iterating
+        don't cause any to be skipped or repeated, and only one page is held in memory at a time
+        however many objects there are
+        
+        arguments:
+        q -- the query dict (as for query()).  Defaults to all objects
+        page_size -- the number of objects to retrieve per shard in each request
+        keepalive -- how long Elasticsearch should keep the snapshot between requests
+        
+        yields:
+        the _source of each matching object
+        
+        """
+        query = q if q is not None else {'query': {'match_all': {}}}
+        return cls.backend().scroll(cls.__type__, query, page_size, keepalive)
 
     @classmethod
     def refresh(cls):
-        r = requests.post(cls.target() + '_refresh')
-        return r.json()
+        return cls.backend().refresh(cls.__type__)
 
 
     @classmethod
@@ -97,14 +126,23 @@ class DomainObject(UserDict.IterableUserDict):
         if id_ is None:
             return None
         try:
-            out = requests.get(cls.target() + id_)
-            if out.status_code == 404:
+            out = cls.backend().get(cls.__type__, id_)
+            if out is None:
                 return None
             else:
-                return cls(**out.json())
+                return cls(**out)
         except:
             return None
 
+    @classmethod
+    def pull_many(cls, ids):
+        '''Retrieve many objects by id, in one request.
+
+        :param ids: a list of ids
+        :returns: a list of the objects, in the same order, with None for any which don't exist
+        '''
+        return [cls(**source) if source is not None else None for source in cls.backend().mget(cls.__type__, ids)]
+
     @classmethod
     def query(cls, recid='', endpoint='_search', q='', terms=None, facets=None, **kwargs):
         '''Perform a query on backend.
@@ -151,11 +189,7 @@ class DomainObject(UserDict.IterableUserDict):
             else:
                 query[k] = v
 
-        if endpoint in ['_mapping']:
-            r = requests.get(cls.target() + recid + endpoint)
-        else:
-            r = requests.post(cls.target() + recid + endpoint, data=json.dumps(query))
-        return r.json()
+        return cls.backend().search(cls.__type__, query, recid + endpoint)
 
     def accessed(self):
         if 'last_access' not in self.data:
@@ -165,8 +199,8 @@ class DomainObject(UserDict.IterableUserDict):
         except:
             usr = "anonymous"
         self.data['last_access'].insert(0, { 'user':usr, 'date':datetime.now().strftime("%Y-%m-%d %H%M") } )
-        r = requests.put(self.target() + self.data['id'], data=json.dumps(self.data))
+        self.backend().save(self.__type__, self.data['id'], self.data)
 
     def delete(self):        
-        r = requests.delete(self.target() + self.id)
+        self.backend().delete(self.__type__, self.id)
 
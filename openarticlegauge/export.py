@@ -0,0 +1,309 @@
+""" export of the archive to compressed NDJSON, for offline analysis or backup """
+
+"""
+Usage:
+
+1/ Export every record into gzipped shards of at most 256MB in the directory "export":
+
+export.py -d export
+
+2/ Export the identifiers and licence types of the records with a cc-by licence, compressed with zstd,
+   in shards of at most 64MB:
+
+export.py -d export -c zstd -m 64 -f identifier -f license.type -q "license.type:cc-by"
+
+Definition of options:
+
+-d - the directory to write the shards into (required).  It is created if it does not exist
+-p - the prefix of the shard file names (optional, default "records").  Shards are named
+     <prefix>-00000.ndjson.gz and so on
+-c - the compression to use: gzip, zstd (requires the zstandard library) or none (optional, default from config.EXPORT_COMPRESSION)
+-m - the maximum size of each shard, in megabytes after compression (optional, default from config.EXPORT_SHARD_SIZE)
+-f - a field to export (optional, may be repeated).  Nested fields are given with dots, e.g. license.type.
+     If omitted, whole records are exported
+-q - a query string to select the records to export (optional, default all records)
+-s - the number of records to read from each shard of the index in each request (optional, default from config.EXPORT_PAGE_SIZE)
+
+The records are read through a scan/scroll snapshot of the index, one page at a time, and each shard
+is written under a ".part" name until it is complete, so memory use does not grow with the size of the
+archive and an interrupted export never leaves a truncated shard looking finished.  Records still in
+the storage buffer are exported once they have been flushed to the archive.
+
+"""
+from openarticlegauge import models, config, codec
+import os, time, zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compression levels: zlib's default, and zstd's, which are both much faster than their maximums
+# for little difference in size
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# the file extension for each compression
+EXTENSIONS = {
+    "gzip" : ".ndjson.gz",
+    "zstd" : ".ndjson.zst",
+    "none" : ".ndjson"
+}
+
+# the mimetype the export endpoint serves each compression as
+MIMETYPES = {
+    "gzip" : "application/gzip",
+    "zstd" : "application/zstd",
+    "none" : "application/x-ndjson"
+}
+
+def export(directory, compression=None, shard_size=None, fields=None, q=None, prefix="records", page_size=None, reporter=None):
+    """
+    Export the records in the archive into compressed NDJSON shards in the directory
+
+    arguments:
+    directory -- the directory to write the shards into.  It is created if it does not exist
+    compression -- "gzip", "zstd" or "none".  Defaults to config.EXPORT_COMPRESSION
+    shard_size -- the maximum size of each shard in bytes, after compression.  A new shard is started when the
+        current one reaches it, so shards may be over it by up to one page of records.  Defaults to config.EXPORT_SHARD_SIZE
+    fields -- a list of the fields to export from each record (see project).  Defaults to the whole record
+    q -- a query (an Elasticsearch query dict, as for dao.DomainObject.scroll) to select the records to export.  Defaults to all records
+    prefix -- the prefix of the shard file names
+    page_size -- the number of records to read from each shard of the index in each request.  Defaults to config.EXPORT_PAGE_SIZE
+    reporter -- a callback function which can be used to report on the progress of this method.  Used for command line or logging integration
+
+    returns:
+    a dictionary of statistics about the export: the number of records exported, the paths of the shards
+        written, the total size of the shards before and after compression, and the time taken
+
+    """
+    if reporter is None:
+        reporter = lambda x: None
+    if compression is None:
+        compression = config.EXPORT_COMPRESSION
+    if shard_size is None:
+        shard_size = config.EXPORT_SHARD_SIZE
+
+    # check the compression is usable before we start
+    _compressor(compression)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    stats = {"records" : 0, "shards" : [], "bytes_before" : 0, "bytes_after" : 0}
+    started = time.time()
+    shard = None
+    try:
+        for page in _pages(fields, q, page_size):
+            if shard is None:
+                path = os.path.join(directory, prefix + "-" + str(len(stats["shards"])).zfill(5) + EXTENSIONS[compression])
+                shard = _Shard(path, compression)
+
+            shard.write(page)
+            stats["bytes_before"] += len(page)
+            stats["records"] += page.count("\n")
+
+            if shard.size >= shard_size:
+                _finish(shard, stats, reporter)
+                shard = None
+                reporter("exported " + str(stats["records"]) + " records in " + str(int(time.time() - started)) + "s")
+
+        if shard is not None:
+            _finish(shard, stats, reporter)
+            shard = None
+    finally:
+        if shard is not None:
+            shard.abandon()
+
+    stats["seconds"] = time.time() - started
+    reporter("exported " + str(stats["records"]) + " records into " + str(len(stats["shards"])) + " shards in " + str(int(stats["seconds"])) + "s, " +
+             str(stats["bytes_before"]) + " bytes compressed to " + str(stats["bytes_after"]))
+    return stats
+
+def stream(fields=None, q=None, compression=None, page_size=None):
+    """
+    Export the records in the archive as a single stream of compressed NDJSON, e.g. for sending
+    in a web response
+
+    arguments:
+    fields -- a list of the fields to export from each record (see project).  Defaults to the whole record
+    q -- a query (an Elasticsearch query dict) to select the records to export.  Defaults to all records
+    compression -- "gzip", "zstd" or "none".  Defaults to config.EXPORT_COMPRESSION
+    page_size -- the number of records to read from each shard of the index in each request.  Defaults to config.EXPORT_PAGE_SIZE
+
+    returns:
+    a generator of compressed chunks of the export
+
+    """
+    if compression is None:
+        compression = config.EXPORT_COMPRESSION
+    compressor = _compressor(compression)
+
+    def chunks():
+        for page in _pages(fields, q, page_size):
+            data = compressor.compress(page)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    return chunks()
+
+def project(record, fields):
+    """
+    Pick the fields out of the record.  Nested fields are given with dots, e.g. "license.type", and
+    where a field holds a list of objects the rest of the path is picked out of each of them, so
+    "license.type" of {"license" : [{"type" : "cc-by", "url" : "..."}]} is {"license" : [{"type" : "cc-by"}]}
+
+    arguments:
+    record -- the record
+    fields -- a list of fields.  If None, the whole record is returned
+
+    returns:
+    a new record with only the fields, which are left out where the record doesn't have them
+
+    """
+    return _project(record, _field_tree(fields))
+
+def compressions():
+    """
+    List the compressions which can be used in this environment (zstd requires an optional library)
+
+    """
+    return [c for c in EXTENSIONS.keys() if c != "zstd" or zstandard is not None]
+
+def query_string(q):
+    """
+    Make an Elasticsearch query dict from a query string, as for the q parameter of /query
+
+    """
+    return {'query': {'query_string': {'query': q}}}
+
+def _field_tree(fields):
+    # a tree of the fields, in which None stands for the whole of a field (so no fields is the whole record)
+    if fields is None:
+        return None
+    tree = {}
+    for field in fields:
+        parts = field.split(".")
+        node = tree
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree
+
+def _project(obj, tree):
+    if tree is None:
+        return obj
+    if isinstance(obj, list):
+        return [_project(item, tree) for item in obj if isinstance(item, (dict, list))]
+    if not isinstance(obj, dict):
+        return None
+    projected = {}
+    for key, subtree in tree.iteritems():
+        if key in obj:
+            projected[key] = _project(obj[key], subtree)
+    return projected
+
+def _pages(fields, q, page_size):
+    # the records, encoded as NDJSON, a page of the scroll at a time, so that each page is encoded and
+    # compressed in one go rather than line by line
+    if page_size is None:
+        page_size = config.EXPORT_PAGE_SIZE
+    tree = _field_tree(fields)
+    lines = []
+    for record in models.Record.scroll(q=q, page_size=page_size):
+        s = codec.dumps(_project(record, tree))
+        if isinstance(s, unicode):
+            s = s.encode("utf-8")
+        lines.append(s)
+        if len(lines) >= page_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if len(lines) > 0:
+        yield "\n".join(lines) + "\n"
+
+def _compressor(compression):
+    if compression == "gzip":
+        # wbits of 16 + MAX_WBITS gives a gzip header and trailer
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ExportException("zstd compression requires the zstandard library to be installed")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    if compression == "none":
+        return _NoCompression()
+    raise ExportException("unknown compression '" + str(compression) + "', must be one of " + ", ".join(sorted(EXTENSIONS.keys())))
+
+def _finish(shard, stats, reporter):
+    shard.close()
+    stats["shards"].append(shard.path)
+    stats["bytes_after"] += shard.size
+    reporter("wrote " + shard.path + " (" + str(shard.size) + " bytes)")
+
+class _Shard(object):
+    # a shard file being written, under a temporary name until it is closed
+    def __init__(self, path, compression):
+        self.path = path
+        self.size = 0
+        self._compressor = _compressor(compression)
+        self._file = open(path + ".part", "wb")
+
+    def write(self, data):
+        self._write(self._compressor.compress(data))
+
+    def close(self):
+        self._write(self._compressor.flush())
+        self._file.close()
+        os.rename(self.path + ".part", self.path)
+
+    def abandon(self):
+        self._file.close()
+        os.remove(self.path + ".part")
+
+    def _write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+
+class _NoCompression(object):
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return ""
+
+class ExportException(Exception):
+    """
+    Exception class to handle any problems arising in the export
+
+    """
+    def __init__(self, message):
+        self.message = message
+        super(ExportException, self).__init__(self, message)
+
+def stdout_reporter(msg):
+    print msg
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--directory", help="the directory to write the shards into", required=True)
+    parser.add_argument("-p", "--prefix", help="the prefix of the shard file names", default="records")
+    parser.add_argument("-c", "--compression", help="the compression to use", choices=sorted(EXTENSIONS.keys()))
+    parser.add_argument("-m", "--max-size", help="the maximum size of each shard, in megabytes after compression", type=float)
+    parser.add_argument("-f", "--field", help="a field to export, with dots for nested fields (may be repeated).  If omitted, whole records are exported", action="append")
+    parser.add_argument("-q", "--query", help="a query string to select the records to export")
+    parser.add_argument("-s", "--page-size", help="the number of records to read from each shard of the index in each request", type=int)
+
+    args = parser.parse_args()
+
+    shard_size = int(args.max_size * 1024 * 1024) if args.max_size is not None else None
+    q = query_string(args.query) if args.query is not None else None
+
+    try:
+        export(args.directory, args.compression, shard_size, args.field, q, args.prefix, args.page_size, stdout_reporter)
+    except ExportException as e:
+        print e.message
+        exit()
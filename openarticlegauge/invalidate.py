@@ -19,6 +19,10 @@ invalidate.py -h handler_name -v handler_version -t license_type
 
 invalidate.py -e -u
 
+5/ Remove all unknown licenses, using 8 processes, at no more than 500 records per second, in a way that can be resumed
+
+invalidate.py -a -u -j 8 -r 500 -c invalidate.checkpoint
+
 Definition of options:
 
 -e - license has /no/ handlers (required if -a or -p is not specified)
@@ -27,20 +31,33 @@ Definition of options:
 -v - the version of the handler (optional).  If omitted, all versions of the handler will be dealt with.  Must only be present if -h is specified
 -t - the type of license to be removed (required if -u is not specified)
 -u - the unknown license (required if -t is not specified)
+-s - the number of records to read from each shard of the index, and write back, in each request (optional, default 100)
+-j - the number of processes to run in parallel (optional, default 1)
+-n - the number of partitions to split the records into, to be shared out between the processes (optional, defaults to -j)
+-r - the maximum number of records to process per second, across all processes (optional)
+-c - a checkpoint file in which to record progress (optional).  If the run is interrupted, the same command will resume it
 
 """
-from openarticlegauge import models
-import json
+from openarticlegauge import models, cache, backends, recordmanager
+import json, time, os, multiprocessing
 
+# the number of records to retrieve from each shard of the index in each request, and to send
+# back in each bulk update
 ES_PAGE_SIZE = 100
 
-def invalidate_license(license_type, handler=None, handler_version=None, treat_none_as_missing=False, reporter=None):
+def invalidate_license(license_type, handler=None, handler_version=None, treat_none_as_missing=False, reporter=None, page_size=None, partition=None, rate_limit=None):
     """
     Invalidate all licences with the specified licence type.  The handler and handler_version may
     be left unset, or set to a specific value.  If left unset then treat_none_as_missing may be used
     to expressly indicate whether a None value for the handler is a wildcard or implies that there
     is no handler specified
     
+    The matching records are read from a snapshot of the index (see models.Record.scroll), so the
+    changes being made can't cause records to be skipped or processed twice, and memory use does
+    not grow with the number of records.  Only the changed licence lists are written back, as
+    bulk partial updates.  Records waiting in the storage buffer are dealt with too, and the
+    affected records in the cache are all invalidated at once (see cache.bump_generation).
+    
     arguments
     license_type -- the type of the licence as would appear in the bibjson record in bibjson['license'][n]['type']
         common values include failed-to-obtain-licence, cc-by, cc0, etc, but there are a long list of possible options
@@ -49,12 +66,34 @@ def invalidate_license(license_type, handler=None, handler_version=None, treat_n
     treat_none_as_missing -- if True, then if handler=None then this will look for licences which do not have a handler associated with them
                              if False, then if handler=None then this will look for any value (other than None) in the handler field
     reporter -- a callback function which can be used to report on the progress of this method.  Used for command line or logging integration
+    page_size -- the number of records to read per shard, and write back, in each request.  Defaults to ES_PAGE_SIZE
+    partition -- a tuple of (partition number, number of partitions), to only deal with that partition of the records.  See invalidate_parallel
+    rate_limit -- the maximum number of records to process per second
+    
+    returns:
+    a dictionary of statistics: the number of records examined and updated, and licences removed
     
     """
     # the reporter is a callback which handles messages of the progress of this operation.  If none
     # is specified we operate silently
     if reporter is None:
-        reporter = lambda x: None
+        reporter = _silent_reporter
+    
+    stats = _invalidate_archive(license_type, handler, handler_version, treat_none_as_missing, reporter, page_size, partition, rate_limit)
+    
+    # when only doing one partition, whoever is running the others will deal with everything else
+    if partition is None:
+        stats["removed"] += _invalidate_buffer(license_type, handler, handler_version, treat_none_as_missing, reporter)
+        _invalidate_cache(license_type, handler, handler_version, treat_none_as_missing, reporter)
+    return stats
+
+def _invalidate_archive(license_type, handler, handler_version, treat_none_as_missing, reporter, page_size=None, partition=None, rate_limit=None):
+    """
+    Remove the licences from the records in the archive; see invalidate_license for details
+    
+    """
+    if page_size is None:
+        page_size = ES_PAGE_SIZE
     
     # report on the operation we are going to carry out
     msg = "invalidating license type '" + license_type + "' for "
@@ -68,81 +107,244 @@ def invalidate_license(license_type, handler=None, handler_version=None, treat_n
             msg += " (all versions)"
     reporter(msg)
     
-    # assemble an initial ElasticSearch query object
+    # assemble the ElasticSearch query object
     query = {
         "filter" : { 
             "and" : [
                 {"term" : {"license.type.exact" : license_type}}
             ]
-        },
-        "size" : ES_PAGE_SIZE,
-        "from" : 0
+        }
     }
     if handler is not None:
         query['filter']['and'].append({"term" : {"license.provenance.handler.exact" : handler}})
     if handler_version is not None:
         query['filter']['and'].append({"term" : {"license.provenance.handler_version.exact" : handler_version}})
+    if partition is not None:
+        query['filter']['and'].append(_partition_filter(partition[0], partition[1]))
     
     # report on the query
-    reporter("using initial search query: " + json.dumps(query))
+    reporter("using search query: " + json.dumps(query))
     
-    first = True
-    while True:
-        # do the query
-        response = models.Record.query(q=query)
-        
-        # get the important numbers for paging
-        total = response.get("hits", {}).get("total", 0)
-        page_size = len(response.get("hits", {}).get("hits", []))
-        end_of_current_page = query["from"] + page_size
-        
-        if first:
-            reporter("total number of relevant records found: " + str(total))
-            first = False
-        reporter("processing records " + str(query["from"]) + " - " + str(end_of_current_page))
-        
-        # process the response from the query
-        _process_response(response, license_type, handler, handler_version, treat_none_as_missing, reporter)
+    stats = {"examined" : 0, "updated" : 0, "removed" : 0}
+    started = time.time()
+    updates = []
+    for record in models.Record.scroll(q=query, page_size=page_size):
+        stats["examined"] += 1
+        _throttle(stats["examined"], started, rate_limit)
+        keep = _remaining_licenses(record, license_type, handler, handler_version, treat_none_as_missing)
+        diff = len(record.get('license', [])) - len(keep)
+        if diff > 0:
+            reporter("removed " + str(diff) + " licenses from " + str(record.get("id")))
+            updates.append((record.get("id"), {"license" : keep, "last_checked" : _last_checked(keep)}))
+            stats["updated"] += 1
+            stats["removed"] += diff
         
-        if total > end_of_current_page:
-            query["from"] = query["from"] + query["size"]
-        else:
-            break
+        # push the changes back to the index a page at a time
+        if len(updates) >= page_size:
+            models.Record.bulk_update(updates)
+            updates = []
+            reporter(_progress(stats, started))
+    
+    if len(updates) > 0:
+        models.Record.bulk_update(updates)
+    
+    reporter("finished: " + _progress(stats, started))
+    return stats
 
-def _process_response(response, license_type, handler, handler_version, treat_none_as_missing, reporter):
+def _invalidate_buffer(license_type, handler, handler_version, treat_none_as_missing, reporter):
     """
-    Process the Elasticsearch response object by taking all the records therein and deleting
-    the licences consistent with the arguments.
+    Remove the licences from the records waiting in the storage buffer, which the archive doesn't have yet
+    
+    returns:
+    the number of licences removed
+    
+    """
+    removed = 0
+    for record in models.Record.buffered():
+        keep = _remaining_licenses(record, license_type, handler, handler_version, treat_none_as_missing)
+        diff = len(record.get('license', [])) - len(keep)
+        if diff > 0:
+            record['license'] = keep
+            record['last_checked'] = _last_checked(keep)
+            models.Record._add_to_buffer(record)
+            removed += diff
+            reporter("removed " + str(diff) + " licenses from " + str(record.get("id")) + " in the storage buffer")
+    return removed
+
+def _last_checked(licences):
+    """
+    Work out when the licence of a record was last checked, from the licences it has left, so that a record
+    whose licences have all been removed isn't taken to have been checked recently
+    
+    returns:
+    the time of the last check in seconds since the epoch, or None if none of the licences has a valid date
+    
+    """
+    return recordmanager.compute_last_checked({"license" : licences})
+
+def _invalidate_cache(license_type, handler, handler_version, treat_none_as_missing, reporter):
+    """
+    Invalidate all the affected records in the cache at once, by bumping the relevant generation counter
+    
+    """
+    field, generation = cache.bump_generation(handler, handler_version, treat_none_as_missing, license_type)
+    reporter("invalidated cached records by moving generation '" + field + "' on to " + str(generation))
+
+def invalidate_parallel(license_type, handler=None, handler_version=None, treat_none_as_missing=False, reporter=None, page_size=None,
+                        processes=4, partitions=None, rate_limit=None, checkpoint=None):
+    """
+    Invalidate licences as per invalidate_license, but with the records split into partitions (by a hash
+    of their id) which are processed in parallel by a pool of processes.
+    
+    If a checkpoint file is given, the partitions which have been completed are recorded in it, so that
+    if the run is interrupted it can be resumed by running it again with the same arguments; completed
+    partitions are then skipped.  A partition which was part way through when the run was interrupted
+    is started again, but that only has to look at the records which were not yet dealt with, since
+    the rest no longer match.  The checkpoint file is removed when the run completes.
+    
+    arguments
+    license_type, handler, handler_version, treat_none_as_missing, reporter, page_size -- as for invalidate_license
+    processes -- the number of processes to use
+    partitions -- the number of partitions to split the records into.  Defaults to the number of processes
+    rate_limit -- the maximum number of records to process per second, across all processes
+    checkpoint -- the path to the checkpoint file
+    
+    returns:
+    a dictionary of statistics for the whole run (as for invalidate_license), plus the number of partitions
+        processed and the number skipped because they were already complete
+    
+    """
+    if reporter is None:
+        reporter = _silent_reporter
+    if partitions is None:
+        partitions = processes
+    
+    job = {"license_type" : license_type, "handler" : handler, "handler_version" : handler_version,
+            "treat_none_as_missing" : treat_none_as_missing, "partitions" : partitions}
+    done = _load_checkpoint(checkpoint, job)
+    todo = [i for i in range(partitions) if str(i) not in done]
+    reporter("processing " + str(len(todo)) + " of " + str(partitions) + " partitions with " + str(processes) + " processes" +
+            (" (" + str(partitions - len(todo)) + " already complete)" if len(todo) < partitions else ""))
+    
+    # share the rate limit out between the processes
+    per_process_rate = float(rate_limit) / min(processes, max(len(todo), 1)) if rate_limit else None
+    
+    started = time.time()
+    args = [(license_type, handler, handler_version, treat_none_as_missing, reporter, page_size, (i, partitions), per_process_rate) for i in todo]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for i, stats in pool.imap_unordered(_invalidate_partition, args):
+            done[str(i)] = stats
+            _save_checkpoint(checkpoint, job, done)
+            reporter("partition " + str(i) + " complete: " + _progress(stats, started) + "; " + str(len(done)) + " of " + str(partitions) + " partitions done")
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    
+    summary = {"examined" : 0, "updated" : 0, "removed" : 0}
+    for i in todo:
+        for k in summary.keys():
+            summary[k] += done[str(i)][k]
+    
+    summary["removed"] += _invalidate_buffer(license_type, handler, handler_version, treat_none_as_missing, reporter)
+    _invalidate_cache(license_type, handler, handler_version, treat_none_as_missing, reporter)
+    summary["partitions"] = len(todo)
+    summary["skipped_partitions"] = partitions - len(todo)
+    
+    reporter("summary: " + _progress(summary, started) + " across " + str(len(todo)) + " partitions" +
+            (", " + str(summary["skipped_partitions"]) + " partitions skipped as already complete" if summary["skipped_partitions"] > 0 else ""))
+    
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return summary
+
+def _invalidate_partition(args):
+    # run in the pool's processes, so has to be a module level function which takes a single argument
+    license_type, handler, handler_version, treat_none_as_missing, reporter, page_size, partition, rate_limit = args
+    stats = invalidate_license(license_type, handler, handler_version, treat_none_as_missing, reporter, page_size, partition, rate_limit)
+    return partition[0], stats
+
+def _partition_filter(partition, partitions):
+    """
+    Get an Elasticsearch filter which matches only the records in the given partition, by a hash of their id
+    
+    """
+    return {
+        "script" : {
+            "script" : backends.PARTITION_SCRIPT,
+            "params" : {"partition" : partition, "partitions" : partitions}
+        }
+    }
+
+def _throttle(processed, started, rate_limit):
+    """
+    Sleep for long enough to keep the processing rate below the rate limit (records per second)
+    
+    """
+    if not rate_limit:
+        return
+    ahead = processed / float(rate_limit) - (time.time() - started)
+    if ahead > 0:
+        time.sleep(ahead)
+
+def _load_checkpoint(path, job):
+    """
+    Load the partitions already completed from the checkpoint file, if there is one.  A checkpoint
+    from a run with different arguments can't be resumed, so that raises a ValueError
+    
+    returns:
+    a dictionary of statistics for each completed partition, keyed by partition number (as a string)
+    
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("job") != job:
+        raise ValueError("checkpoint file " + path + " is for a different invalidation run: " + json.dumps(checkpoint.get("job")))
+    return checkpoint.get("done", {})
+
+def _save_checkpoint(path, job, done):
+    if path is None:
+        return
+    # write and then move, so that an interruption can't leave a half written checkpoint
+    with open(path + ".tmp", "w") as f:
+        json.dump({"job" : job, "done" : done}, f)
+    os.rename(path + ".tmp", path)
+
+def _remaining_licenses(record, license_type, handler, handler_version, treat_none_as_missing):
+    """
+    Work out which of the record's licences remain once those consistent with the arguments are removed
     
     arguments:
-    response -- Elastic search response object containing bibjson records as the individual results
+    record -- the bibjson record
     license_type -- the type of licence to remove
     handler -- the handler to remove (can be None)
     handler_version -- the handler_version to remove (can be None)
     treat_none_as_missing -- if True, then if handler=None then this will look for licences which do not have a handler associated with them
                              if False, then if handler=None then this will look for any value (other than None) in the handler field
-    reporter -- a callback function which can be used to report on the progress of this method.  Used for command line or logging integration
+    
+    returns:
+    the list of licences to keep
     
     """
-    # extract the records
-    records = [hit.get("_source") for hit in response.get("hits", {}).get("hits", [])]
-    
-    # for each record go through all of its licences and delete any which meet the criteria provided
-    for record in records:
-        reporter("processing id: " + str(record.get("id")))
-        keep = []
-        for license in record.get("license", []):
-            type_match = license.get("type") == license_type
-            handler_match = _handler_match(license, handler, treat_none_as_missing)
-            version_match = license.get("provenance", {}).get("handler_version") == handler_version if handler_version is not None else True
-            if not (type_match and handler_match and version_match):
-                keep.append(license)
-        diff = len(record.get('license', [])) - len(keep) 
-        record['license'] = keep
-        reporter("removed " + str(diff) + " licenses from " + str(record.get("id")))
-    
-    # now push the records back to the index
-    models.Record.bulk(records)
+    keep = []
+    for license in record.get("license", []):
+        type_match = license.get("type") == license_type
+        handler_match = _handler_match(license, handler, treat_none_as_missing)
+        version_match = license.get("provenance", {}).get("handler_version") == handler_version if handler_version is not None else True
+        if not (type_match and handler_match and version_match):
+            keep.append(license)
+    return keep
+
+def _progress(stats, started):
+    elapsed = time.time() - started
+    rate = stats["examined"] / elapsed if elapsed > 0 else 0.0
+    return ("examined " + str(stats["examined"]) + " records, updated " + str(stats["updated"]) +
+            ", removed " + str(stats["removed"]) + " licenses in " + ("%.1f" % elapsed) + "s (" + ("%.1f" % rate) + " records/s)")
 
 def _handler_match(license, handler, treat_none_as_missing):
     """
@@ -190,6 +392,9 @@ def _handler_match(license, handler, treat_none_as_missing):
 def stdout_reporter(msg):
     print msg
 
+def _silent_reporter(msg):
+    pass
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -200,6 +405,11 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--version", help="the version of the handler whose license to invalidate (must only be present if -h is specified")
     parser.add_argument("-u", "--unknown", help="short cut for specifying the unknonw license as the target license to remove.  Must be present if -t is not specified", action="store_true")
     parser.add_argument("-t", "--type", help="explicitly specify the type of the license to be removed (use with caution).  Must be present if -u is not specified")
+    parser.add_argument("-s", "--page-size", help="the number of records to read from each shard, and write back, in each request", type=int, default=ES_PAGE_SIZE)
+    parser.add_argument("-j", "--processes", help="the number of processes to run in parallel", type=int, default=1)
+    parser.add_argument("-n", "--partitions", help="the number of partitions to split the records into (defaults to the number of processes)", type=int)
+    parser.add_argument("-r", "--rate", help="the maximum number of records to process per second, in total", type=float)
+    parser.add_argument("-c", "--checkpoint", help="a file in which to record progress.  If the run is interrupted, run the same command again to resume it")
 
     args = parser.parse_args()
 
@@ -248,7 +458,15 @@ if __name__ == "__main__":
     treat_none_as_missing = args.empty
     
     # and send off to the routine that invalidates licenses
-    invalidate_license(license_type, handler, handler_version, treat_none_as_missing, stdout_reporter)
+    if args.processes > 1 or args.partitions is not None or args.checkpoint is not None:
+        try:
+            invalidate_parallel(license_type, handler, handler_version, treat_none_as_missing, stdout_reporter, args.page_size,
+                                args.processes, args.partitions, args.rate, args.checkpoint)
+        except ValueError as e:
+            print e
+            exit()
+    else:
+        invalidate_license(license_type, handler, handler_version, treat_none_as_missing, stdout_reporter, args.page_size, rate_limit=args.rate)
 
 
     
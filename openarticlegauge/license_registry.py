@@ -0,0 +1,57 @@
+"""
+The licences in the licences module, compiled once at import into templates for the licence objects
+that plugins attach to records, so that building one is a single shallow copy.
+
+Each template is the licence's entry in licenses.LICENSES, with its open access decision (see
+oa_policy) already made, and the fields every licence object must have defaulted to empty.  The
+templates are immutable; build gives you a copy to fill in.
+
+"""
+
+from openarticlegauge.licenses import LICENSES
+from openarticlegauge import oa_policy
+
+# fields which have to be there, even if empty
+DEFAULTS = {
+    'version' : '',
+    'description' : '',
+    'jurisdiction' : ''
+}
+
+def _open_access(licence):
+    # licences which don't say what rights they grant can't be decided, so are not open access
+    rights = dict([(k, licence.get(k)) for k in ['NC', 'SA', 'ND']])
+    return oa_policy.oa_from_rights(**rights)
+
+def _compile(licence):
+    template = dict(DEFAULTS)
+    template.update(licence)
+    template['open_access'] = _open_access(licence)
+    # all the values are strings, booleans or None, so the items can be frozen as they are
+    return tuple(template.items())
+
+TEMPLATES = dict([(lic_type, _compile(licence)) for lic_type, licence in LICENSES.iteritems()])
+
+def build(lic_type, overrides=None, provenance=None):
+    """
+    Build a new licence object of the given type
+    
+    arguments:
+    lic_type -- the type of the licence, as in licenses.LICENSES
+    overrides -- a dictionary of values to use in place of those from the licences module, e.g. what
+        a plugin knows about the licence from the statement it found
+    provenance -- the provenance of the licence (see recordmanager.add_license)
+    
+    returns:
+    the licence object, which is the caller's to change
+    
+    raises:
+    KeyError if there is no such licence type
+    
+    """
+    licence = dict(TEMPLATES[lic_type])
+    if overrides:
+        licence.update(overrides)
+    if provenance is not None:
+        licence['provenance'] = provenance
+    return licence
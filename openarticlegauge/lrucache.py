@@ -0,0 +1,156 @@
+"""
+A small in-process cache, for keeping the results of expensive operations for a short while.
+
+Entries expire a fixed number of seconds after they were stored, and when the cache is full (of
+entries, or optionally of bytes, by the sizes given when they are stored) the least recently used
+entries are evicted.  The cache is thread safe, and get_or_compute collapses
+concurrent requests for the same missing key into a single computation: the first caller does the
+work, and the rest wait for, and share, its result.
+
+"""
+
+import threading, time
+from collections import OrderedDict
+
+class LRUCache(object):
+
+    def __init__(self, max_items, timeout, max_bytes=None):
+        """
+        arguments:
+        max_items -- the maximum number of entries to keep
+        timeout -- the number of seconds for which to keep each entry
+        max_bytes -- the maximum total size of the entries to keep (optional)
+
+        """
+        self.max_items = max_items
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        get the value stored under the key
+
+        returns:
+        the value, or the default if there is no entry for the key or it has expired
+
+        """
+        with self._lock:
+            found, value = self._get(key)
+        return value if found else default
+
+    def set(self, key, value, size=0):
+        """
+        store the value under the key, evicting the least recently used entries if the cache is full
+
+        arguments:
+        key -- the key
+        value -- the value
+        size -- the size of the value, in bytes, counted against max_bytes
+
+        """
+        with self._lock:
+            self._set(key, value, size)
+
+    def invalidate(self, key):
+        """
+        remove the entry for the key, if there is one
+
+        """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """
+        remove all the entries
+
+        """
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def get_or_compute(self, key, compute):
+        """
+        get the value stored under the key, or if there isn't one, compute and store it.  If the
+        value is already being computed for another caller, wait for that instead.  Exceptions
+        raised by compute are passed on to every caller waiting for it, and nothing is stored
+
+        arguments:
+        key -- the key of the value
+        compute -- a function of no arguments which produces the value
+
+        returns:
+        the value
+
+        """
+        with self._lock:
+            found, value = self._get(key)
+            if found:
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None:
+                    self._set(key, flight.value)
+                del self._inflight[key]
+            flight.done.set()
+        return flight.value
+
+    def _get(self, key):
+        # must be called with the lock held
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                self.bytes -= entry[2]
+            self.misses += 1
+            return False, None
+        # put it back at the most recently used end
+        self._entries[key] = entry
+        self.hits += 1
+        return True, entry[1]
+
+    def _set(self, key, value, size=0):
+        # must be called with the lock held
+        self._remove(key)
+        self._entries[key] = (time.time() + self.timeout, value, size)
+        self.bytes += size
+        while len(self._entries) > self.max_items or (self.max_bytes is not None and self.bytes > self.max_bytes and len(self._entries) > 0):
+            self.bytes -= self._entries.popitem(last=False)[1][2]
+
+    def _remove(self, key):
+        # must be called with the lock held
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+class _Flight(object):
+    # a computation in progress, which other callers can wait on
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
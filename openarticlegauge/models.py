@@ -3,11 +3,10 @@ Data model objects, some of which extend the DAO for storage purposes
 
 """
 
-import json, redis, logging
+import logging, hashlib, time
 
-from openarticlegauge import config
+from openarticlegauge import config, codec, cache, storage, recordmanager
 from openarticlegauge.dao import DomainObject
-from openarticlegauge.core import app
 from openarticlegauge.slavedriver import celery
 
 log = logging.getLogger(__name__)
@@ -120,8 +119,8 @@ class Record(DomainObject):
         if canonical is None:
             raise BufferException("cannot buffer an item without a canonical form of the identifier")
         
-        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
-        s = json.dumps(bibjson)
+        client = storage.redis_client(config.REDIS_BUFFER_HOST, config.REDIS_BUFFER_PORT, config.REDIS_BUFFER_DB)
+        s = codec.dumps(bibjson)
         client.set("id_" + canonical, s)
     
     @classmethod
@@ -136,11 +135,27 @@ class Record(DomainObject):
         
         """
         # query the redis cache for the bibjson record and return it
-        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        client = storage.redis_client(config.REDIS_BUFFER_HOST, config.REDIS_BUFFER_PORT, config.REDIS_BUFFER_DB)
         record = client.get("id_" + canonical)
         if record is None or record == "":
             return None
-        return json.loads(record)
+        return codec.loads(record)
+    
+    @classmethod
+    def buffered(cls):
+        """
+        Iterate over the bibjson records which are currently in the storage buffer
+        
+        yields:
+        each bibjson record
+        
+        """
+        client = storage.redis_client(config.REDIS_BUFFER_HOST, config.REDIS_BUFFER_PORT, config.REDIS_BUFFER_DB)
+        for key in client.scan_iter(match="id_*"):
+            s = client.get(key)
+            if s is None or s == "":
+                continue
+            yield codec.loads(s)
     
     @classmethod
     def flush_buffer(cls, key_timeout=0, block_size=1000):
@@ -163,7 +178,7 @@ class Record(DomainObject):
         True if there are items in the buffer to flush and they are successfully flushed
         
         """
-        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        client = storage.redis_client(config.REDIS_BUFFER_HOST, config.REDIS_BUFFER_PORT, config.REDIS_BUFFER_DB)
         
         # get all of the id keys
         ids = client.keys("id_*")
@@ -179,7 +194,7 @@ class Record(DomainObject):
         for identifier in ids:
             # obtain, decode and register the bibjson record to be archived
             s = client.get(identifier)
-            obj = json.loads(s)
+            obj = codec.loads(s)
             bibjson_records.append(obj)
             
             # if we've reached the block size, do a bulk write
@@ -203,6 +218,46 @@ class Record(DomainObject):
         
         return True
 
+    @classmethod
+    def checked_before(cls, timestamp, size=10, ids=None, exclude=None):
+        """
+        Find archived records whose licence was last checked before the given time, oldest first
+        
+        Records archived before bibjson['last_checked'] was kept don't have it, so for those the time
+        of the last check is taken from the dates in their licences' provenance, as it is when they are
+        read (see recordmanager.compute_last_checked).  They come first, as they are the oldest
+        
+        arguments:
+        timestamp -- the time (seconds since the epoch) before which the licence was last checked
+        size -- the maximum number of records to return
+        ids -- if supplied, only look among the records with these (canonical) identifiers
+        exclude -- if supplied, leave out the records with these (canonical) identifiers
+        
+        returns:
+        a tuple of the total number of matching records, and a list of (up to size of) their bibjson records
+        
+        """
+        # a legacy record was last checked before the given time if none of its licences is dated at or
+        # after it.  Dates in config.date_format sort as strings in the same order as in time
+        legacy = {"and" : [
+            {"missing" : {"field" : "last_checked"}},
+            {"not" : {"range" : {"license.provenance.date.exact" : {"gte" : recordmanager.epoch_to_date(timestamp)}}}}
+        ]}
+        f = {"or" : [{"range" : {"last_checked" : {"lt" : timestamp}}}, legacy]}
+        if ids is not None:
+            f = {"and" : [f, {"ids" : {"values" : [i.replace('/','_') for i in ids]}}]}
+        if exclude:
+            f = {"and" : [f, {"not" : {"ids" : {"values" : [i.replace('/','_') for i in exclude]}}}]}
+        query = {
+            "query" : {"filtered" : {"query" : {"match_all" : {}}, "filter" : f}},
+            # an index whose mapping predates last_checked can't sort on it otherwise
+            "sort" : [{"last_checked" : {"order" : "asc", "missing" : "_first", "ignore_unmapped" : True}}],
+            "size" : size
+        }
+        result = cls.query(q=query)
+        hits = result.get("hits", {})
+        return hits.get("total", 0), [h.get("_source", {}) for h in hits.get("hits", [])]
+
 class Issue(DomainObject):
     __type__ = 'issue'
 
@@ -222,7 +277,8 @@ class ResultSet(object):
     {
 	    "requested" : number_requested_in_batch,
 	    "results" : [
-		    the list of bibjson record objects already known
+		    the list of bibjson record objects already known.  Any which are stale, and are being
+		    refreshed, have "stale" : true
 	    ],
 	    "errors" : [
 		    a list of JSON objects with an "identifier" key and an "error" key
@@ -267,6 +323,11 @@ class ResultSet(object):
             self.errors.append({"identifier" : record.get('identifier'), "error" : record.get("error")})
         elif record.get('queued', False) or bibjson is None:
             self.processing.append({"identifier" : record.get('identifier')})
+        elif record.get('stale', False):
+            # flag a copy, so the flag doesn't end up in the cache or the archive
+            stale = dict(bibjson)
+            stale["stale"] = True
+            self.results.append(stale)
         else:
             self.results.append(bibjson)
     
@@ -284,7 +345,49 @@ class ResultSet(object):
             "errors" :  self.errors,
             "processing" : self.processing
             }
-        return json.dumps(obj)
+        return codec.dumps(obj)
+    
+    def etag(self):
+        """
+        Get a strong entity tag for the JSON representation of this object, which is derived from
+        the canonical identifiers of the results and the provenance dates of their licences (so
+        it changes whenever a licence is re-checked), and the identifiers in error and processing.
+        It is cheap to compute, as nothing needs to be serialised
+        
+        returns the entity tag (unquoted)
+        
+        """
+        parts = ["requested:" + str(self.requested)]
+        for bibjson in self.results:
+            ids = [i.get("canonical", "") for i in bibjson.get("identifier", [])]
+            dates = [l.get("provenance", {}).get("date") or "" for l in bibjson.get("license", [])]
+            parts.append("result:" + ",".join(ids) + ":" + ",".join(dates) + (":stale" if bibjson.get("stale", False) else ""))
+        for error in self.errors:
+            identifier = error.get("identifier") or {}
+            parts.append("error:" + (identifier.get("canonical") or identifier.get("id") or "") + ":" + error.get("error", ""))
+        for processing in self.processing:
+            identifier = processing.get("identifier") or {}
+            parts.append("processing:" + (identifier.get("canonical") or identifier.get("id") or ""))
+        return hashlib.sha1(u"\n".join(parts).encode("utf-8")).hexdigest()
+    
+    def max_age(self):
+        """
+        Get the number of seconds for which this object may be cached by clients.  This is how long it
+        will be until the first of the results becomes stale (at most config.LOOKUP_MAX_AGE), or 0 if
+        any of the identifiers are still being processed, in error, or stale
+        
+        """
+        if len(self.processing) > 0 or len(self.errors) > 0 or len(self.results) == 0:
+            return 0
+        
+        now = time.time()
+        max_age = config.LOOKUP_MAX_AGE
+        for bibjson in self.results:
+            checked = cache.last_checked(bibjson)
+            if bibjson.get("stale", False) or checked is None:
+                return 0
+            max_age = min(max_age, int(checked + config.licence_stale_time - now))
+        return max(max_age, 0)
     
     def _get_bibjson(self, record):
         """
@@ -336,7 +439,7 @@ def flush_buffer():
         return False
     
     # check to see if we are already running a buffering process    
-    client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+    client = storage.redis_client(config.REDIS_BUFFER_HOST, config.REDIS_BUFFER_PORT, config.REDIS_BUFFER_DB)
     lock = client.get("flush_buffer_lock")
     if lock is not None:
         log.warn("flush_buffer ran before previous iteration had completed - consider increasing the gaps between the run times for this scheduled task")
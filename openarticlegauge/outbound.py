@@ -0,0 +1,284 @@
+"""
+Outbound HTTP requests, to the DOI resolver, publishers and the other services that plugins
+fetch from, with timeouts and circuit breakers.
+
+Every request is made with a timeout: the timeout for its host (config.HTTP_HOST_TIMEOUTS, or
+config.HTTP_TIMEOUT), cut down to what is left of the time budget of the plugin making it (see
+budget, and config.PLUGIN_TIME_BUDGETS).  So a slow host holds up a worker for at most one plugin's
+budget, rather than until the task hits its time limit.
+
+Each host has a circuit breaker, shared by all processes through the cache database.  It opens
+after config.BREAKER_FAILURES failures in a row - connection errors, timeouts, server errors, or
+responses slower than config.BREAKER_SLOW_RESPONSE seconds - and while it is open, no requests are
+made to the host: HostUnavailableException is raised instead, so that the record can be put off
+until later (see workflow).  After config.BREAKER_OPEN_TIME seconds the breaker is half-open:
+requests are made again, and the first success closes it, but a single failure opens it again.
+A host's failures are forgotten after config.BREAKER_OPEN_TIME seconds without another one.
+
+Redirects are followed here, rather than by requests, so that each host in a chain of redirects
+(e.g. from the DOI resolver to a publisher) is checked, and held responsible, for its own part.
+
+If the cache database can't be reached, requests are made without the breakers.
+
+"""
+
+from openarticlegauge import config, storage
+
+import requests, redis
+import threading, time, urlparse, logging
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# the hash in the cache database which holds the state of a host's breaker is BREAKER_PREFIX + host, and
+# the hosts which have one are kept in the BREAKERS_KEY set
+BREAKER_PREFIX = "breaker:"
+BREAKERS_KEY = "breakers"
+
+# the responses which are redirects, and the most redirects that will be followed for one request
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 30
+
+# record the outcome of a request to a host.  KEYS are the host's breaker and the set of hosts with breakers,
+# and ARGV the host, 1 if the request failed or 0 if not, the time now, config.BREAKER_FAILURES and
+# config.BREAKER_OPEN_TIME.  Returns the time until which the breaker is open, or 0 if it is not
+RECORD_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'failures', 'opened_until')
+local failures = tonumber(state[1]) or 0
+local opened_until = tonumber(state[2]) or 0
+local now = tonumber(ARGV[3])
+local open_time = tonumber(ARGV[5])
+if ARGV[2] == '0' then
+    -- a success closes the breaker, unless it has opened since the request was made
+    if opened_until > now then
+        return opened_until
+    end
+    if failures > 0 or opened_until > 0 then
+        redis.call('DEL', KEYS[1])
+        redis.call('SREM', KEYS[2], ARGV[1])
+    end
+    return 0
+end
+failures = failures + 1
+if opened_until <= now and (opened_until > 0 or failures >= tonumber(ARGV[4])) then
+    -- open the breaker, or if it was half-open, open it again
+    opened_until = now + open_time
+    redis.call('HSET', KEYS[1], 'opened_until', opened_until)
+end
+redis.call('HSET', KEYS[1], 'failures', failures)
+redis.call('EXPIRE', KEYS[1], math.max(opened_until - now, 0) + open_time)
+redis.call('SADD', KEYS[2], ARGV[1])
+if opened_until > now then
+    return opened_until
+end
+return 0
+"""
+
+# the deadline of the time budget of the plugin running in each thread, if any
+_budgets = threading.local()
+
+def get(url, **kwargs):
+    """
+    GET the url, as requests.get does, but with a timeout and through the breakers of the hosts
+    involved (see the module documentation).  Redirects are followed unless allow_redirects is False
+
+    arguments:
+    url -- the url to get
+    kwargs -- any other arguments to requests.get, except the timeout
+
+    returns:
+    the requests Response object for the last url in the chain of redirects
+
+    raises:
+    HostUnavailableException if the breaker of any host in the chain of redirects is open
+    BudgetExhaustedException (a requests Timeout) if the time budget of the running plugin has run out
+    requests.exceptions.RequestException as requests.get would
+
+    """
+    allow_redirects = kwargs.pop("allow_redirects", True)
+    cookies = requests.cookies.RequestsCookieJar()
+    cookies.update(kwargs.pop("cookies", None) or {})
+    history = []
+    for i in range(MAX_REDIRECTS + 1):
+        resp = _get(url, cookies=cookies, **kwargs)
+        if not allow_redirects or resp.status_code not in REDIRECT_CODES or "location" not in resp.headers:
+            break
+        # carry the cookies along the chain, as some publishers insist on them
+        for cookie in getattr(resp, "cookies", None) or []:
+            cookies.set_cookie(cookie)
+        history.append(resp)
+        url = urlparse.urljoin(url, resp.headers["location"])
+    else:
+        raise requests.exceptions.TooManyRedirects("exceeded " + str(MAX_REDIRECTS) + " redirects")
+    if len(history) > 0:
+        resp.history = history
+    return resp
+
+@contextmanager
+def budget(plugin_name):
+    """
+    run the enclosed code within the time budget of the plugin (see config.PLUGIN_TIME_BUDGETS): the
+    timeouts of requests made through get are cut down so that all of them together take no longer than
+    the budget, and once it has run out, they fail straight away.  Budgets may be nested, in which case
+    the inner one can only be shorter
+
+    arguments:
+    plugin_name -- the short name of the plugin
+
+    """
+    seconds = config.PLUGIN_TIME_BUDGETS.get(plugin_name, config.PLUGIN_TIME_BUDGET)
+    outer = getattr(_budgets, "deadline", None)
+    deadline = time.time() + seconds
+    if outer is not None:
+        deadline = min(deadline, outer)
+    _budgets.deadline = deadline
+    try:
+        yield
+    finally:
+        _budgets.deadline = outer
+
+def timeout(host):
+    """
+    the timeout for a request to the host now: the host's timeout (see config.HTTP_HOST_TIMEOUTS), or less
+    if the time budget of the running plugin (see budget) is about to run out
+
+    raises:
+    BudgetExhaustedException if the time budget of the running plugin has run out
+
+    """
+    seconds = _host_setting(config.HTTP_HOST_TIMEOUTS, host, config.HTTP_TIMEOUT)
+    deadline = getattr(_budgets, "deadline", None)
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise BudgetExhaustedException("the time budget for the plugin ran out before a request to " + host)
+        seconds = min(seconds, remaining)
+    return seconds
+
+def check(host):
+    """
+    check that the breaker for the host is not open
+
+    raises:
+    HostUnavailableException if the breaker is open
+
+    """
+    try:
+        opened_until = _client().hget(BREAKER_PREFIX + host, "opened_until")
+    except redis.RedisError as e:
+        log.warning("unable to check the breaker for " + host + ": " + str(e))
+        return
+    if opened_until is not None and int(opened_until) > time.time():
+        raise HostUnavailableException(host, int(opened_until) - time.time())
+
+def record(host, failed):
+    """
+    record the outcome of a request to the host in its breaker, which opens if there have been too many
+    failures in a row (see the module documentation)
+
+    arguments:
+    host -- the host
+    failed -- True if the request failed or was too slow, False if not
+
+    """
+    client = _client()
+    try:
+        opened_until = client.register_script(RECORD_SCRIPT)(
+            keys=[BREAKER_PREFIX + host, BREAKERS_KEY],
+            args=[host, 1 if failed else 0, int(time.time()), config.BREAKER_FAILURES, config.BREAKER_OPEN_TIME]
+        )
+    except redis.RedisError as e:
+        log.warning("unable to record the outcome of a request to " + host + " in its breaker: " + str(e))
+        return
+    if failed and opened_until > 0:
+        log.warning("the breaker for " + host + " is open, so no requests will be made to it until " + time.ctime(opened_until))
+
+def breakers():
+    """
+    get the state of the breakers of the hosts which have failed recently
+
+    returns:
+    a dictionary of host to its breaker: {"state" : "open", "half-open" or "closed", "failures" : <failures in a row>,
+        "retry_after" : <seconds until it is half-open, if it is open>}
+
+    """
+    client = _client()
+    hosts = sorted(client.smembers(BREAKERS_KEY))
+    pipe = client.pipeline(transaction=False)
+    for host in hosts:
+        pipe.hmget(BREAKER_PREFIX + host, "failures", "opened_until")
+    now = time.time()
+    states = {}
+    for host, (failures, opened_until) in zip(hosts, pipe.execute()):
+        if failures is None:
+            # its failures have been forgotten
+            client.srem(BREAKERS_KEY, host)
+            continue
+        opened_until = int(opened_until or 0)
+        state = {"failures" : int(failures), "state" : "closed"}
+        if opened_until > now:
+            state.update({"state" : "open", "retry_after" : int(opened_until - now)})
+        elif opened_until > 0:
+            state["state"] = "half-open"
+        states[host] = state
+    return states
+
+def host_of(url):
+    """
+    the host name of the url, in lower case
+
+    """
+    return (urlparse.urlparse(url).hostname or "").lower()
+
+def _get(url, **kwargs):
+    # a single request, without following redirects, through the breaker of its host
+    host = host_of(url)
+    check(host)
+    seconds = timeout(host)
+    started = time.time()
+    try:
+        resp = requests.get(url, timeout=seconds, allow_redirects=False, **kwargs)
+    except requests.exceptions.Timeout:
+        # a timeout cut short by the plugin's budget says nothing about the host
+        if seconds >= _host_setting(config.HTTP_HOST_TIMEOUTS, host, config.HTTP_TIMEOUT):
+            record(host, True)
+        raise
+    except requests.exceptions.ConnectionError:
+        record(host, True)
+        raise
+    record(host, resp.status_code >= 500 or time.time() - started > config.BREAKER_SLOW_RESPONSE)
+    return resp
+
+def _host_setting(settings, host, default):
+    # the setting for the host, or failing that for the nearest domain it is in (so "ncbi.nlm.nih.gov" covers
+    # "eutils.ncbi.nlm.nih.gov"), or the default
+    parts = host.split(".")
+    for i in range(len(parts)):
+        value = settings.get(".".join(parts[i:]))
+        if value is not None:
+            return value
+    return default
+
+def _client():
+    return storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+
+class HostUnavailableException(Exception):
+    """
+    Exception raised instead of making a request to a host whose breaker is open
+
+    """
+    def __init__(self, host, retry_after):
+        self.host = host
+        self.retry_after = retry_after
+        self.message = "the breaker for " + host + " is open, after too many failures"
+        super(HostUnavailableException, self).__init__(self, self.message)
+
+class BudgetExhaustedException(requests.exceptions.Timeout):
+    """
+    Exception raised instead of making a request once the time budget of the running plugin has run
+    out.  It is a requests Timeout, so it is dealt with as the request timing out would have been
+
+    """
+    def __init__(self, message):
+        self.message = message
+        super(BudgetExhaustedException, self).__init__(message)
@@ -3,15 +3,12 @@ Common infrastructure for the plugin framework
 
 """
 
-from openarticlegauge import config, plugloader, recordmanager
-from openarticlegauge.licenses import LICENSES
-from openarticlegauge import oa_policy
+from openarticlegauge import config, recordmanager, outbound, plugin_registry
+from openarticlegauge import license_registry
 
 import logging
-from copy import deepcopy
 from datetime import datetime
 
-import requests
 import string
 import re
 
@@ -37,11 +34,16 @@ class Plugin(object):
             "type_detect_verify" : True,
             "canonicalise" : ["<supported type>"],
             "detect_provider" : ["<supported type>"],
-            "license_detect" : True
+            "license_detect" : True,
+            "catch_all" : True
         }
         
         Omit any key for any feature that the plugin does not support, or set the
-        value of the key to False
+        value of the key to False.  "catch_all" is for licence detectors which support
+        any provider at all, and so are tried after all the others.
+        
+        Plugins which are not in the lists in config are registered for their capabilities
+        (see plugin_registry)
         
         """
         return {}
@@ -177,7 +179,7 @@ class Plugin(object):
         """
 
         # get content
-        r = requests.get(url)
+        r = outbound.get(url)
         # logging.debug('got content')
         content = self.normalise_string(r.content)
         
@@ -203,21 +205,6 @@ class Plugin(object):
                 # okay, statement found on the page -> get license type
                 lic_type = statement_mapping[statement]['type']
 
-                # license identified, now use that to construct the license object
-                license = deepcopy(LICENSES[lic_type])
-                license['open_access'] = oa_policy.oa_for_license(lic_type)
-                # set some defaults which have to be there, even if empty
-                license.setdefault('version','')
-                license.setdefault('description','')
-                license.setdefault('jurisdiction','') # TODO later (or later version of OAG!)
-                
-                # Copy over all information about the license from the license
-                # statement mapping. In essence, transfer the knowledge of the 
-                # publisher plugin authors to the license object.
-                # Consequence: Values coming from the publisher plugin overwrite
-                # values specified in the licenses module.
-                license.update(statement_mapping[statement])
-                
                 # add provenance information to the license object
                 provenance = {
                     'date': datetime.strftime(datetime.now(), config.date_format),
@@ -230,7 +217,13 @@ class Plugin(object):
                     'handler_version': self.__version__ # version of the plugin processing this record
                 }
 
-                license['provenance'] = provenance
+                # license identified, now use that to construct the license object.
+                # Copy over all information about the license from the license
+                # statement mapping. In essence, transfer the knowledge of the 
+                # publisher plugin authors to the license object.
+                # Consequence: Values coming from the publisher plugin overwrite
+                # values specified in the licenses module.
+                license = license_registry.build(lic_type, statement_mapping[statement], provenance)
 
                 record['bibjson'].setdefault('license', [])
                 record['bibjson']['license'].append(license)
@@ -306,6 +299,22 @@ class Plugin(object):
         )
 
 class PluginFactory(object):
+    """
+    Hands out the plugins for each job, from the current plugin registry (see plugin_registry).  Within
+    a task or request, the plugins all come from the registry that it started with
+    
+    """
+    
+    @classmethod
+    def handler_versions(cls):
+        """
+        Get the current version of each of the registered plugins, as recorded in the provenance
+        of the licences that they apply
+        
+        returns a dictionary of plugin short names (handlers) to their versions, which must not be changed
+        
+        """
+        return plugin_registry.current().handler_versions
     
     @classmethod
     def type_detect_verify(cls):
@@ -316,15 +325,7 @@ class PluginFactory(object):
             plugin.type_detect_verify method
         
         """
-        # FIXME: this should be updated to utilise the "capabilities" aspect of the plugin
-        plugins = []
-        for plugin_class in config.type_detection:
-            klazz = plugloader.load(plugin_class)
-            if klazz is None:
-                log.warn("unable to load plugin for detecting identifier type from " + str(plugin_class))
-                continue
-            plugins.append(klazz()) # append an instance of the class
-        return plugins
+        return [klazz() for klazz in plugin_registry.current().type_detection]
     
     @classmethod
     def canonicalise(cls, identifier_type):
@@ -334,11 +335,13 @@ class PluginFactory(object):
         arguments:
         identifier_type -- string representation of the identifier type (e.g. "doi" or "pmid")
         
-        returns a plugin object (instance, not class), which implements the plugin.canonicalise method
+        returns a plugin object (instance, not class), which implements the plugin.canonicalise method,
+            or None if there is no such plugin
         
         """
-        plugin_class = config.canonicalisers.get(identifier_type)
-        klazz = plugloader.load(plugin_class)
+        klazz = plugin_registry.current().canonicalisers.get(identifier_type)
+        if klazz is None:
+            return None
         return klazz() # return an instance of the class
     
     @classmethod
@@ -354,12 +357,8 @@ class PluginFactory(object):
             plugin.detect_provider method
         
         """
-        plugins = []
-        for plugin_class in config.provider_detection.get(identifier_type, []):
-            # all provider plugins run, until each plugin has had a go at determining provider information
-            klazz = plugloader.load(plugin_class)
-            plugins.append(klazz()) # append an instance of the class
-        return plugins
+        # all provider plugins run, until each plugin has had a go at determining provider information
+        return [klazz() for klazz in plugin_registry.current().provider_detection.get(identifier_type, ())]
     
     @classmethod
     def license_detect(cls, provider_record):
@@ -374,14 +373,11 @@ class PluginFactory(object):
         returns a plugin object (instance, not class) which implements the plugin.license_detect method
         
         """
-        for plugin_class in config.license_detection:
-            log.debug("checking " + plugin_class + " for support of provider " + str(provider_record))
-            klazz = plugloader.load(plugin_class)
-            if klazz is None:
-                continue
+        for klazz in plugin_registry.current().license_detection:
+            log.debug("checking " + str(klazz) + " for support of provider " + str(provider_record))
             inst = klazz()
             
             if inst.supports(provider_record):
-                log.debug(plugin_class + " (" + inst._short_name + " v" + inst.__version__ + ") services provider " + str(provider_record))
+                log.debug(str(klazz) + " (" + inst._short_name + " v" + inst.__version__ + ") services provider " + str(provider_record))
                 return inst
         return None
@@ -0,0 +1,382 @@
+"""
+The registry of plugins: which plugins detect the types of identifiers, canonicalise them, detect their
+providers and detect licences.  It is built once, and held as a snapshot which plugin.PluginFactory hands
+plugins out from.
+
+The plugins are those in the lists in config (type_detection, canonicalisers, provider_detection and
+license_detection), in the order given there, followed by any others which are discovered:
+
+- in the "openarticlegauge.plugins" entry point group of an installed package, or
+- in a module in one of config.PLUGIN_DIRECTORIES
+
+Discovered plugins are registered for whatever their capabilities() say they can do (see plugin.Plugin).
+Licence detectors which declare themselves a catch-all, supporting any provider, are tried after all the
+others.
+
+So a new publisher can be added by installing its plugin (or putting it in a plugin directory) and then
+bumping the registry version, without restarting anything.  Each web and worker process keeps its registry
+until it is asked to reload, either by a bump of the version (see bump), which every process hears about
+on a Redis channel, or by config.PLUGIN_RELOAD_SIGNAL being sent to the process.  A new registry is then
+built and swapped in at the start of the next task or request, while those already running carry on with
+the registry they started with (see pin).  Changes to the lists in config are picked up as well.
+
+"""
+
+"""
+Usage:
+
+1/ Have every running process reload its plugins:
+
+plugin_registry.py -b
+
+2/ List the plugins that would be registered now:
+
+plugin_registry.py -l
+
+Definition of options:
+
+-b - bump the registry version, so that every web and worker process reloads its plugins
+-l - list the plugins in a registry built now, by what they do
+
+"""
+
+from openarticlegauge import config, plugloader, storage
+
+import redis
+import os, sys, imp, glob, signal, inspect, threading, time, logging
+
+log = logging.getLogger(__name__)
+
+# the entry point group in which installed packages register plugins
+ENTRY_POINT_GROUP = "openarticlegauge.plugins"
+
+# the current version of the registry, in the cache database, and the channel on which bumps of it are published
+VERSION_KEY = "plugins:version"
+RELOAD_CHANNEL = "plugins:reload"
+
+class Registry(object):
+    """
+    A snapshot of the plugins, by what they do.  Plugins are held as classes, and are not to be changed
+    once the registry has been built: a reload builds a new registry instead
+
+    """
+    def __init__(self, version, type_detection, canonicalisers, provider_detection, license_detection):
+        self.version = version
+        self.type_detection = tuple(type_detection)
+        self.canonicalisers = canonicalisers
+        self.provider_detection = dict([(t, tuple(classes)) for t, classes in provider_detection.iteritems()])
+        self.license_detection = tuple(license_detection)
+        self.built = time.time()
+        self.fingerprint = _config_fingerprint()
+
+        classes = list(self.type_detection) + self.canonicalisers.values() + list(self.license_detection)
+        for classes_for_type in self.provider_detection.values():
+            classes += classes_for_type
+        self.handler_versions = dict([(k._short_name, k.__version__) for k in set(classes) if hasattr(k, "_short_name")])
+
+    def describe(self):
+        """
+        describe the registry, by the short names of the plugins
+
+        returns:
+        a dictionary of the version of the registry, when it was built, and the plugins for each job and their versions
+
+        """
+        name = lambda k: getattr(k, "_short_name", k.__name__)
+        return {
+            "version" : self.version,
+            "built" : self.built,
+            "type_detection" : [name(k) for k in self.type_detection],
+            "canonicalisers" : dict([(t, name(k)) for t, k in self.canonicalisers.iteritems()]),
+            "provider_detection" : dict([(t, [name(k) for k in classes]) for t, classes in self.provider_detection.iteritems()]),
+            "license_detection" : [name(k) for k in self.license_detection],
+            "handler_versions" : self.handler_versions
+        }
+
+def build(version=None):
+    """
+    build a new registry from the lists in config and the plugins that can be discovered (see the module
+    documentation)
+
+    arguments:
+    version -- the version of the new registry.  Defaults to the current version in the cache database
+
+    returns:
+    the registry
+
+    """
+    if version is None:
+        version = _stored_version()
+
+    type_detection = _load_all(config.type_detection)
+    canonicalisers = {}
+    for identifier_type, plugin_class in config.canonicalisers.iteritems():
+        klazz = _load(plugin_class)
+        if klazz is not None:
+            canonicalisers[identifier_type] = klazz
+    provider_detection = dict([(t, _load_all(classes)) for t, classes in config.provider_detection.iteritems()])
+    license_detection = _load_all(config.license_detection)
+
+    # the plugins in config do what config says, whatever their capabilities, and come first
+    known = set(type_detection + canonicalisers.values() + license_detection)
+    for classes in provider_detection.values():
+        known.update(classes)
+    for klazz in discover():
+        if klazz in known:
+            continue
+        known.add(klazz)
+        capabilities = _capabilities(klazz)
+        if capabilities.get("type_detect_verify"):
+            type_detection.append(klazz)
+        for identifier_type in capabilities.get("canonicalise") or []:
+            canonicalisers.setdefault(identifier_type, klazz)
+        for identifier_type in capabilities.get("detect_provider") or []:
+            provider_detection.setdefault(identifier_type, []).append(klazz)
+        if capabilities.get("license_detect"):
+            license_detection.append(klazz)
+
+    # catch-alls would support every provider, so must come last
+    license_detection = [k for k in license_detection if not _capabilities(k).get("catch_all")] + \
+                        [k for k in license_detection if _capabilities(k).get("catch_all")]
+
+    return Registry(version, type_detection, canonicalisers, provider_detection, license_detection)
+
+def discover():
+    """
+    find the plugin classes in the entry point group and in the plugin directories (see the module
+    documentation).  Plugins in the directories are loaded afresh each time, so changes to them are picked up
+
+    returns:
+    a list of plugin classes
+
+    """
+    classes = []
+    pkg_resources = _pkg_resources()
+    if pkg_resources is not None:
+        # a new working set, so that packages installed since startup are found
+        for entry_point in pkg_resources.WorkingSet().iter_entry_points(ENTRY_POINT_GROUP):
+            try:
+                classes += _plugin_classes(entry_point.load())
+            except Exception as e:
+                log.error("unable to load plugins from entry point " + str(entry_point) + ": " + str(e))
+
+    for i in range(len(config.PLUGIN_DIRECTORIES)):
+        for path in sorted(glob.glob(os.path.join(config.PLUGIN_DIRECTORIES[i], "*.py"))):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name.startswith("_"):
+                continue
+            try:
+                module = imp.load_source(_directory_package(i) + "." + name, path)
+            except Exception as e:
+                log.error("unable to load plugins from " + path + ": " + str(e))
+                continue
+            classes += _plugin_classes(module)
+    return classes
+
+def current():
+    """
+    get the current registry.  Within a task or request, this is the registry that it started with (see pin);
+    otherwise, if a reload has been asked for, or the lists in config have changed, a new registry is built
+    and swapped in first
+
+    """
+    pinned = getattr(_local, "registry", None)
+    if pinned is not None:
+        return pinned
+    registry = _registry
+    if registry is None or _stale(registry):
+        with _lock:
+            registry = _swap()
+    return registry
+
+def pin():
+    """
+    hold the current registry for the rest of the task or request running in this thread, so that it
+    carries on with the same plugins however many reloads there are.  Pins may be nested; each must be
+    matched by a call to unpin
+
+    """
+    depth = getattr(_local, "depth", 0)
+    if depth == 0:
+        _local.registry = current()
+    _local.depth = depth + 1
+
+def unpin():
+    """
+    let go of the registry held by pin, at the end of a task or request
+
+    """
+    depth = getattr(_local, "depth", 0) - 1
+    if depth <= 0:
+        _local.registry = None
+        depth = 0
+    _local.depth = depth
+
+def bump():
+    """
+    bump the registry version, so that every web and worker process reloads its plugins (see watch)
+
+    returns:
+    the new version
+
+    """
+    client = _client()
+    version = client.incr(VERSION_KEY)
+    client.publish(RELOAD_CHANNEL, version)
+    return version
+
+def watch():
+    """
+    start listening for requests to reload the plugins in this process: bumps of the registry version, and
+    config.PLUGIN_RELOAD_SIGNAL.  It only has to be called once in each process, though it does no harm to
+    call it again.  A process forked from one which was already watching has to call it for itself
+
+    """
+    global _watching
+    if _watching == os.getpid():
+        return
+    _watching = os.getpid()
+
+    signum = getattr(signal, config.PLUGIN_RELOAD_SIGNAL or "", None)
+    if signum is not None:
+        try:
+            signal.signal(signum, _signalled)
+        except ValueError:
+            # not the main thread, so the process is being run by something else which looks after signals
+            log.debug("unable to listen for " + config.PLUGIN_RELOAD_SIGNAL + " outside the main thread")
+    _ReloadListener().start()
+
+# the registry, the newest version that has been published, whether a reload has been signalled, and
+# the process (if any) which is watching for reloads
+_registry = None
+_published = 0
+_reload_signalled = False
+_watching = None
+_lock = threading.Lock()
+
+# the registry pinned by the task or request in each thread, and how deeply
+_local = threading.local()
+
+def _stale(registry):
+    return _reload_signalled or _published > registry.version or registry.fingerprint != _config_fingerprint()
+
+def _swap():
+    # called holding the lock, in case another thread has got there first
+    global _registry, _reload_signalled
+    registry = _registry
+    if registry is not None and not _stale(registry):
+        return registry
+    _reload_signalled = False
+    registry = build(max(_published, _stored_version()))
+    if _registry is not None:
+        log.info("reloaded the plugins, now at version " + str(registry.version))
+    _registry = registry
+    return registry
+
+def _signalled(signum, frame):
+    # only ask for the reload here; it is done at the start of the next task or request
+    global _reload_signalled
+    _reload_signalled = True
+
+def _config_fingerprint():
+    # enough to tell whether any of the lists in config which make up the registry have been changed.  This
+    # is checked on every use of the registry, so is kept cheap
+    lists = [config.type_detection, config.canonicalisers, config.provider_detection, config.license_detection,
+             config.module_search_list, config.PLUGIN_DIRECTORIES]
+    return tuple([(id(l), len(l)) for l in lists])
+
+def _stored_version():
+    try:
+        return int(_client().get(VERSION_KEY) or 0)
+    except redis.RedisError as e:
+        log.warning("unable to read the plugin registry version: " + str(e))
+        return _published
+
+def _directory_package(i):
+    # the modules in each plugin directory are loaded into a package of their own, so that they can't clash with
+    # any other module, and so that plugins which name themselves after their module (as the plugins which come
+    # with OAG do) get the right name
+    package = "_oag_plugin_directory" + str(i)
+    module = sys.modules.get(package)
+    if module is None:
+        module = sys.modules[package] = imp.new_module(package)
+    module.__path__ = [config.PLUGIN_DIRECTORIES[i]]
+    return package
+
+def _pkg_resources():
+    # imported only when it is needed, as it takes longer to import than most of the application
+    try:
+        import pkg_resources
+        return pkg_resources
+    except ImportError:
+        return None
+
+def _load(plugin_class):
+    klazz = plugloader.load(plugin_class)
+    if klazz is None:
+        log.warn("unable to load plugin " + str(plugin_class))
+    return klazz
+
+def _load_all(plugin_classes):
+    return [k for k in [_load(p) for p in plugin_classes] if k is not None]
+
+def _capabilities(klazz):
+    capabilities = getattr(klazz, "capabilities", None)
+    if capabilities is None:
+        return {}
+    try:
+        return klazz().capabilities() or {}
+    except Exception as e:
+        log.error("unable to get the capabilities of " + str(klazz) + ": " + str(e))
+        return {}
+
+def _plugin_classes(obj):
+    # the plugin classes in a module (those defined in it, not imported into it), or the class itself
+    if inspect.isclass(obj):
+        return [obj]
+    return [v for k, v in sorted(vars(obj).items())
+            if inspect.isclass(v) and v.__module__ == obj.__name__ and hasattr(v, "capabilities") and len(_capabilities(v)) > 0]
+
+def _client():
+    return storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+
+class _ReloadListener(threading.Thread):
+    """
+    Notes the newest registry version published on the reload channel (see bump).  If the connection to
+    Redis is lost, bumps may have been missed, so the stored version is read again when it is restored
+
+    """
+    def __init__(self):
+        super(_ReloadListener, self).__init__(name="plugin-reload-listener")
+        self.daemon = True
+
+    def run(self):
+        global _published
+        client = _client()
+        while True:
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(RELOAD_CHANNEL)
+                _published = max(_published, int(client.get(VERSION_KEY) or 0))
+                for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        _published = max(_published, int(message["data"]))
+            except Exception as e:
+                log.warning("lost the plugin reload channel: " + str(e))
+                time.sleep(1)
+
+if __name__ == "__main__":
+    import argparse, json
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--bump", help="bump the registry version, so that every process reloads its plugins", action="store_true")
+    parser.add_argument("-l", "--list", help="list the plugins in a registry built now", action="store_true")
+    args = parser.parse_args()
+
+    if not args.bump and not args.list:
+        parser.print_help()
+        exit()
+
+    if args.bump:
+        print "plugin registry is now at version " + str(bump())
+    if args.list:
+        print json.dumps(build().describe(), indent=2, sort_keys=True)
@@ -9,6 +9,11 @@ class BMCPlugin(plugin.Plugin):
     
     ## Plugin parent class overrides ##
     
+    def capabilities(self):
+        return {
+            "license_detect" : True
+        }
+    
     def supports(self, provider):
         """
         Does the page_license plugin support this provider
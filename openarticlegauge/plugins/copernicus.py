@@ -29,6 +29,11 @@ class COPERNICUSPlugin(plugin.Plugin):
     
     
     
+    def capabilities(self):
+        return {
+            "license_detect" : True
+        }
+    
     def supports(self, provider):
         """
         Does this plugin support this provider
@@ -1,5 +1,5 @@
-import re, requests
-from openarticlegauge import plugin, recordmanager, model_exceptions
+import re
+from openarticlegauge import plugin, recordmanager, model_exceptions, outbound
 
 class DOIPlugin(plugin.Plugin):
     _short_name = __name__.split('.')[-1]
@@ -145,7 +145,12 @@ class DOIPlugin(plugin.Plugin):
         resolvable = "http://dx.doi.org/" + canonical[4:]
         
         # now dereference it and find out the target of the (chain of) 303(s)
-        response = requests.get(resolvable)
+        response = outbound.get(resolvable)
+        
+        # the resolver does not know this DOI, so it has no location (rather than
+        # the location of the resolver's error page)
+        if response.status_code == 404:
+            return None
         return response.url
 
 
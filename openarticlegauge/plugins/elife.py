@@ -1,9 +1,7 @@
-from openarticlegauge import plugin, config
-from openarticlegauge.licenses import LICENSES
-from openarticlegauge import oa_policy
-import requests, logging
+from openarticlegauge import plugin, config, outbound
+from openarticlegauge import license_registry
+import logging
 from lxml import etree
-from copy import deepcopy
 from datetime import datetime
 
 log = logging.getLogger(__name__)
@@ -15,6 +13,11 @@ class ELifePlugin(plugin.Plugin):
     
     base_urls = ["elife.elifesciences.org"]
     
+    def capabilities(self):
+        return {
+            "license_detect" : True
+        }
+    
     def supports(self, provider):
         """
         Does the license_detect plugin support this provider
@@ -63,7 +66,7 @@ class ELifePlugin(plugin.Plugin):
         if doi:
         # 2. query elife XML api
             url = 'http://elife.elifesciences.org/elife-source-xml/' + doi
-            response = requests.get(url)
+            response = outbound.get(url)
 
             try:
                 xml = etree.fromstring(response.text.decode("utf-8"))
@@ -82,21 +85,6 @@ class ELifePlugin(plugin.Plugin):
                 if len(elements) > 0:
                     lic_type = meaning['type']
         
-                    # license identified, now use that to construct the license object
-                    license = deepcopy(LICENSES[lic_type])
-                    license['open_access'] = oa_policy.oa_for_license(lic_type)
-                    # set some defaults which have to be there, even if empty
-                    license.setdefault('version','')
-                    license.setdefault('description','')
-                    license.setdefault('jurisdiction','') # TODO later (or later version of OAG!)
-        
-                    # Copy over all information about the license from the license
-                    # statement mapping. In essence, transfer the knowledge of the 
-                    # publisher plugin authors to the license object.
-                    # Consequence: Values coming from the publisher plugin overwrite
-                    # values specified in the licenses module.
-                    license.update(meaning)
-        
                     # add provenance information to the license object
                     provenance = {
                         'handler': self._short_name,
@@ -109,7 +97,10 @@ class ELifePlugin(plugin.Plugin):
                         'description': 'License decided by querying the eLife XML API at ' + url
                     }
         
-                    license['provenance'] = provenance
+                    # license identified, now use that to construct the license object.
+                    # Values coming from the publisher plugin overwrite values specified
+                    # in the licenses module.
+                    license = license_registry.build(lic_type, meaning, provenance)
         
                     record['bibjson'].setdefault('license', [])
                     record['bibjson']['license'].append(license)
@@ -28,6 +28,13 @@ class Tutorial(plugin.Plugin):
     # so if the http://www.biomedcentral.com/1471-2164/13/425 URL comes in,
     # it should be supported.
     
+    ## Say what the plugin can do, so that it can be registered without being
+    ## listed in config.py (see plugin_registry.py) - this one detects licences
+    def capabilities(self):
+        return {
+            "license_detect" : True
+        }
+    
     ## You can keep the supports() function as it is if your publisher only has
     ## a few domain names and doesn't need anything more special than
     ## "Does this URL start with this domain name?"
@@ -16,6 +16,11 @@ class NaturePlugin(plugin.Plugin):
     # so if the http://www.nature.com/ncomms/journal/v1/n1/full/ncomms1007.html URL comes in,
     # it should be supported.
     
+    def capabilities(self):
+        return {
+            "license_detect" : True
+        }
+    
     def supports(self, provider):
         """
         Does this plugin support this provider
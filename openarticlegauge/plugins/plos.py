@@ -10,6 +10,11 @@ class PLOSPlugin(plugin.Plugin):
                  "www.plosntds.org"]
     
     
+    def capabilities(self):
+        return {
+            "license_detect" : True
+        }
+    
     def supports(self, provider):
         """
         Does the page_license plugin support this provider
@@ -1,5 +1,5 @@
-import re, logging, requests
-from openarticlegauge import plugin, recordmanager, model_exceptions
+import re, logging
+from openarticlegauge import plugin, recordmanager, model_exceptions, outbound
 from lxml import etree
 from openarticlegauge.plugins.doi import DOIPlugin
 from bs4 import BeautifulSoup
@@ -12,6 +12,14 @@ class PMIDPlugin(plugin.Plugin):
     
     _rx = "^[\d]{1,8}$"
     
+    def capabilities(self):
+        return {
+            "type_detect_verify" : True,
+            "canonicalise" : ["pmid"],
+            "detect_provider" : ["pmid"],
+            "license_detect" : False
+        }
+    
     def type_detect_verify(self, bibjson_identifier):
         """
         determine if the provided bibjson identifier has a type of "PMID", by
@@ -111,7 +119,7 @@ class PMIDPlugin(plugin.Plugin):
         return a list of urls which might be a suitable provider from the NCBI page
         """
         ncbi_url = "http://www.ncbi.nlm.nih.gov/pubmed/" + canonical_pmid[5:]
-        resp = requests.get(ncbi_url)
+        resp = outbound.get(ncbi_url)
         if resp.status_code != 200:
             return []
         
@@ -141,7 +149,7 @@ class PMIDPlugin(plugin.Plugin):
         xml_url = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=" + canonical_pmid[5:] + "&retmode=xml"
         
         # now dereference it and find out the target of the (chain of) 303(s)
-        response = requests.get(xml_url)
+        response = outbound.get(xml_url)
         try:
             xml = etree.fromstring(response.text.encode("utf-8"))
         except:
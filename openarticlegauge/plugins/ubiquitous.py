@@ -10,6 +10,12 @@ class UbiquitousPlugin(plugin.Plugin):
     _short_name = __name__.split('.')[-1]
     __version__='0.1' 
     
+    def capabilities(self):
+        return {
+            "license_detect" : True,
+            "catch_all" : True
+        }
+    
     def supports(self, provider):
         """
         Does this plugin support this provider
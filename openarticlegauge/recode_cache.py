@@ -0,0 +1,243 @@
+""" rewriting of cache entries into a new encoding, and reporting on the memory that would save """
+
+"""
+Usage:
+
+1/ Report on the encodings currently in use in the cache, and how big a sample of entries
+would be in each of the available encodings:
+
+recode_cache.py -s
+
+2/ Rewrite all entries in the cache into the encoding configured in config.CACHE_ENCODING
+
+recode_cache.py -r
+
+3/ Rewrite all entries in the cache into a specific encoding
+
+recode_cache.py -r -e msgpack+zlib
+
+4/ See what a rewrite would do, without changing anything
+
+recode_cache.py -r -e json+zlib -d
+
+Definition of options:
+
+-s - report statistics on a sample of the cache (required if -r is not specified)
+-r - rewrite the cache (required if -s is not specified)
+-e - the encoding to rewrite into (optional).  If omitted, config.CACHE_ENCODING is used
+-d - dry run; report what would be rewritten, but do not change anything
+-n - the number of entries to sample with -s (default 1000)
+
+Entries are rewritten in place, preserving their remaining time to live, and only if they have
+not been changed in the meantime.  Anything in the cache which is not a cached record (i.e. does
+not decode to an object) is left alone.
+
+"""
+from openarticlegauge import config, cache, storage
+
+SCAN_BATCH_SIZE = 500
+
+# replace the value at KEYS[1] with ARGV[2] only if it is still ARGV[1], keeping its time to live
+REWRITE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl > 0 then
+    redis.call('SET', KEYS[1], ARGV[2], 'PX', ttl)
+else
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+def recode(encoding=None, dry_run=False, reporter=None):
+    """
+    Rewrite every record in the cache into the supplied encoding
+
+    arguments:
+    encoding -- the name of the encoding to rewrite into (see cache.ENCODINGS).  Defaults to config.CACHE_ENCODING
+    dry_run -- if True, report on what would be done but do not write anything to the cache
+    reporter -- a callback function which can be used to report on the progress of this method.  Used for command line or logging integration
+
+    returns:
+    a dictionary of statistics about the operation: the number of entries examined, rewritten and skipped,
+        and the total size of the rewritten entries before and after
+
+    """
+    if reporter is None:
+        reporter = lambda x: None
+    if encoding is None:
+        encoding = config.CACHE_ENCODING
+
+    # check the encoding is usable before we start
+    cache.encode({}, encoding)
+
+    reporter("rewriting cache entries into encoding '" + encoding + "'" + (" (dry run)" if dry_run else ""))
+
+    client = _client()
+    rewrite = client.register_script(REWRITE_SCRIPT)
+    stats = {"examined" : 0, "rewritten" : 0, "skipped" : 0, "changed_meanwhile" : 0, "bytes_before" : 0, "bytes_after" : 0}
+
+    for keys, values in _batches(client):
+        for key, s in zip(keys, values):
+            stats["examined"] += 1
+            obj = _decode_record(s)
+            if obj is None or cache.encoding_of(s) == encoding:
+                stats["skipped"] += 1
+                continue
+
+            new_s = cache.encode(obj, encoding)
+            if not dry_run and not rewrite(keys=[key], args=[s, new_s]):
+                stats["changed_meanwhile"] += 1
+                continue
+
+            stats["rewritten"] += 1
+            stats["bytes_before"] += len(s)
+            stats["bytes_after"] += len(new_s)
+
+        reporter("examined " + str(stats["examined"]) + " keys, rewritten " + str(stats["rewritten"]))
+
+    reporter(_summary(stats))
+    return stats
+
+def sample_stats(sample_size=1000, reporter=None):
+    """
+    Report on the encodings in use in the cache, and estimate the memory that each of the
+    available encodings would use, based on a sample of the cached records
+
+    arguments:
+    sample_size -- the maximum number of cached records to sample
+    reporter -- a callback function which can be used to report on the progress of this method.  Used for command line or logging integration
+
+    returns:
+    a dictionary with the number of records sampled, the count of each encoding currently
+        in use in the sample, and the total size the sample would have in each available encoding
+
+    """
+    if reporter is None:
+        reporter = lambda x: None
+
+    client = _client()
+    in_use = {}
+    current_bytes = 0
+    sizes = dict([(e, 0) for e in available_encodings()])
+    sampled = 0
+
+    for keys, values in _batches(client):
+        for s in values:
+            obj = _decode_record(s)
+            if obj is None:
+                continue
+            enc = cache.encoding_of(s)
+            in_use[enc] = in_use.get(enc, 0) + 1
+            current_bytes += len(s)
+            for e in sizes.keys():
+                sizes[e] += len(cache.encode(obj, e))
+            sampled += 1
+            if sampled >= sample_size:
+                break
+        if sampled >= sample_size:
+            break
+
+    reporter("total keys in cache: " + str(client.dbsize()))
+    reporter("records sampled: " + str(sampled))
+    for enc, count in in_use.iteritems():
+        reporter("currently encoded as " + enc + ": " + str(count))
+    reporter("current size of sample: " + str(current_bytes) + " bytes")
+    for e in sorted(sizes.keys()):
+        reporter(_saving_line(e, current_bytes, sizes[e]))
+
+    return {"sampled" : sampled, "in_use" : in_use, "current_bytes" : current_bytes, "sizes" : sizes}
+
+def available_encodings():
+    """
+    List the cache encodings which can be used in this environment (some require optional libraries)
+
+    """
+    available = []
+    for e in cache.ENCODINGS.keys():
+        try:
+            cache.encode({}, e)
+            available.append(e)
+        except cache.CacheException:
+            continue
+    return available
+
+def _client():
+    return storage.redis_client(config.REDIS_CACHE_HOST, config.REDIS_CACHE_PORT, config.REDIS_CACHE_DB)
+
+def _batches(client):
+    """
+    Iterate over the whole cache in batches, yielding the keys and their values.  Values
+    which are not strings (i.e. not cache entries) are yielded as None
+
+    """
+    keys = []
+    for key in client.scan_iter(count=SCAN_BATCH_SIZE):
+        keys.append(key)
+        if len(keys) >= SCAN_BATCH_SIZE:
+            yield keys, _get_all(client, keys)
+            keys = []
+    if len(keys) > 0:
+        yield keys, _get_all(client, keys)
+
+def _get_all(client, keys):
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
+    return [v if isinstance(v, basestring) else None for v in pipe.execute(raise_on_error=False)]
+
+def _decode_record(s):
+    """
+    decode the cache entry, returning None if it is not a readable cached record
+
+    """
+    if s is None:
+        return None
+    try:
+        obj = cache.decode(s)
+    except ValueError:
+        return None
+    if not isinstance(obj, dict):
+        return None
+    return obj
+
+def _saving_line(encoding, before, after):
+    saving = 100.0 * (before - after) / before if before > 0 else 0.0
+    return encoding + ": " + str(after) + " bytes (" + ("%.1f" % saving) + "% saving)"
+
+def _summary(stats):
+    return ("examined " + str(stats["examined"]) + ", rewrote " + str(stats["rewritten"]) +
+            ", skipped " + str(stats["skipped"]) + ", changed during rewrite " + str(stats["changed_meanwhile"]) +
+            "; " + _saving_line("rewritten entries", stats["bytes_before"], stats["bytes_after"]))
+
+def stdout_reporter(msg):
+    print msg
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-s", "--stats", help="report on the encodings in use and the memory each available encoding would use.  Must be present if -r is not specified", action="store_true")
+    parser.add_argument("-r", "--rewrite", help="rewrite the cache entries into the new encoding.  Must be present if -s is not specified", action="store_true")
+    parser.add_argument("-e", "--encoding", help="the encoding to rewrite into.  If omitted, config.CACHE_ENCODING is used")
+    parser.add_argument("-d", "--dry-run", help="report what a rewrite would do, without changing anything", action="store_true")
+    parser.add_argument("-n", "--sample", help="the number of records to sample with -s", type=int, default=1000)
+
+    args = parser.parse_args()
+
+    if args.stats and args.rewrite:
+        print "Cannot specify -s and -r in the same command"
+        exit()
+
+    if not args.stats and not args.rewrite:
+        print "Must specify either -s or -r"
+        exit()
+
+    if args.encoding is not None and args.encoding not in cache.ENCODINGS:
+        print "Unknown encoding " + args.encoding + "; must be one of " + ", ".join(cache.ENCODINGS.keys())
+        exit()
+
+    if args.stats:
+        sample_stats(args.sample, stdout_reporter)
+    else:
+        recode(args.encoding, args.dry_run, stdout_reporter)
@@ -11,6 +11,7 @@ future (if at all - the python data structure has some utility that a class migh
 
 from openarticlegauge import config
 from datetime import datetime
+import time
 
 def record_provider_url(record, url):
     """
@@ -76,7 +77,7 @@ def add_license(record,
                 provenance_description="",
                 agent=config.agent,
                 source="",
-                date=datetime.strftime(datetime.now(), config.date_format),
+                date=None,
                 handler="",
                 handler_version=""):
     """
@@ -108,11 +109,16 @@ def add_license(record,
         }
     }
     
+    The record's bibjson['last_checked'] timestamp is brought up to date with the
+    date of the new licence (see set_last_checked).
+    
     keyword_arguments:
     see the top level documentation for details on the meaning of each field - they map consistently to the parts
-    of the licence record
+    of the licence record.  If no date is supplied, the current time is used
     
     """
+    if date is None:
+        date = datetime.strftime(datetime.now(), config.date_format)
     
     if "bibjson" not in record:
         record["bibjson"] = {}
@@ -146,3 +152,97 @@ def add_license(record,
         }
     )
     
+    epoch = date_to_epoch(date)
+    if epoch is not None and epoch > record['bibjson'].get("last_checked", 0):
+        set_last_checked(record, epoch)
+
+def set_last_checked(record, epoch=None):
+    """
+    Record the time at which the licence of this record was last checked, as an integer
+    number of seconds since the epoch in record['bibjson']['last_checked'].  This is what
+    the stale check in the cache uses, so that it does not have to look at every licence.
+    
+    arguments:
+    record -- OAG record object; see top-level documentation for details on its structure
+    epoch -- the time of the check in seconds since the epoch.  If omitted, the current time is used
+    
+    """
+    if epoch is None:
+        epoch = time.time()
+    if "bibjson" not in record:
+        record["bibjson"] = {}
+    record["bibjson"]["last_checked"] = int(epoch)
+
+def compute_last_checked(bibjson):
+    """
+    Work out when the licence of a bibjson record was last checked from the dates in
+    its licences' provenance.  This is the fallback for records which were stored before
+    bibjson['last_checked'] was maintained.
+    
+    arguments:
+    bibjson -- a bibjson record, with zero or more licences
+    
+    returns:
+    the most recent licence date as an integer number of seconds since the epoch, or None
+        if there are no licences with a valid date
+    
+    """
+    epochs = [date_to_epoch(licence.get("provenance", {}).get("date")) for licence in bibjson.get("license", [])]
+    epochs = [e for e in epochs if e is not None]
+    if len(epochs) == 0:
+        return None
+    return max(epochs)
+
+def latest_license(bibjson):
+    """
+    Get the most recently applied licence of a bibjson record, according to the dates in
+    the licences' provenance.  If more than one has the latest date (or none have a valid
+    date), the one added last wins.
+    
+    arguments:
+    bibjson -- a bibjson record, with zero or more licences
+    
+    returns:
+    the licence, or None if the record has no licences
+    
+    """
+    licences = bibjson.get("license", [])
+    if len(licences) == 0:
+        return None
+    return max(reversed(licences), key=lambda licence: date_to_epoch(licence.get("provenance", {}).get("date")) or 0)
+
+def epoch_to_date(epoch):
+    """
+    Convert a number of seconds since the epoch to a date string in the configured date
+    format (config.date_format), in local time, as dates are generated throughout the system.
+    This is the reverse of date_to_epoch
+    
+    arguments:
+    epoch -- the number of seconds since the epoch
+    
+    returns:
+    the date string
+    
+    """
+    return datetime.strftime(datetime.fromtimestamp(epoch), config.date_format)
+
+def date_to_epoch(date_string):
+    """
+    Convert a date string in the configured date format (config.date_format) to an
+    integer number of seconds since the epoch.  Dates are generated in local time
+    throughout the system, so they are interpreted as such.
+    
+    arguments:
+    date_string -- the date string
+    
+    returns:
+    the number of seconds since the epoch, or None if the date string is missing or invalid
+    
+    """
+    if date_string is None:
+        return None
+    try:
+        dt = datetime.strptime(date_string, config.date_format)
+    except (ValueError, TypeError):
+        return None
+    return int(time.mktime(dt.timetuple()))
@@ -0,0 +1,38 @@
+"""
+The application settings, as the web application sees them: everything in config.py, overridden by
+anything in the optional app.cfg file at the root of the repository.
+
+These are available without building the web application, so that the parts of the system which
+don't need it (the Celery workers, the command line tools) can start quickly, and without side
+effects such as setting up the index.  See storage.py for the clients for the storage back ends.
+
+"""
+
+import os
+from openarticlegauge import config
+
+def load(config_path=None):
+    """
+    Load the settings
+
+    arguments:
+    config_path -- the path to a python file of settings to override those in config.py.  Defaults to
+        app.cfg at the root of the repository, if there is one
+
+    returns:
+    a dictionary of the settings, which (as with Flask's configuration) are those whose names are upper case
+
+    """
+    settings = dict([(k, getattr(config, k)) for k in dir(config) if k.isupper()])
+
+    if config_path is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        config_path = os.path.join(os.path.dirname(here), 'app.cfg')
+    if os.path.exists(config_path):
+        overrides = {'__file__' : config_path}
+        execfile(config_path, overrides)
+        settings.update(dict([(k, v) for k, v in overrides.iteritems() if k.isupper()]))
+
+    return settings
+
+SETTINGS = load()
@@ -11,7 +11,11 @@ from celery import Celery
 
 celery = Celery()
 
-from openarticlegauge import celeryconfig
+from openarticlegauge import celeryconfig, codec
+
+# tasks and results are serialised with the OAG codec (see celeryconfig), so it
+# needs to be known to kombu before any messages are sent or received
+codec.register_celery_serializer()
 
 celery.config_from_object(celeryconfig)
 
@@ -0,0 +1,193 @@
+"""
+Licence statistics, kept up to date as records are stored, so that questions such as "how many PLOS
+records are CC-BY" can be answered without aggregating over the whole archive.
+
+Each record is counted once, by its most recent licence, in each of these dimensions:
+
+total -- all records
+type -- the licence type, e.g. "cc-by" or "failed-to-obtain-license"
+open_access -- "true" or "false"
+handler -- the plugin which applied the licence
+handler_version -- the plugin and its version, as "<handler>@<version>"
+handler_type -- the plugin and the licence type, as "<handler>|<type>"
+host -- the host of the provider page the licence was found on
+host_type -- the host and the licence type, as "<host>|<type>"
+day -- the day on which the licence was applied, as "YYYY-MM-DD"
+
+The counts are held in a Redis hash, under fields "<dimension>:<value>".  Alongside them is a hash of
+the fields each record is currently counted under, so that when a record is stored again (e.g. when
+it is refreshed) its old counts can be taken away before the new ones are added.  store_results in
+the workflow calls count for each record it stores, and the reconcile task periodically recounts
+everything from the archive, in case anything has drifted.
+
+"""
+
+import time, logging, urlparse
+from openarticlegauge import config, models, recordmanager, storage
+from openarticlegauge.slavedriver import celery
+
+log = logging.getLogger(__name__)
+
+COUNTS_KEY = "stats:counts"
+RECORDS_KEY = "stats:records"
+RECONCILED_KEY = "stats:reconciled"
+
+# the keys the reconcile task builds the new counts in, before swapping them in
+REBUILD_SUFFIX = ":rebuild"
+
+# how many records to count per round trip when reconciling
+RECONCILE_BATCH_SIZE = 500
+
+# replace the fields that the record ARGV[1] is counted under in the counts hash KEYS[1] with the
+# newline separated list of fields in ARGV[2], remembering them in the records hash KEYS[2]
+COUNT_SCRIPT = """
+local old = redis.call('HGET', KEYS[2], ARGV[1])
+if old == ARGV[2] then return 0 end
+if old then
+    for field in string.gmatch(old, '[^\\n]+') do
+        if redis.call('HINCRBY', KEYS[1], field, -1) <= 0 then redis.call('HDEL', KEYS[1], field) end
+    end
+end
+for field in string.gmatch(ARGV[2], '[^\\n]+') do
+    redis.call('HINCRBY', KEYS[1], field, 1)
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""
+
+def count(bibjson):
+    """
+    Count the bibjson record in the statistics, replacing whatever it was counted as before
+
+    arguments:
+    bibjson -- the bibjson record, as stored in the archive (i.e. with an "id")
+
+    """
+    if bibjson.get("id") is None:
+        return
+    client = _client()
+    client.register_script(COUNT_SCRIPT)(keys=[COUNTS_KEY, RECORDS_KEY], args=[bibjson["id"], "\n".join(fields(bibjson))])
+
+def fields(bibjson):
+    """
+    Get the fields which the bibjson record is counted under (see the module documentation)
+
+    arguments:
+    bibjson -- the bibjson record
+
+    returns:
+    a list of fields, which is empty if the record has no licence
+
+    """
+    licence = recordmanager.latest_license(bibjson)
+    if licence is None:
+        return []
+
+    provenance = licence.get("provenance", {})
+    licence_type = licence.get("type") or "unknown"
+    handler = provenance.get("handler") or "unknown"
+    host = urlparse.urlparse(provenance.get("source") or "").netloc or "unknown"
+
+    f = [
+        "total",
+        "type:" + licence_type,
+        "open_access:" + ("true" if licence.get("open_access") else "false"),
+        "handler:" + handler,
+        "handler_version:" + handler + "@" + (provenance.get("handler_version") or "unknown"),
+        "handler_type:" + handler + "|" + licence_type,
+        "host:" + host,
+        "host_type:" + host + "|" + licence_type
+    ]
+    epoch = recordmanager.date_to_epoch(provenance.get("date"))
+    if epoch is not None:
+        f.append("day:" + time.strftime("%Y-%m-%d", time.localtime(epoch)))
+    return f
+
+def summary():
+    """
+    Get all the statistics
+
+    returns:
+    a dictionary with the total number of records counted, the time of the last reconcile (seconds
+        since the epoch, or None), and the counts in each of the other dimensions.  The counts for
+        handler_version, handler_type and host_type are nested, e.g. {"plos" : {"cc-by" : 10}}
+
+    """
+    client = _client()
+    pipe = client.pipeline()
+    pipe.hgetall(COUNTS_KEY)
+    pipe.get(RECONCILED_KEY)
+    counts, reconciled = pipe.execute()
+
+    result = {"total" : 0, "reconciled" : int(reconciled) if reconciled is not None else None}
+    for dimension in ["type", "open_access", "handler", "handler_version", "handler_type", "host", "host_type", "day"]:
+        result[dimension] = {}
+
+    for field, n in counts.iteritems():
+        n = int(n)
+        if field == "total":
+            result["total"] = n
+            continue
+        dimension, value = field.split(":", 1)
+        if dimension not in result:
+            continue
+        separator = "@" if dimension == "handler_version" else "|" if dimension.endswith("_type") else None
+        if separator is None:
+            result[dimension][value] = n
+        else:
+            outer, inner = value.rsplit(separator, 1)
+            result[dimension].setdefault(outer, {})[inner] = n
+    return result
+
+@celery.task(name="openarticlegauge.stats.reconcile")
+def reconcile():
+    """
+    Celery task which recounts the statistics from scratch, from every record in the archive and the
+    storage buffer, and swaps the new counts in.  This should be promoted onto a processing queue by
+    Celery Beat (see the celeryconfig).
+
+    Records stored while the recount is running may be left out of the new counts until the next one.
+
+    returns:
+    the number of records counted
+
+    """
+    client = _client()
+    counts_key = COUNTS_KEY + REBUILD_SUFFIX
+    records_key = RECORDS_KEY + REBUILD_SUFFIX
+    client.delete(counts_key, records_key)
+    script = client.register_script(COUNT_SCRIPT)
+
+    counted = 0
+    pipe = client.pipeline(transaction=False)
+    for bibjson in _all_records():
+        if bibjson.get("id") is None:
+            continue
+        script(keys=[counts_key, records_key], args=[bibjson["id"], "\n".join(fields(bibjson))], client=pipe)
+        counted += 1
+        if counted % RECONCILE_BATCH_SIZE == 0:
+            pipe.execute()
+    pipe.execute()
+
+    pipe = client.pipeline()
+    if counted > 0:
+        pipe.rename(counts_key, COUNTS_KEY)
+        pipe.rename(records_key, RECORDS_KEY)
+    else:
+        pipe.delete(COUNTS_KEY, RECORDS_KEY)
+    pipe.set(RECONCILED_KEY, int(time.time()))
+    pipe.execute()
+
+    log.info("reconciled licence statistics over " + str(counted) + " records")
+    return counted
+
+def _all_records():
+    # everything in the archive, then anything newer waiting in the storage buffer
+    for bibjson in models.Record.scroll():
+        yield bibjson
+    if config.BUFFERING:
+        for bibjson in models.Record.buffered():
+            yield bibjson
+
+def _client():
+    return storage.redis_client(config.REDIS_STATS_HOST, config.REDIS_STATS_PORT, config.REDIS_STATS_DB)
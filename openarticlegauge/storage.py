@@ -0,0 +1,44 @@
+"""
+Clients for the storage back ends, Redis and Elasticsearch.  These need only the settings, not the web
+application, so can be used anywhere.
+
+Redis connections are pooled: all the clients for the same host, port and database in a process share
+one pool, rather than each opening connections of its own.  The pools are safe to use after a fork (e.g.
+in Celery's worker processes), as redis-py starts a new pool in the child.
+
+"""
+
+import redis, threading
+from openarticlegauge.settings import SETTINGS
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def redis_client(host, port, db):
+    """
+    Get a client for the given Redis database, using the shared connection pool for it
+
+    """
+    key = (host, port, db)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = redis.ConnectionPool(host=host, port=port, db=db)
+                _pools[key] = pool
+    return redis.StrictRedis(connection_pool=pool)
+
+def es_host():
+    """
+    Get the base url of the Elasticsearch server, with no trailing slash
+
+    """
+    return 'http://' + SETTINGS['ELASTIC_SEARCH_HOST'].lstrip('http://').rstrip('/')
+
+def es_index():
+    """
+    Get the base url of the application's Elasticsearch index, with no trailing slash
+
+    """
+    return es_host() + '/' + SETTINGS['ELASTIC_SEARCH_DB']
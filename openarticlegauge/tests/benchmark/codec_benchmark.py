@@ -0,0 +1,125 @@
+"""
+Benchmark the JSON codecs available in this environment at each of the hops that an
+OAG record makes through the system:
+
+cache   -- a full OAG record, encoded into and decoded out of the redis cache
+buffer  -- a bibjson record, encoded into and decoded out of the storage buffer
+broker  -- a Celery task message carrying an OAG record
+api     -- a ResultSet of 100 results, encoded for the API response
+bulk    -- an Elasticsearch bulk request body of 1000 bibjson records
+pull    -- an Elasticsearch GET response, decoded from the archive
+
+Run from the repository root with
+
+    python openarticlegauge/tests/benchmark/codec_benchmark.py
+
+"""
+
+import timeit
+from copy import deepcopy
+from datetime import datetime
+
+from openarticlegauge import codec, config
+from openarticlegauge.licenses import LICENSES
+
+ITERATIONS = 200
+
+def make_bibjson(n):
+    doi = "10.1371/journal.pone.%07d" % n
+    url = "http://www.plosone.org/article/info%3Adoi%2F" + doi.replace("/", "%2F")
+    licence = deepcopy(LICENSES["cc-by"])
+    licence.update({
+        "open_access" : True,
+        "version" : "",
+        "description" : "",
+        "jurisdiction" : "",
+        "provenance" : {
+            "date" : datetime.strftime(datetime.now(), config.date_format),
+            "source" : url,
+            "agent" : config.agent,
+            "category" : "page_scrape",
+            "description" : "License decided by scraping the resource at " + url + " and looking for the following license statement: \"This is an open-access article distributed under the terms of the Creative Commons Attribution License, which permits unrestricted use, distribution, and reproduction in any medium, provided the original author and source are credited.\".",
+            "handler" : "plos",
+            "handler_version" : "0.1"
+        }
+    })
+    return {
+        "id" : "doi:" + doi.replace("/", "_"),
+        "identifier" : [{"id" : doi, "type" : "doi", "canonical" : "doi:" + doi}],
+        "title" : u"A realistic article title with some non-ascii characters \u00e9\u00fc",
+        "license" : [licence, deepcopy(licence)]
+    }
+
+def make_record(n):
+    bibjson = make_bibjson(n)
+    return {
+        "identifier" : bibjson["identifier"][0],
+        "provider" : {"url" : [bibjson["license"][0]["provenance"]["source"]], "doi" : bibjson["identifier"][0]["canonical"]},
+        "bibjson" : bibjson
+    }
+
+def hops():
+    record = make_record(1)
+    bibjson = record["bibjson"]
+    message = {
+        "task" : "openarticlegauge.workflow.detect_provider",
+        "id" : "8c2d4b52-2d2c-4a35-9d58-0e8b3c1f4a3e",
+        "args" : [record],
+        "kwargs" : {},
+        "retries" : 0,
+        "eta" : None,
+        "callbacks" : [{"task" : "openarticlegauge.workflow.provider_licence", "args" : [], "kwargs" : {}, "options" : {}}]
+    }
+    resultset = {
+        "requested" : 100,
+        "results" : [make_bibjson(i) for i in range(100)],
+        "errors" : [],
+        "processing" : []
+    }
+    bulk = [make_bibjson(i) for i in range(1000)]
+    pull = {"_index" : "oag", "_type" : "record", "_id" : bibjson["id"], "_version" : 1, "exists" : True, "_source" : bibjson}
+
+    def bulk_body():
+        data = ""
+        for r in bulk:
+            data += codec.dumps({"index" : {"_id" : r["id"]}}) + "\n"
+            data += codec.dumps(r) + "\n"
+        return data
+
+    pull_s = codec.dumps(pull)
+
+    return [
+        ("cache", lambda: codec.loads(codec.dumps(record))),
+        ("buffer", lambda: codec.loads(codec.dumps(bibjson))),
+        ("broker", lambda: codec.loads(codec.dumps(message))),
+        ("api", lambda: codec.dumps(resultset)),
+        ("bulk", bulk_body),
+        ("pull", lambda: codec.loads(pull_s))
+    ]
+
+def run():
+    original = codec.name
+    results = {}
+    for name in codec.available():
+        codec.use(name)
+        results[name] = {}
+        for hop, fn in hops():
+            results[name][hop] = min(timeit.repeat(fn, number=ITERATIONS, repeat=3)) / ITERATIONS
+    codec.use(original)
+    return results
+
+def report(results):
+    names = [n for n in ["json", "simplejson", "ujson", "orjson"] if n in results]
+    print "codec selected by configuration: " + codec.name
+    print "microseconds per operation (speed-up over stdlib json in brackets)"
+    print "hop".ljust(10) + "".join([n.rjust(20) for n in names])
+    for hop, fn in hops():
+        base = results["json"][hop]
+        row = hop.ljust(10)
+        for n in names:
+            t = results[n][hop]
+            row += ("%.1f (%.2fx)" % (t * 1000000, base / t)).rjust(20)
+        print row
+
+if __name__ == "__main__":
+    report(run())
@@ -0,0 +1,44 @@
+"""
+Benchmark building the licence object that a plugin attaches to a record when it finds a licence
+statement, the way the plugins used to (a deep copy of the licences table entry, the open access
+decision made again, and the defaults and plugin values applied one by one) against the compiled
+licence registry (see license_registry.py).
+
+Run from the repository root with
+
+    python openarticlegauge/tests/benchmark/license_benchmark.py
+
+"""
+
+import timeit
+from copy import deepcopy
+
+from openarticlegauge import license_registry, oa_policy
+from openarticlegauge.licenses import LICENSES
+
+ITERATIONS = 20000
+
+MAPPING = {'type': 'cc-by', 'version': '3.0', 'url': 'http://creativecommons.org/licenses/by/3.0/'}
+PROVENANCE = {'handler' : 'plos', 'handler_version' : '0.1', 'source' : 'http://www.plosone.org/article'}
+
+def by_hand():
+    license = deepcopy(LICENSES['cc-by'])
+    license['open_access'] = oa_policy.oa_for_license('cc-by')
+    license.setdefault('version','')
+    license.setdefault('description','')
+    license.setdefault('jurisdiction','')
+    license.update(MAPPING)
+    license['provenance'] = PROVENANCE
+    return license
+
+def compiled():
+    return license_registry.build('cc-by', MAPPING, PROVENANCE)
+
+if __name__ == "__main__":
+    assert by_hand() == compiled()
+    results = []
+    for name, fn in [("by hand", by_hand), ("compiled", compiled)]:
+        t = min(timeit.repeat(fn, number=ITERATIONS, repeat=3)) / ITERATIONS
+        results.append(t)
+        print name.ljust(10) + ("%.2f microseconds per licence" % (t * 1000000))
+    print "speed-up: %.1fx" % (results[0] / results[1])
@@ -0,0 +1,59 @@
+"""
+Benchmark how long it takes to import the modules that each kind of OAG process starts from, each in a
+fresh interpreter, and check that the Celery workers don't build the web application:
+
+settings  -- the application settings, without the web application
+models    -- the storage models (the command line tools)
+worker    -- the Celery tasks (what a worker imports, via celeryconfig.CELERY_IMPORTS)
+web       -- the web application, which also sets up the index if it has changed (see core.py)
+
+The web application needs Elasticsearch and Redis to be running, so its timing includes the round trips
+to them.  Run from the repository root with
+
+    python openarticlegauge/tests/benchmark/startup_benchmark.py
+
+"""
+
+import subprocess, sys
+
+REPEAT = 5
+
+# what each process imports
+STARTS = [
+    ("settings", ["openarticlegauge.settings"]),
+    ("models", ["openarticlegauge.models"]),
+    ("worker", ["openarticlegauge.workflow", "openarticlegauge.models", "openarticlegauge.stats"]),
+    ("web", ["openarticlegauge.app"])
+]
+
+# time the imports, and report on whether the web application was built
+SCRIPT = """
+import time, sys, logging
+logging.disable(logging.CRITICAL)
+started = time.time()
+for module in %r:
+    __import__(module)
+print time.time() - started, 'openarticlegauge.core' in sys.modules, 'flask' in sys.modules
+"""
+
+def measure(modules):
+    output = subprocess.check_output([sys.executable, "-c", SCRIPT % (modules,)])
+    elapsed, core, flask = output.strip().split("\n")[-1].split()
+    return float(elapsed), core == "True", flask == "True"
+
+def run():
+    results = {}
+    for name, modules in STARTS:
+        timings = [measure(modules) for i in range(REPEAT)]
+        results[name] = (min([t[0] for t in timings]), timings[0][1], timings[0][2])
+    return results
+
+def report(results):
+    print "import time, best of " + str(REPEAT) + " fresh interpreters"
+    print "start".ljust(10) + "seconds".rjust(10) + "web app built".rjust(16) + "flask loaded".rjust(16)
+    for name, modules in STARTS:
+        elapsed, core, flask = results[name]
+        print name.ljust(10) + ("%.3f" % elapsed).rjust(10) + str(core).rjust(16) + str(flask).rjust(16)
+
+if __name__ == "__main__":
+    report(run())
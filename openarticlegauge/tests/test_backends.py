@@ -0,0 +1,190 @@
+from unittest import TestCase
+
+import os, shutil, tempfile, threading
+from openarticlegauge import backends, models, invalidate, recordmanager
+
+def _record(id_, last_checked, licences):
+    return {
+        "id" : id_,
+        "identifier" : [{"id" : id_, "canonical" : id_}],
+        "last_checked" : last_checked,
+        "license" : [{"type" : t, "provenance" : {"handler" : h, "handler_version" : "1.0"}} for t, h in licences]
+    }
+
+RECORDS = [
+    _record("doi:10.1/a", 100, [("failed-to-obtain-license", "plugin_a"), ("cc-by", "plugin_b")]),
+    _record("doi:10.1/b", 300, [("failed-to-obtain-license", "plugin_b")]),
+    _record("doi:10.1/c", 200, [("cc-by", "plugin_a")]),
+    _record(u"doi:10.1/\u00e9", 400, [("cc0", "plugin_a")])
+]
+
+class TestBackends(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.backend = backends.SQLiteBackend(os.path.join(self.dir, "archive.sqlite"))
+        self.old_archive = backends.archive
+        backends.archive = lambda: self.backend
+
+    def tearDown(self):
+        backends.archive = self.old_archive
+        shutil.rmtree(self.dir)
+
+    def test_01_save_get(self):
+        assert self.backend.get("record", "nothing") is None
+        self.backend.save("record", "1", {"id" : "1", "title" : "one"})
+        doc = self.backend.get("record", "1")
+        assert doc["_source"] == {"id" : "1", "title" : "one"}
+        assert doc["_version"] == 1
+
+        self.backend.save("record", "1", {"id" : "1", "title" : "uno"})
+        doc = self.backend.get("record", "1")
+        assert doc["_source"]["title"] == "uno"
+        assert doc["_version"] == 2
+
+        # types are kept apart
+        assert self.backend.get("issue", "1") is None
+
+        self.backend.delete("record", "1")
+        assert self.backend.get("record", "1") is None
+
+    def test_02_bulk_mget(self):
+        self.backend.bulk("record", RECORDS)
+        docs = self.backend.mget("record", ["doi:10.1/c", "missing", u"doi:10.1/\u00e9"])
+        assert docs[0] == RECORDS[2]
+        assert docs[1] is None
+        assert docs[2] == RECORDS[3]
+
+    def test_03_bulk_update(self):
+        self.backend.save("record", "1", {"id" : "1", "nested" : {"a" : 1, "b" : 2}, "license" : [1, 2]})
+        result = self.backend.bulk_update("record", [("1", {"nested" : {"b" : 3}, "license" : [1]}), ("missing", {"x" : 1})])
+        assert result["items"][0]["update"]["ok"]
+        assert "error" in result["items"][1]["update"]
+        # objects are merged, everything else replaced, as in an Elasticsearch partial update
+        assert self.backend.get("record", "1")["_source"] == {"id" : "1", "nested" : {"a" : 1, "b" : 3}, "license" : [1]}
+        assert self.backend.get("record", "missing") is None
+
+    def test_04_search(self):
+        self.backend.bulk("record", RECORDS)
+
+        # as the sweeper asks for records (see models.Record.checked_before)
+        query = {
+            "query" : {"filtered" : {"query" : {"match_all" : {}}, "filter" : {"range" : {"last_checked" : {"lt" : 350}}}}},
+            "sort" : [{"last_checked" : {"order" : "asc"}}],
+            "size" : 2
+        }
+        result = self.backend.search("record", query)
+        assert result["hits"]["total"] == 3
+        assert [h["_id"] for h in result["hits"]["hits"]] == ["doi:10.1/a", "doi:10.1/c"]
+
+        query["sort"] = [{"last_checked" : {"order" : "desc"}}]
+        query["from"] = 1
+        result = self.backend.search("record", query)
+        assert [h["_id"] for h in result["hits"]["hits"]] == ["doi:10.1/c", "doi:10.1/a"]
+
+        f = {"and" : [{"range" : {"last_checked" : {"lt" : 1000}}}, {"ids" : {"values" : ["doi:10.1/b", "doi:10.1/c"]}}]}
+        result = self.backend.search("record", {"query" : {"filtered" : {"query" : {"match_all" : {}}, "filter" : f}}})
+        assert sorted([h["_id"] for h in result["hits"]["hits"]]) == ["doi:10.1/b", "doi:10.1/c"]
+
+        # term filters on nested fields, through lists
+        result = self.backend.search("record", {"filter" : {"term" : {"license.type.exact" : "cc-by"}}})
+        assert sorted([h["_id"] for h in result["hits"]["hits"]]) == ["doi:10.1/a", "doi:10.1/c"]
+
+        # and query strings
+        assert self.backend.search("record", {"query" : {"query_string" : {"query" : "license.type:cc0"}}})["hits"]["total"] == 1
+        assert self.backend.search("record", {"query" : {"query_string" : {"query" : "PLUGIN_B"}}})["hits"]["total"] == 2
+
+        with self.assertRaises(backends.StorageException):
+            self.backend.search("record", {"query" : {"fuzzy" : {"title" : "x"}}})
+
+    def test_05_scroll(self):
+        self.backend.bulk("record", RECORDS)
+        ids = [r["id"] for r in self.backend.scroll("record", {"query" : {"match_all" : {}}}, 1, "5m")]
+        assert ids == sorted([r["id"] for r in RECORDS])
+
+        # changing records while scrolling doesn't cause any to be skipped or repeated
+        seen = []
+        for r in self.backend.scroll("record", {"query" : {"match_all" : {}}}, 2, "5m"):
+            seen.append(r["id"])
+            self.backend.save("record", r["id"], dict(r, touched=True))
+        assert sorted(seen) == sorted([r["id"] for r in RECORDS])
+
+    def test_06_partitions(self):
+        # the partitions are the same as Elasticsearch's, using java's String.hashCode
+        assert backends._java_hash("hello") == 99162322
+        assert backends._java_hash("polygenelubricants") == -2147483648
+        assert backends._java_hash("Aa") == backends._java_hash("BB")
+
+        self.backend.bulk("record", RECORDS)
+        seen = []
+        for p in range(3):
+            for r in self.backend.scroll("record", {"filter" : invalidate._partition_filter(p, 3)}, 10, "5m"):
+                seen.append(r["id"])
+        assert sorted(seen) == sorted([r["id"] for r in RECORDS])
+
+    def test_07_domain_object(self):
+        models.Record.bulk([dict(r) for r in RECORDS])
+        assert models.Record.pull("doi:10.1/b").data == RECORDS[1]
+        assert models.Record.pull("nothing") is None
+        assert [r.data if r is not None else None for r in models.Record.pull_many(["doi:10.1/a", "nothing"])] == [RECORDS[0], None]
+
+        total, records = models.Record.checked_before(250, size=10)
+        assert total == 2
+        assert [r["id"] for r in records] == ["doi:10.1/a", "doi:10.1/c"]
+
+    def test_08_invalidate(self):
+        models.Record.bulk([dict(r) for r in RECORDS])
+        stats = invalidate._invalidate_archive("failed-to-obtain-license", "plugin_a", None, False, lambda x: None, 10)
+        assert stats["updated"] == 1
+        assert stats["removed"] == 1
+        assert [l["type"] for l in models.Record.pull("doi:10.1/a").data["license"]] == ["cc-by"]
+        assert len(models.Record.pull("doi:10.1/b").data["license"]) == 1
+        
+        # the time of the last check comes from the licences that are left, which here have no dates
+        assert models.Record.pull("doi:10.1/a").data["last_checked"] is None
+        assert models.Record.pull("doi:10.1/b").data["last_checked"] == 300
+        total, records = models.Record.checked_before(250, size=10)
+        assert "doi:10.1/a" in [r["id"] for r in records]
+
+    def test_09_threads(self):
+        # each thread has its own connection
+        errors = []
+        def write(n):
+            try:
+                for i in range(20):
+                    self.backend.save("record", str(n) + "-" + str(i), {"id" : str(n) + "-" + str(i)})
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert self.backend.search("record", {"query" : {"match_all" : {}}})["hits"]["total"] == 80
+    
+    def test_10_legacy_checked_before(self):
+        # records archived before last_checked was kept are found by the dates of their licences
+        def legacy(id_, dates):
+            return {"id" : id_, "identifier" : [{"id" : id_, "canonical" : id_}],
+                    "license" : [{"type" : "cc-by", "provenance" : {"handler" : "plugin_a", "date" : recordmanager.epoch_to_date(d)}} for d in dates]}
+        models.Record.bulk([dict(r) for r in RECORDS] + [
+            legacy("doi:10.2_old", [150, 240]),
+            legacy("doi:10.2_recent", [150, 260]),
+            legacy("doi:10.2_none", [])
+        ])
+        
+        total, records = models.Record.checked_before(250, size=10)
+        assert total == 4
+        # the legacy ones first, as the oldest
+        assert sorted([r["id"] for r in records[:2]]) == ["doi:10.2_none", "doi:10.2_old"]
+        assert [r["id"] for r in records[2:]] == ["doi:10.1/a", "doi:10.1/c"]
+        
+        # (archived records are stored under their canonical identifiers with / replaced by _)
+        total, records = models.Record.checked_before(250, size=10, ids=["doi:10.2/old", "doi:10.2/recent"])
+        assert [r["id"] for r in records] == ["doi:10.2_old"]
+        
+        # records which the sweeper is leaving alone are left out
+        total, records = models.Record.checked_before(250, size=10, exclude=["doi:10.2/old"])
+        assert total == 3
+        assert "doi:10.2_old" not in [r["id"] for r in records]
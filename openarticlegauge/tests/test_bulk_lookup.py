@@ -0,0 +1,184 @@
+from unittest import TestCase
+
+import os, json, shutil, tempfile
+from openarticlegauge import bulk_lookup, workflow
+
+STORED = []
+
+def mock_detect_verify_type(record):
+    if record['identifier']['id'].startswith("10."):
+        record['identifier']['type'] = "doi"
+
+def mock_canonicalise_identifier(record):
+    record['identifier']['canonical'] = record['identifier']['type'] + ":" + record['identifier']['id']
+
+def mock_detect_provider(record):
+    if "unresolvable" in record['identifier']['id']:
+        record['error'] = "unable to resolve the identifier to a provider"
+    else:
+        record['provider'] = {"url" : ["http://provider/" + record['identifier']['id']]}
+    return record
+
+def mock_provider_licence(record):
+    if "broken" in record['identifier']['id']:
+        raise ValueError("plugin broke")
+    if "nolicence" not in record['identifier']['id']:
+        record['bibjson'] = {"license" : [{"type" : "cc-by", "provenance" : {"handler" : "mock"}}]}
+    return record
+
+def mock_store_results(record):
+    STORED.append(record)
+    return record
+
+def mock_check_cache(record):
+    if "cached" in record['identifier']['id']:
+        if "stale" in record['identifier']['id']:
+            record['stale'] = True
+        return {"identifier" : record['identifier'], "bibjson" : {"title" : "cached"}}
+    return None
+
+def mock_check_archive(record):
+    if "archived" in record['identifier']['id']:
+        return {"title" : "archived"}
+    return None
+
+class TestBulkLookup(TestCase):
+
+    def setUp(self):
+        global STORED
+        del STORED[:]
+        self.old_detect_verify_type = workflow._detect_verify_type
+        self.old_canonicalise_identifier = workflow._canonicalise_identifier
+        self.old_detect_provider = workflow.detect_provider
+        self.old_provider_licence = workflow.provider_licence
+        self.old_store_results = workflow.store_results
+        self.old_check_cache = workflow._check_cache
+        self.old_check_archive = workflow._check_archive
+        workflow._detect_verify_type = mock_detect_verify_type
+        workflow._canonicalise_identifier = mock_canonicalise_identifier
+        workflow.detect_provider = mock_detect_provider
+        workflow.provider_licence = mock_provider_licence
+        workflow.store_results = mock_store_results
+        workflow._check_cache = mock_check_cache
+        workflow._check_archive = mock_check_archive
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        workflow._detect_verify_type = self.old_detect_verify_type
+        workflow._canonicalise_identifier = self.old_canonicalise_identifier
+        workflow.detect_provider = self.old_detect_provider
+        workflow.provider_licence = self.old_provider_licence
+        workflow.store_results = self.old_store_results
+        workflow._check_cache = self.old_check_cache
+        workflow._check_archive = self.old_check_archive
+        shutil.rmtree(self.dir)
+
+    def _file(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def _results(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_01_read_ndjson(self):
+        path = self._file("in.ndjson", '"10.1/a"\n{"id" : "10.1/b", "type" : "doi"}\n\n10.1/c\n{"id" : 12345}\n')
+        ids = list(bulk_lookup.read_identifiers(path))
+        assert ids == [{"id" : "10.1/a"}, {"id" : "10.1/b", "type" : "doi"}, {"id" : "10.1/c"}, {"id" : "12345"}], ids
+
+    def test_02_read_csv(self):
+        path = self._file("in.csv", 'id,type\n10.1/a,doi\n\n10.1/b\n')
+        ids = list(bulk_lookup.read_identifiers(path))
+        assert ids == [{"id" : "10.1/a", "type" : "doi"}, {"id" : "10.1/b"}], ids
+
+        # the format can be given explicitly, whatever the file is called
+        path = self._file("in.txt", '10.1/a\n')
+        assert list(bulk_lookup.read_identifiers(path, "csv")) == [{"id" : "10.1/a"}]
+        with self.assertRaises(ValueError):
+            list(bulk_lookup.read_identifiers(path, "xml"))
+
+    def test_03_lookup(self):
+        result = bulk_lookup.lookup_one({"id" : "10.1/a"})
+        assert result['input'] == "10.1/a"
+        assert result['source'] == "lookup"
+        assert result['identifier']['canonical'] == "doi:10.1/a"
+        assert result['bibjson']['license'][0]['type'] == "cc-by"
+        assert result['bibjson']['identifier'][0]['canonical'] == "doi:10.1/a"
+        assert len(STORED) == 0
+
+    def test_04_lookup_no_licence(self):
+        result = bulk_lookup.lookup_one({"id" : "10.1/nolicence"})
+        assert result['bibjson']['license'][0]['type'] == "failed-to-obtain-license"
+
+    def test_05_lookup_errors(self):
+        result = bulk_lookup.lookup_one({"id" : "notanid"})
+        assert result == {"input" : "notanid", "error" : "unable to determine the type of the identifier"}, result
+
+        result = bulk_lookup.lookup_one({"id" : "10.1/unresolvable"})
+        assert result['error'] == "unable to resolve the identifier to a provider"
+        assert "bibjson" not in result
+
+        # a broken plugin gives an error for that identifier, rather than stopping the run
+        result = bulk_lookup.lookup_one({"id" : "10.1/broken"})
+        assert "plugin broke" in result['error']
+
+    def test_06_lookup_cache_and_archive(self):
+        # nothing is read unless we ask for it
+        result = bulk_lookup.lookup_one({"id" : "10.1/cached"})
+        assert result['source'] == "lookup"
+
+        result = bulk_lookup.lookup_one({"id" : "10.1/cached"}, use_cache=True)
+        assert result['source'] == "cache"
+        assert result['bibjson'] == {"title" : "cached"}
+
+        result = bulk_lookup.lookup_one({"id" : "10.1/archived"}, use_cache=True, use_archive=True)
+        assert result['source'] == "archive"
+
+        # stale copies are looked up again
+        result = bulk_lookup.lookup_one({"id" : "10.1/cached-stale"}, use_cache=True)
+        assert result['source'] == "lookup"
+
+    def test_07_lookup_store(self):
+        result = bulk_lookup.lookup_one({"id" : "10.1/a"}, store=True)
+        assert result['source'] == "lookup"
+        assert len(STORED) == 1
+        assert STORED[0]['identifier']['canonical'] == "doi:10.1/a"
+
+    def test_08_run(self):
+        inp = self._file("in.ndjson", '10.1/a\n10.1/b\n10.1/a\nnotanid\n10.1/cached\n')
+        out = os.path.join(self.dir, "out.ndjson")
+        stats = bulk_lookup.run(inp, out, processes=1, use_cache=True)
+        assert stats['processed'] == 4
+        assert stats['skipped'] == 1
+        assert stats['errors'] == 1
+        assert stats['cache'] == 1
+
+        results = self._results(out)
+        assert [r['input'] for r in results] == ["10.1/a", "10.1/b", "notanid", "10.1/cached"]
+
+    def test_09_resume(self):
+        inp = self._file("in.ndjson", '10.1/a\n10.1/b\n10.1/c\n')
+        # a previous run finished 10.1/a, and was interrupted while writing 10.1/b
+        out = self._file("out.ndjson", json.dumps({"input" : "10.1/a", "source" : "lookup"}) + '\n{"input" : "10.1/b", "sou')
+
+        stats = bulk_lookup.run(inp, out, processes=1)
+        assert stats['processed'] == 2
+        assert stats['skipped'] == 1
+
+        results = self._results(out)
+        assert [r['input'] for r in results] == ["10.1/a", "10.1/b", "10.1/c"]
+
+        # and running it again does nothing
+        stats = bulk_lookup.run(inp, out, processes=1)
+        assert stats['processed'] == 0
+        assert stats['skipped'] == 3
+
+    def test_10_run_parallel(self):
+        ids = ["10.1/" + str(i) for i in range(20)]
+        inp = self._file("in.csv", "\n".join(ids))
+        out = os.path.join(self.dir, "out.ndjson")
+        stats = bulk_lookup.run(inp, out, processes=3)
+        assert stats['processed'] == 20
+        assert sorted([r['input'] for r in self._results(out)]) == sorted(ids)
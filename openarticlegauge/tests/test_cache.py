@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-import redis, json, datetime
+import redis, json, datetime, time, zlib
 from openarticlegauge import config, cache
 
 test_host = "localhost"
@@ -19,6 +19,13 @@ class TestWorkflow(TestCase):
         client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
         client.delete("exists")
         client.delete("corrupt")
+        client.delete(cache.CLAIM_PREFIX + "exists")
+        client.delete(cache.INFLIGHT_KEY)
+        client.delete(cache.POPULARITY_KEY)
+        client.delete(cache.SWEEP_STATS_KEY)
+        client.delete(cache.SWEEP_BACKOFF_KEY)
+        client.delete(cache.GENERATIONS_KEY)
+        client.delete("g1:exists")
         
     def test_01_check_redis_up(self):
         # not really a test, but we can't carry on if redis isn't responding
@@ -123,8 +130,154 @@ class TestWorkflow(TestCase):
         obj = json.loads(s)
         assert obj.has_key("key")
         assert obj["key"] == "value"
+    
+    def test_12_claim(self):
+        # only the first claim succeeds, until the claim is released
+        token = cache.claim("exists")
+        assert token
+        assert cache.claim("exists") is None
+        
+        client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+        ttl = client.ttl(cache.CLAIM_PREFIX + "exists")
+        assert ttl > 0 and ttl <= config.QUEUED_LEASE_TIMEOUT
+        
+        # and only by whoever holds it
+        assert not cache.release_claim("exists", "someone else")
+        assert cache.claim("exists") is None
+        assert cache.release_claim("exists", token)
+        assert cache.claim("exists")
+    
+    def test_13_cache_timeout(self):
+        cache.cache("exists", {"queued" : True}, 60)
+        client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+        ttl = client.ttl("exists")
+        assert ttl > 0 and ttl <= 60
+    
+    def test_14_lease(self):
+        client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+        token = cache.claim("exists")
+        assert token
+        assert client.zscore(cache.INFLIGHT_KEY, "exists") >= time.time()
+        
+        # a live claim is not an orphan
+        assert cache.orphaned_claims() == []
+        
+        # renewing a lapsed claim takes it again
+        client.delete(cache.CLAIM_PREFIX + "exists")
+        assert cache.renew_claim("exists", token)
+        assert not cache.claim("exists")
+        
+        # but not once someone else has claimed it
+        client.delete(cache.CLAIM_PREFIX + "exists")
+        other = cache.claim("exists")
+        assert not cache.renew_claim("exists", token)
+        assert client.get(cache.CLAIM_PREFIX + "exists") == other
+        
+        # a claim whose lease ran out without being released is an orphan, and is only reported once
+        client.zadd(cache.INFLIGHT_KEY, int(time.time()) - 10, "exists")
+        assert cache.orphaned_claims() == ["exists"]
+        assert cache.orphaned_claims() == []
+        
+        # releasing a claim removes it from the in-flight set
+        assert cache.renew_claim("exists", other)
+        assert cache.release_claim("exists", other)
+        assert client.zscore(cache.INFLIGHT_KEY, "exists") is None
+        assert client.get(cache.CLAIM_PREFIX + "exists") is None
+    
+    def test_15_popularity(self):
+        for i in range(3):
+            cache.count_request("doi:10.popular")
+        cache.count_request("doi:10.unpopular")
+        for i in range(2):
+            cache.count_request("doi:10.middling")
+        
+        assert cache.most_requested(2) == ["doi:10.popular", "doi:10.middling"]
+        
+        # only the most popular are remembered
+        old_max = config.POPULARITY_MAX_ITEMS
+        config.POPULARITY_MAX_ITEMS = 1
+        assert cache.most_requested(10) == ["doi:10.popular"]
+        config.POPULARITY_MAX_ITEMS = old_max
+    
+    def test_16_sweep_stats(self):
+        cache.update_sweep_stats({"last_enqueued" : 5, "total_enqueued" : 5})
+        cache.update_sweep_stats({"last_enqueued" : 3, "total_enqueued" : 3})
+        stats = cache.sweep_stats()
+        assert stats["last_enqueued"] == "3"
+        assert stats["total_enqueued"] == "8"
+    
+    def test_17_handler_generation(self):
+        record = {"bibjson" : {"license" : [{"type" : "cc-by", "provenance" : {"handler" : "plos", "handler_version" : "0.1"}}]}}
+        cache.cache("exists", record)
+        assert cache.check_cache("exists") == record
+        
+        # bumping an unrelated handler leaves the record alone
+        cache.bump_generation("bmc")
+        assert cache.check_cache("exists") == record
+        
+        # bumping the record's handler invalidates it, and it can be cached again afterwards
+        assert cache.bump_generation("plos", "0.1") == ("handler:plos@0.1", 1)
+        assert cache.check_cache("exists") is None
+        cache.cache("exists", record)
+        assert cache.check_cache("exists") == record
+        
+        # records with licences that have no handler
+        cache.cache("corrupt", {"bibjson" : {"license" : [{"type" : "cc-by", "provenance" : {}}]}})
+        cache.bump_generation(treat_none_as_missing=True)
+        assert cache.check_cache("corrupt") is None
+        assert cache.check_cache("exists") == record
+    
+    def test_18_global_generation(self):
+        cache.cache("exists", {"key" : "value"})
+        assert cache.bump_generation() == ("global", 1)
+        assert cache.check_cache("exists") is None
         
+        # new entries go into the new namespace
+        cache.cache("exists", {"key" : "other value"})
+        assert cache.check_cache("exists") == {"key" : "other value"}
+        client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+        assert client.get("g1:exists") is not None
         
+        cache.invalidate("exists")
+        assert client.get("g1:exists") is None
+    
+    def test_19_license_type_generation(self):
+        unknown = {"bibjson" : {"license" : [{"type" : "failed-to-obtain-license", "provenance" : {"handler" : "plos", "handler_version" : "0.1"}}]}}
+        known = {"bibjson" : {"license" : [{"type" : "cc-by", "provenance" : {"handler" : "plos", "handler_version" : "0.1"}}]}}
+        cache.cache("unknown", unknown)
+        cache.cache("known", known)
+        
+        # invalidating the unknown licences from all handlers leaves the records with good licences alone
+        assert cache.bump_generation(license_type="failed-to-obtain-license") == ("license:failed-to-obtain-license", 1)
+        assert cache.check_cache("unknown") is None
+        assert cache.check_cache("known") == known
+        
+        # as does invalidating those from a particular handler
+        cache.cache("unknown", unknown)
+        assert cache.bump_generation("plos", "0.1", license_type="failed-to-obtain-license") == ("license:failed-to-obtain-license:handler:plos@0.1", 1)
+        assert cache.check_cache("unknown") is None
+        assert cache.check_cache("known") == known
+        assert cache.get_generations().get("global", 0) == 0
+    
+    def test_20_sweep_backoff(self):
+        cache.back_off_sweep("doi:10.failing")
+        assert cache.sweep_backed_off() == ["doi:10.failing"]
+        
+        old_backoff, old_max = config.SWEEP_FAILURE_BACKOFF, config.SWEEP_BACKOFF_MAX_ITEMS
+        try:
+            # beyond the maximum, those due back soonest are let back in
+            config.SWEEP_BACKOFF_MAX_ITEMS = 1
+            config.SWEEP_FAILURE_BACKOFF = 100
+            cache.back_off_sweep("doi:10.also_failing")
+            assert cache.sweep_backed_off() == ["doi:10.failing"]
+            
+            # and once its back-off has run out, the sweeper tries it again
+            config.SWEEP_FAILURE_BACKOFF = -1
+            cache.back_off_sweep("doi:10.failing")
+            assert cache.sweep_backed_off() == []
+        finally:
+            config.SWEEP_FAILURE_BACKOFF, config.SWEEP_BACKOFF_MAX_ITEMS = old_backoff, old_max
+
         
         
         
@@ -155,3 +308,220 @@ class TestWorkflow(TestCase):
         
         
         
+        
+        
+
+class TestEncoding(TestCase):
+
+    def setUp(self):
+        self.encoding = config.CACHE_ENCODING
+        self.record = {"identifier" : {"id" : "10.1", "type" : "doi", "canonical" : "doi:10.1"}, "bibjson" : {"title" : u"caf\u00e9", "license" : [{"type" : "cc-by", "open_access" : True, "NC" : None}]}}
+        
+    def tearDown(self):
+        config.CACHE_ENCODING = self.encoding
+    
+    def _usable(self, encoding):
+        try:
+            cache.encode({}, encoding)
+            return True
+        except cache.CacheException:
+            return False
+    
+    def test_01_plain_json_has_no_header(self):
+        s = cache.encode(self.record, "json")
+        assert json.loads(s) == self.record
+        assert cache.encoding_of(s) == "json"
+    
+    def test_02_roundtrip_all_encodings(self):
+        for encoding in cache.ENCODINGS.keys():
+            if not self._usable(encoding):
+                continue
+            s = cache.encode(self.record, encoding)
+            assert cache.encoding_of(s) == encoding, encoding
+            assert cache.decode(s) == self.record, encoding
+    
+    def test_03_configured_encoding(self):
+        config.CACHE_ENCODING = "json+zlib"
+        s = cache.encode(self.record)
+        assert s.startswith(cache.FORMAT_MAGIC)
+        assert cache.encoding_of(s) == "json+zlib"
+        
+        # the payload after the header is the json, compressed
+        assert json.loads(zlib.decompress(s[len(cache.FORMAT_MAGIC) + 2:])) == self.record
+        
+        # which is smaller, on a record with enough in it to compress
+        record = dict(self.record, bibjson=dict(self.record["bibjson"], license=self.record["bibjson"]["license"] * 20))
+        assert len(cache.encode(record)) < len(json.dumps(record))
+    
+    def test_04_legacy_entries_readable(self):
+        config.CACHE_ENCODING = "json+zlib"
+        assert cache.decode(json.dumps(self.record)) == self.record
+    
+    def test_05_unknown_encoding(self):
+        with self.assertRaises(cache.CacheException):
+            cache.encode(self.record, "wibble")
+    
+    def test_06_newer_format_version(self):
+        s = cache.FORMAT_MAGIC + chr(cache.FORMAT_VERSION + 1) + chr(1) + "whatever"
+        with self.assertRaises(cache.UnsupportedFormatException):
+            cache.decode(s)
+        
+        s = cache.FORMAT_MAGIC + chr(cache.FORMAT_VERSION) + chr(200) + "whatever"
+        with self.assertRaises(cache.UnsupportedFormatException):
+            cache.decode(s)
+    
+    def test_07_corrupt_entry(self):
+        s = cache.FORMAT_MAGIC + chr(cache.FORMAT_VERSION) + chr(cache.ENCODINGS["json+zlib"]) + "not compressed"
+        with self.assertRaises(ValueError):
+            cache.decode(s)
+        
+        with self.assertRaises(ValueError):
+            cache.decode(cache.FORMAT_MAGIC)
+
+class TestLastChecked(TestCase):
+
+    def setUp(self):
+        self.stale_time = config.licence_stale_time
+        config.licence_stale_time = 15552000 # 6 months
+        
+    def tearDown(self):
+        config.licence_stale_time = self.stale_time
+    
+    def test_01_last_checked_used(self):
+        # the licence dates are ignored if the record has a last_checked timestamp
+        oneyear = datetime.timedelta(days=365)
+        old = datetime.datetime.strftime(datetime.datetime.now() - oneyear, "%Y-%m-%dT%H:%M:%SZ")
+        bibjson = {'license' : [{'provenance' : {'date' : old}}], 'last_checked' : int(time.time()) - 60}
+        assert not cache.is_stale(bibjson)
+        
+        bibjson['last_checked'] = int(time.time()) - 15552000 - 60
+        assert cache.is_stale(bibjson)
+    
+    def test_02_legacy_record(self):
+        threemonths = datetime.timedelta(days=90)
+        n = datetime.datetime.now()
+        bibjson = {'license' : [{'provenance' : {'date' : datetime.datetime.strftime(n - threemonths, "%Y-%m-%dT%H:%M:%SZ")}}]}
+        assert not cache.is_stale(bibjson)
+        
+        # the computed timestamp is remembered on the record
+        assert bibjson.has_key("last_checked")
+        assert abs(bibjson['last_checked'] - (time.time() - 90 * 86400)) < 5
+    
+    def test_03_no_licence(self):
+        # a timestamp on its own does not make up for there being no licence at all
+        assert cache.is_stale({'last_checked' : int(time.time())})
+        assert cache.is_stale({'license' : [], 'last_checked' : int(time.time())})
+    
+    def test_04_servable_stale(self):
+        month = 2592000
+        bibjson = {'license' : [{}], 'last_checked' : int(time.time()) - 7 * month}
+        assert cache.is_stale(bibjson)
+        assert cache.is_servable_stale(bibjson)
+        
+        # past the hard limit it can't be served
+        bibjson['last_checked'] = int(time.time()) - config.STALE_MAX_AGE - 60
+        assert not cache.is_servable_stale(bibjson)
+        
+        # nor without a licence
+        assert not cache.is_servable_stale({'last_checked' : int(time.time()) - 7 * month})
+        
+        # nor if serving stale records is switched off
+        old_max_age = config.STALE_MAX_AGE
+        config.STALE_MAX_AGE = 0
+        bibjson['last_checked'] = int(time.time()) - 7 * month
+        assert not cache.is_servable_stale(bibjson)
+        config.STALE_MAX_AGE = old_max_age
+
+class TestLocalCache(TestCase):
+
+    def setUp(self):
+        config.REDIS_CACHE_HOST = test_host
+        config.REDIS_CACHE_PORT = test_port
+        config.REDIS_CACHE_DB = test_db
+        self.timeout = config.LOCAL_CACHE_TIMEOUT
+        self.pubsub = config.LOCAL_CACHE_PUBSUB
+        config.LOCAL_CACHE_TIMEOUT = 60
+        # start afresh, as if in a new process
+        cache._local_pid = None
+        self.client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+        self.record = {"identifier" : {"id" : "10.1", "canonical" : "doi:10.1"}, "bibjson" : {"license" : [{"type" : "cc-by"}]}}
+        
+    def tearDown(self):
+        config.LOCAL_CACHE_TIMEOUT = self.timeout
+        config.LOCAL_CACHE_PUBSUB = self.pubsub
+        cache._local_pid = None
+        self.client.delete("local", "queued", cache.GENERATIONS_KEY)
+    
+    def _wait_for(self, condition):
+        # give the listener a moment to receive the invalidation
+        for i in range(50):
+            if condition():
+                return True
+            time.sleep(0.02)
+        return False
+    
+    def test_01_served_locally(self):
+        cache.cache("local", self.record)
+        assert cache.check_cache("local") == self.record
+        
+        # from now on it is served without going to redis
+        self.client.set("local", json.dumps({"changed" : "behind our back"}))
+        before = cache.tier_stats()
+        assert cache.check_cache("local") == self.record
+        after = cache.tier_stats()
+        assert after["local"]["hits"] == before["local"]["hits"] + 1
+        assert after["redis"]["hits"] == before["redis"]["hits"]
+        assert after["local"]["entries"] == 1
+        assert after["local"]["bytes"] > 0
+        
+        # callers get their own copy to change
+        cache.check_cache("local")["bibjson"]["license"].append({"type" : "changed"})
+        assert cache.check_cache("local") == self.record
+    
+    def test_02_invalidated_everywhere(self):
+        cache.cache("local", self.record)
+        cache.check_cache("local")
+        
+        # another process changes the record
+        self.client.set("local", json.dumps({"changed" : True}))
+        self.client.publish(cache.INVALIDATIONS_CHANNEL, "another-process local")
+        assert self._wait_for(lambda: cache.check_cache("local") == {"changed" : True})
+        
+        # and then bumps a generation, which clears everything
+        cache.check_cache("local")
+        self.client.set("local", json.dumps({"changed" : "again"}))
+        cache.bump_generation("plugin_a")
+        assert self._wait_for(lambda: cache.check_cache("local") == {"changed" : "again"})
+        
+        # changes made in this process are seen straight away
+        cache.cache("local", self.record)
+        assert cache.check_cache("local") == self.record
+        cache.invalidate("local")
+        assert cache.check_cache("local") is None
+    
+    def test_03_queued_not_kept(self):
+        cache.cache("queued", {"identifier" : {"id" : "10.2"}, "queued" : True})
+        cache.check_cache("queued")
+        assert cache.tier_stats()["local"]["entries"] == 0
+    
+    def test_04_timeout_only(self):
+        config.LOCAL_CACHE_PUBSUB = False
+        config.LOCAL_CACHE_TIMEOUT = 1
+        cache.cache("local", self.record)
+        cache.check_cache("local")
+        
+        # without the channel, another process's change is only seen when the local copy expires
+        self.client.set("local", json.dumps({"changed" : True}))
+        self.client.publish(cache.INVALIDATIONS_CHANNEL, "another-process local")
+        assert cache.check_cache("local") == self.record
+        time.sleep(1.1)
+        assert cache.check_cache("local") == {"changed" : True}
+    
+    def test_05_switched_off(self):
+        config.LOCAL_CACHE_TIMEOUT = 0
+        cache.cache("local", self.record)
+        cache.check_cache("local")
+        stats = cache.tier_stats()
+        assert not stats["local"]["enabled"]
+        assert stats["local"]["hit_ratio"] is None
+        assert stats["redis"]["hits"] > 0
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from openarticlegauge import codec
+
+RECORD = {
+    "identifier" : {"id" : "10.1371/journal.pone.0035089", "type" : "doi", "canonical" : "doi:10.1371/journal.pone.0035089"},
+    "queued" : False,
+    "provider" : {"url" : ["http://www.plosone.org/article/info%3Adoi%2F10.1371%2Fjournal.pone.0035089"]},
+    "bibjson" : {
+        "title" : u"Caf\u00e9 culture",
+        "license" : [{
+            "type" : "cc-by",
+            "open_access" : True,
+            "NC" : False,
+            "version" : None,
+            "provenance" : {"date" : "2013-02-21T11:07:18Z", "handler" : "plos", "handler_version" : "0.1"}
+        }]
+    }
+}
+
+class TestCodec(TestCase):
+
+    def setUp(self):
+        self.original = codec.name
+
+    def tearDown(self):
+        codec.use(self.original)
+
+    def test_01_roundtrip_all_available(self):
+        for name in codec.available():
+            assert codec.use(name), name
+            s = codec.dumps(RECORD)
+            assert isinstance(s, basestring), name
+            assert codec.loads(s) == RECORD, name
+
+    def test_02_stdlib_always_available(self):
+        assert "json" in codec.available()
+        assert codec.use("json")
+        assert codec.name == "json"
+
+    def test_03_select_fallback(self):
+        name = codec.select(["not_a_codec", "also_not_a_codec"])
+        assert name == "json"
+
+        name = codec.select(["not_a_codec", "json"])
+        assert name == "json"
+
+    def test_04_use_unknown(self):
+        codec.use("json")
+        assert not codec.use("not_a_codec")
+        assert codec.name == "json"
+
+    def test_05_dumps_type_error(self):
+        for name in codec.available():
+            codec.use(name)
+            with self.assertRaises(TypeError):
+                codec.dumps({"obj" : object()})
+
+    def test_06_loads_value_error(self):
+        for name in codec.available():
+            codec.use(name)
+            with self.assertRaises(ValueError):
+                codec.loads("{askjdfafds}")
+
+    def test_07_celery_serializer(self):
+        from kombu.serialization import registry
+        codec.register_celery_serializer()
+        content_type, content_encoding, body = registry.encode(RECORD, serializer=codec.CELERY_SERIALIZER)
+        assert content_type == codec.CELERY_CONTENT_TYPE
+        assert registry.decode(body, content_type, content_encoding) == RECORD
@@ -0,0 +1,129 @@
+from unittest import TestCase
+
+import json
+from openarticlegauge import core, licenses
+
+CALLS = []
+MARKER = {}
+FAILING = {}
+
+class MockResponse(object):
+    def __init__(self, status_code, content=""):
+        self.status_code = status_code
+        self.content = content
+
+def mock_get(url):
+    CALLS.append(("GET", url))
+    if url.endswith(core.INDEX_MARKER) and MARKER.has_key("hash"):
+        return MockResponse(200, json.dumps({"_source" : MARKER}))
+    return MockResponse(404)
+
+def mock_post(url, data=None):
+    CALLS.append(("POST", url))
+    if url.endswith("/_bulk"):
+        # ES reports the failure of individual items in the body, not the status
+        items = []
+        for line in data.splitlines()[::2]:
+            _id = json.loads(line)["index"]["_id"]
+            result = {"_id" : _id, "error" : "MapperParsingException"} if _id in FAILING.get("bulk", []) else {"_id" : _id, "ok" : True}
+            items.append({"index" : result})
+        return MockResponse(200, json.dumps({"took" : 1, "items" : items}))
+    return MockResponse(200)
+
+def mock_put(url, data=None):
+    CALLS.append(("PUT", url))
+    if url.endswith(core.INDEX_MARKER):
+        MARKER.update(json.loads(data))
+    if url.endswith("/_mapping") and url.split("/")[-2] in FAILING.get("mapping", []):
+        return MockResponse(400, json.dumps({"error" : "MergeMappingException[Merge failed with failures]", "status" : 400}))
+    return MockResponse(200)
+
+class MockApp(object):
+    def __init__(self, config):
+        self.config = config
+
+class TestCore(TestCase):
+
+    def setUp(self):
+        self.get = core.requests.get
+        self.post = core.requests.post
+        self.put = core.requests.put
+        core.requests.get = mock_get
+        core.requests.post = mock_post
+        core.requests.put = mock_put
+        del CALLS[:]
+        MARKER.clear()
+        FAILING.clear()
+        
+    def tearDown(self):
+        core.requests.get = self.get
+        core.requests.post = self.post
+        core.requests.put = self.put
+    
+    def test_01_initialise_index_once(self):
+        app = MockApp({"MAPPINGS" : core.app.config["MAPPINGS"], "ELASTIC_SEARCH_HOST" : "http://es:9200", "ELASTIC_SEARCH_DB" : "oag"})
+        
+        # the first time round, the mappings are put and the licences loaded in a single bulk request
+        assert core.initialise_index(app)
+        bulk = [c for c in CALLS if c[1].endswith("/_bulk")]
+        assert bulk == [("POST", "http://es:9200/oag/license/_bulk")]
+        assert len([c for c in CALLS if c[0] == "PUT" and c[1].endswith("/_mapping")]) == len(app.config["MAPPINGS"])
+        
+        # after that, nothing is done, until the mappings or licences change
+        del CALLS[:]
+        assert not core.initialise_index(app)
+        assert CALLS == [("GET", "http://es:9200/oag" + core.INDEX_MARKER)]
+        
+        # and then every mapping is put again, not only those the index doesn't have yet
+        app.config["MAPPINGS"] = dict(app.config["MAPPINGS"], extra={"extra" : {}})
+        del CALLS[:]
+        assert core.initialise_index(app)
+        assert len([c for c in CALLS if c[0] == "PUT" and c[1].endswith("/_mapping")]) == len(app.config["MAPPINGS"])
+        assert not core.initialise_index(app)
+    
+    def test_04_mapping_conflict(self):
+        app = MockApp({"MAPPINGS" : core.app.config["MAPPINGS"], "ELASTIC_SEARCH_HOST" : "http://es:9200", "ELASTIC_SEARCH_DB" : "oag"})
+        FAILING["mapping"] = ["record"]
+        
+        # a mapping which can't be merged into the index is an error, and the index isn't marked as initialised
+        with self.assertRaises(core.IndexException):
+            core.initialise_index(app)
+        assert not MARKER.has_key("hash")
+        
+        FAILING.clear()
+        assert core.initialise_index(app)
+        assert MARKER.has_key("hash")
+    
+    def test_05_bulk_item_errors(self):
+        app = MockApp({"MAPPINGS" : core.app.config["MAPPINGS"], "ELASTIC_SEARCH_HOST" : "http://es:9200", "ELASTIC_SEARCH_DB" : "oag"})
+        FAILING["bulk"] = [licenses.LICENSES.keys()[0]]
+        
+        # the bulk request succeeds, but one of the licences didn't go in, so it is all tried again next time
+        assert core.initialise_index(app)
+        assert not MARKER.has_key("hash")
+        assert core.bulk_errors({"items" : [{"index" : {"_id" : "cc-by", "error" : "x"}}, {"index" : {"_id" : "cc0", "ok" : True}}]}) == ["cc-by: x"]
+        
+        FAILING.clear()
+        assert core.initialise_index(app)
+        assert MARKER.has_key("hash")
+    
+    def test_02_content_hash(self):
+        h = core.index_content_hash({"record" : {}}, licenses.LICENSES)
+        assert h == core.index_content_hash({"record" : {}}, dict(licenses.LICENSES))
+        assert h != core.index_content_hash({"record" : {"x" : 1}}, licenses.LICENSES)
+    
+    def test_03_cache_not_flushed(self):
+        flushed = []
+        class MockRedis(object):
+            def __init__(self, **kwargs): pass
+            def flushdb(self): flushed.append(True)
+        old_redis = core.redis.StrictRedis
+        core.redis.StrictRedis = MockRedis
+        
+        config = {"REDIS_CACHE_HOST" : "localhost", "REDIS_CACHE_PORT" : 6379, "REDIS_CACHE_DB" : 2}
+        core.prep_redis(MockApp(dict(config, FLUSH_CACHE_ON_STARTUP=False)))
+        assert flushed == []
+        core.prep_redis(MockApp(dict(config, FLUSH_CACHE_ON_STARTUP=True)))
+        assert flushed == [True]
+        
+        core.redis.StrictRedis = old_redis
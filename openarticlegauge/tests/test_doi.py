@@ -44,10 +44,13 @@ class MockResponse():
         self.headers = {}
         self.url = None
 
-def get_no_location(url):
+def get_no_location(url, *args, **kwargs):
     return MockResponse(200)
 
-def get_success(url):
+def get_not_found(url, *args, **kwargs):
+    return MockResponse(404)
+
+def get_success(url, *args, **kwargs):
     r = MockResponse(200)
     r.url = "http://location"
     return r
@@ -214,6 +217,19 @@ class TestWorkflow(TestCase):
         assert record["provider"]["doi"] == "doi:123"
         
         requests.get = oldget
+    
+    def test_12_dereference_not_found(self):
+        oldget = requests.get
+        requests.get = get_not_found
+        doi = DOIPlugin()
+        
+        record = {"identifier" : {"id" : "10.9999/unregistered", "type" : "doi", "canonical" : "doi:10.9999/unregistered"}}
+        doi.provider_dereference(record)
+        assert "provider" in record
+        assert "url" not in record["provider"]
+        assert record["provider"]["doi"] == "doi:10.9999/unregistered"
+        
+        requests.get = oldget
         
         
         
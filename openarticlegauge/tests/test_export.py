@@ -0,0 +1,95 @@
+from unittest import TestCase
+
+import os, json, gzip, zlib, shutil, tempfile
+from openarticlegauge import export, models
+
+RECORDS = [{"id" : str(i), "title" : "record " + str(i), "license" : [{"type" : "cc-by", "url" : "http://cc/" + str(i)}]} for i in range(1000)]
+SCROLLS = []
+
+def mock_scroll(q=None, page_size=100, keepalive='5m'):
+    SCROLLS.append((q, page_size))
+    for r in RECORDS:
+        yield r
+
+def broken_scroll(q=None, page_size=100, keepalive='5m'):
+    for r in RECORDS[:10]:
+        yield r
+    raise IOError("index went away")
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        global SCROLLS
+        del SCROLLS[:]
+        self.old_scroll = models.Record.scroll
+        models.Record.scroll = staticmethod(mock_scroll)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        models.Record.scroll = self.old_scroll
+        shutil.rmtree(self.dir)
+
+    def _read(self, paths):
+        records = []
+        for path in paths:
+            with gzip.open(path) as f:
+                records += [json.loads(line) for line in f]
+        return records
+
+    def test_01_project(self):
+        record = {"id" : "1", "title" : "t", "identifier" : [{"type" : "doi", "id" : "10.1/a"}],
+                  "license" : [{"type" : "cc-by", "provenance" : {"handler" : "plos", "date" : "now"}}, "not an object"]}
+        assert export.project(record, None) is record
+        assert export.project(record, ["id", "missing"]) == {"id" : "1"}
+        assert export.project(record, ["license.type", "license.provenance.handler"]) == {"license" : [{"type" : "cc-by", "provenance" : {"handler" : "plos"}}]}
+        # asking for a field and one inside it gives the whole field
+        assert export.project(record, ["identifier", "identifier.id"])["identifier"] == record["identifier"]
+
+    def test_02_export(self):
+        stats = export.export(self.dir, "gzip", 10 * 1024 * 1024, page_size=100)
+        assert stats['records'] == 1000
+        assert len(stats['shards']) == 1
+        assert stats['shards'][0] == os.path.join(self.dir, "records-00000.ndjson.gz")
+        assert stats['bytes_after'] == os.path.getsize(stats['shards'][0])
+        assert stats['bytes_after'] < stats['bytes_before']
+        assert self._read(stats['shards']) == RECORDS
+        assert SCROLLS == [(None, 100)]
+
+    def test_03_shards(self):
+        # small shards, so that each page of records goes into a new one
+        stats = export.export(self.dir, "gzip", 1, page_size=100, prefix="test")
+        assert len(stats['shards']) == 10
+        assert stats['shards'][9] == os.path.join(self.dir, "test-00009.ndjson.gz")
+        assert self._read(stats['shards']) == RECORDS
+        assert sorted(os.listdir(self.dir)) == sorted([os.path.basename(p) for p in stats['shards']])
+
+    def test_04_fields_and_query(self):
+        q = export.query_string("license.type:cc-by")
+        stats = export.export(self.dir, "none", fields=["id", "license.type"], q=q)
+        assert stats['shards'][0].endswith(".ndjson")
+        with open(stats['shards'][0]) as f:
+            records = [json.loads(line) for line in f]
+        assert records[5] == {"id" : "5", "license" : [{"type" : "cc-by"}]}
+        assert SCROLLS[0][0] == {'query': {'query_string': {'query': "license.type:cc-by"}}}
+
+    def test_05_compression(self):
+        with self.assertRaises(export.ExportException):
+            export.export(self.dir, "rar")
+        if export.zstandard is None:
+            assert "zstd" not in export.compressions()
+            with self.assertRaises(export.ExportException):
+                export.export(self.dir, "zstd")
+        assert os.listdir(self.dir) == []
+
+    def test_06_interrupted(self):
+        models.Record.scroll = staticmethod(broken_scroll)
+        with self.assertRaises(IOError):
+            export.export(self.dir, "gzip", page_size=5)
+        # the shard which was being written is removed, rather than left looking complete
+        assert os.listdir(self.dir) == []
+
+    def test_07_stream(self):
+        data = "".join(export.stream(["id"], compression="gzip", page_size=100))
+        lines = zlib.decompress(data, 16 + zlib.MAX_WBITS).splitlines()
+        assert len(lines) == 1000
+        assert json.loads(lines[0]) == {"id" : "0"}
@@ -7,8 +7,9 @@
 
 from unittest import TestCase
 
-from openarticlegauge import models, invalidate, config
-import time
+from openarticlegauge import models, invalidate, config, cache, recordmanager
+from copy import deepcopy
+import time, os, json, math, tempfile
 
 bibjson_records = [
     {
@@ -300,3 +301,153 @@ class TestInvalidate(TestCase):
         assert len(six.data['license']) == 1
         assert len(seven.data['license']) == 1
         assert len(eight.data['license']) == 1
+
+
+def _java_hash_mod(s, n):
+    # what the partition filter script does in elastic search: Math.abs(s.hashCode() % n)
+    h = 0
+    for c in s:
+        h = (31 * h + ord(c)) & 0xFFFFFFFF
+    if h >= 0x80000000:
+        h -= 0x100000000
+    return abs(int(math.fmod(h, n)))
+
+class TestInvalidateEngine(TestCase):
+    # does not require elastic search; the scroll, the bulk updates, the storage buffer and the cache are mocked
+    
+    def setUp(self):
+        self.scroll = models.Record.scroll
+        self.bulk_update = models.Record.bulk_update
+        self.buffered = models.Record.buffered
+        self.add_to_buffer = models.Record._add_to_buffer
+        self.bump_generation = cache.bump_generation
+        self.updates = []
+        self.page_sizes = []
+        self.buffer = []
+        self.rebuffered = []
+        self.bumps = []
+        
+        def mock_scroll(cls, q=None, page_size=100, keepalive="5m"):
+            self.page_sizes.append(page_size)
+            # emulate the partition filter, if there is one
+            partition = None
+            for f in q["filter"]["and"]:
+                if "script" in f:
+                    partition = f["script"]["params"]
+            for bj in bibjson_records:
+                if partition is None or _java_hash_mod(bj["id"], partition["partitions"]) == partition["partition"]:
+                    yield deepcopy(bj)
+        
+        def mock_bulk_update(cls, updates, refresh=False):
+            self.updates.append(updates)
+        
+        def mock_buffered(cls):
+            for bj in self.buffer:
+                yield deepcopy(bj)
+        
+        def mock_add_to_buffer(cls, bibjson):
+            self.rebuffered.append(bibjson)
+        
+        def mock_bump_generation(handler=None, handler_version=None, treat_none_as_missing=False, license_type=None):
+            self.bumps.append((license_type, handler, handler_version, treat_none_as_missing))
+            return "global", len(self.bumps)
+        
+        models.Record.scroll = classmethod(mock_scroll)
+        models.Record.bulk_update = classmethod(mock_bulk_update)
+        models.Record.buffered = classmethod(mock_buffered)
+        models.Record._add_to_buffer = classmethod(mock_add_to_buffer)
+        cache.bump_generation = mock_bump_generation
+    
+    def tearDown(self):
+        models.Record.scroll = self.scroll
+        models.Record.bulk_update = self.bulk_update
+        models.Record.buffered = self.buffered
+        models.Record._add_to_buffer = self.add_to_buffer
+        cache.bump_generation = self.bump_generation
+    
+    def test_01_partial_updates_in_pages(self):
+        stats = invalidate.invalidate_license("failed-to-obtain-license", page_size=2)
+        
+        assert self.page_sizes == [2]
+        assert stats["examined"] == len(bibjson_records)
+        assert stats["updated"] == 4
+        assert stats["removed"] == 6
+        
+        # only the changed records are sent back, a page at a time, and only their licences, along
+        # with the time of the last check worked out from the licences which are left
+        assert [len(page) for page in self.updates] == [2, 2]
+        changed = dict([u for page in self.updates for u in page])
+        assert sorted(changed.keys()) == ["111", "222", "333", "444"]
+        assert changed["111"] == {"license" : [], "last_checked" : None}
+        assert [l["type"] for l in changed["333"]["license"]] == ["cc0"]
+        assert invalidate._last_checked([{"provenance" : {"date" : recordmanager.epoch_to_date(1000)}}, {"provenance" : {}}]) == 1000
+        
+        # the cache is invalidated once the archive is done, for the records with that type of licence only
+        assert self.bumps == [("failed-to-obtain-license", None, None, False)]
+    
+    def test_02_nothing_to_change(self):
+        stats = invalidate.invalidate_license("cc-by", page_size=2)
+        assert stats["examined"] == len(bibjson_records)
+        assert stats["updated"] == 0
+        assert self.updates == []
+    
+    def test_03_partitions(self):
+        # the partitions cover all the records between them, without overlap
+        examined = 0
+        for i in range(3):
+            stats = invalidate.invalidate_license("failed-to-obtain-license", partition=(i, 3))
+            examined += stats["examined"]
+        assert examined == len(bibjson_records)
+        
+        # a single partition leaves the buffer and the cache to whoever is running the whole job
+        assert self.bumps == []
+    
+    def test_04_parallel(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint")
+        summary = invalidate.invalidate_parallel("failed-to-obtain-license", processes=2, partitions=3, checkpoint=checkpoint)
+        assert summary["examined"] == len(bibjson_records)
+        assert summary["updated"] == 4
+        assert summary["removed"] == 6
+        assert summary["partitions"] == 3
+        assert summary["skipped_partitions"] == 0
+        
+        # the cache is invalidated once, by the parent
+        assert self.bumps == [("failed-to-obtain-license", None, None, False)]
+        
+        # the checkpoint is removed once the run is complete
+        assert not os.path.exists(checkpoint)
+    
+    def test_05_resume(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint")
+        job = {"license_type" : "failed-to-obtain-license", "handler" : None, "handler_version" : None,
+                "treat_none_as_missing" : False, "partitions" : 2}
+        with open(checkpoint, "w") as f:
+            json.dump({"job" : job, "done" : {"0" : {"examined" : 1, "updated" : 1, "removed" : 1}}}, f)
+        
+        # only the partition which was not complete is done
+        summary = invalidate.invalidate_parallel("failed-to-obtain-license", processes=2, partitions=2, checkpoint=checkpoint)
+        in_partition_1 = [bj for bj in bibjson_records if _java_hash_mod(bj["id"], 2) == 1]
+        assert summary["examined"] == len(in_partition_1)
+        assert summary["partitions"] == 1
+        assert summary["skipped_partitions"] == 1
+    
+    def test_06_resume_different_job(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint")
+        with open(checkpoint, "w") as f:
+            json.dump({"job" : {"license_type" : "cc0"}, "done" : {}}, f)
+        with self.assertRaises(ValueError):
+            invalidate.invalidate_parallel("failed-to-obtain-license", processes=2, checkpoint=checkpoint)
+    
+    def test_07_rate_limit(self):
+        started = time.time()
+        invalidate.invalidate_license("failed-to-obtain-license", rate_limit=40)
+        assert time.time() - started >= (len(bibjson_records) - 1) / 40.0
+    
+    def test_08_buffer(self):
+        self.buffer = [bj for bj in bibjson_records if bj["id"] in ["111", "555"]]
+        stats = invalidate.invalidate_license("failed-to-obtain-license", handler="plugin_a", handler_version="1.0")
+        
+        # only the buffered record which has a matching licence is put back in the buffer, without it
+        assert [bj["id"] for bj in self.rebuffered] == ["111"]
+        assert self.rebuffered[0]["license"] == []
+        assert self.bumps == [("failed-to-obtain-license", "plugin_a", "1.0", False)]
@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from copy import deepcopy
+from openarticlegauge import license_registry, oa_policy
+from openarticlegauge.licenses import LICENSES
+
+class TestLicenseRegistry(TestCase):
+
+    def setUp(self):
+        pass
+        
+    def tearDown(self):
+        pass
+    
+    def test_01_same_as_constructing_by_hand(self):
+        # the way the plugins used to build licences, for licences whose rights are known
+        for lic_type, entry in LICENSES.iteritems():
+            if not all([k in entry for k in ['NC', 'SA', 'ND']]):
+                continue
+            expected = deepcopy(entry)
+            expected['open_access'] = oa_policy.oa_for_license(lic_type)
+            expected.setdefault('version', '')
+            expected.setdefault('description', '')
+            expected.setdefault('jurisdiction', '')
+            expected.update({"url" : "http://licence"})
+            expected['provenance'] = {"handler" : "test"}
+            
+            assert license_registry.build(lic_type, {"url" : "http://licence"}, {"handler" : "test"}) == expected, lic_type
+    
+    def test_02_undecidable_not_open_access(self):
+        assert license_registry.build("afl-3.0")["open_access"] is False
+        assert license_registry.build("cc-by")["open_access"] is True
+    
+    def test_03_templates_not_changed(self):
+        licence = license_registry.build("cc-by", {"version" : "3.0"})
+        licence["title"] = "changed"
+        licence["open_access"] = False
+        
+        again = license_registry.build("cc-by")
+        assert again["title"] == LICENSES["cc-by"]["title"]
+        assert again["open_access"]
+        assert again["version"] == ""
+        assert "provenance" not in again
+        assert "open_access" not in LICENSES["cc-by"]
+    
+    def test_04_unknown(self):
+        with self.assertRaises(KeyError):
+            license_registry.build("should_not_exist")
@@ -0,0 +1,102 @@
+from unittest import TestCase
+
+import threading, time
+from openarticlegauge.lrucache import LRUCache
+
+class TestLRUCache(TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_01_get_set(self):
+        c = LRUCache(10, 60)
+        assert c.get("a") is None
+        assert c.get("a", "default") == "default"
+        c.set("a", 1)
+        assert c.get("a") == 1
+        assert c.hits == 1
+        assert c.misses == 2
+
+        c.invalidate("a")
+        assert c.get("a") is None
+        c.set("a", 1)
+        c.clear()
+        assert len(c) == 0
+
+    def test_02_timeout(self):
+        c = LRUCache(10, 1)
+        c.set("a", 1)
+        time.sleep(1.1)
+        assert c.get("a") is None
+        assert len(c) == 0
+
+    def test_03_eviction(self):
+        c = LRUCache(2, 60)
+        c.set("a", 1)
+        c.set("b", 2)
+
+        # using "a" makes "b" the least recently used
+        c.get("a")
+        c.set("c", 3)
+        assert c.get("b") is None
+        assert c.get("a") == 1
+        assert c.get("c") == 3
+        assert len(c) == 2
+
+    def test_04_get_or_compute(self):
+        c = LRUCache(10, 60)
+        calls = []
+        def compute():
+            calls.append(1)
+            return "value"
+        assert c.get_or_compute("a", compute) == "value"
+        assert c.get_or_compute("a", compute) == "value"
+        assert len(calls) == 1
+
+        # failures are not cached
+        def broken():
+            raise ValueError("broken")
+        with self.assertRaises(ValueError):
+            c.get_or_compute("b", broken)
+        assert c.get_or_compute("b", compute) == "value"
+
+    def test_05_concurrent_compute_collapsed(self):
+        c = LRUCache(10, 60)
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.5)
+            return "value"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(c.get_or_compute("a", compute))) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(calls) == 1
+        assert results == ["value"] * 5
+
+    def test_06_max_bytes(self):
+        c = LRUCache(10, 60, max_bytes=100)
+        c.set("a", 1, 40)
+        c.set("b", 2, 40)
+        assert c.bytes == 80
+        c.set("c", 3, 40)
+        assert c.get("a") is None
+        assert c.bytes == 80
+
+        # replacing or removing an entry gives back its bytes
+        c.set("b", 2, 10)
+        assert c.bytes == 50
+        c.invalidate("c")
+        assert c.bytes == 10
+
+        # an entry bigger than the whole cache is not kept
+        c.set("d", 4, 200)
+        assert c.get("d") is None
+        assert c.bytes == 0
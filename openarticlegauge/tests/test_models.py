@@ -403,3 +403,59 @@ class TestWorkflow(TestCase):
         result3 = models.flush_buffer()
         assert result3
         
+    
+    def test_16_resultset_etag(self):
+        def licensed(id, date):
+            return {
+                "identifier" : {"id" : id, "type" : "doi", "canonical" : "doi:" + id},
+                "bibjson" : {"license" : [{"type" : "cc-by", "provenance" : {"date" : date}}]}
+            }
+        
+        rs = models.ResultSet([{"id" : "1"}, {"id" : "2"}])
+        rs.add_result_record(licensed("1", "2013-02-21T11:07:18Z"))
+        rs.add_result_record({"identifier" : {"id" : "2", "type" : "doi", "canonical" : "doi:2"}, "queued" : True})
+        
+        # the same results give the same tag
+        same = models.ResultSet([{"id" : "1"}, {"id" : "2"}])
+        same.add_result_record(licensed("1", "2013-02-21T11:07:18Z"))
+        same.add_result_record({"identifier" : {"id" : "2", "type" : "doi", "canonical" : "doi:2"}, "queued" : True})
+        assert rs.etag() == same.etag()
+        
+        # a re-checked licence, or a change in what is still processing, changes it
+        rechecked = models.ResultSet([{"id" : "1"}, {"id" : "2"}])
+        rechecked.add_result_record(licensed("1", "2013-03-21T11:07:18Z"))
+        rechecked.add_result_record({"identifier" : {"id" : "2", "type" : "doi", "canonical" : "doi:2"}, "queued" : True})
+        assert rechecked.etag() != rs.etag()
+        
+        done = models.ResultSet([{"id" : "1"}, {"id" : "2"}])
+        done.add_result_record(licensed("1", "2013-02-21T11:07:18Z"))
+        done.add_result_record(licensed("2", "2013-02-21T11:07:18Z"))
+        assert done.etag() != rs.etag()
+    
+    def test_17_resultset_max_age(self):
+        def checked(id, last_checked, stale=False):
+            return {
+                "identifier" : {"id" : id, "type" : "doi", "canonical" : "doi:" + id},
+                "bibjson" : {"last_checked" : last_checked, "license" : [{"type" : "cc-by"}]},
+                "stale" : stale
+            }
+        
+        # fresh results may be kept until the first of them goes stale, up to the maximum
+        now = int(time.time())
+        rs = models.ResultSet([{"id" : "1"}, {"id" : "2"}])
+        rs.add_result_record(checked("1", now))
+        rs.add_result_record(checked("2", now - config.licence_stale_time + 600))
+        assert 590 <= rs.max_age() <= 600
+        
+        rs = models.ResultSet([{"id" : "1"}])
+        rs.add_result_record(checked("1", now))
+        assert rs.max_age() == config.LOOKUP_MAX_AGE
+        
+        # but not if anything is stale or still processing
+        rs.add_result_record(checked("2", now, stale=True))
+        assert rs.max_age() == 0
+        
+        rs = models.ResultSet([{"id" : "1"}, {"id" : "2"}])
+        rs.add_result_record(checked("1", now))
+        rs.add_result_record({"identifier" : {"id" : "2", "type" : "doi", "canonical" : "doi:2"}, "queued" : True})
+        assert rs.max_age() == 0
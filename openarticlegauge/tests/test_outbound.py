@@ -0,0 +1,227 @@
+from unittest import TestCase
+
+import redis, requests, time
+from openarticlegauge import config, outbound, workflow, plugin, cache
+
+test_host = "localhost"
+test_port = 6379
+test_db = 3
+
+HOSTS = ["publisher.example.com", "dx.doi.org", "slow.example.com"]
+REQUESTS = []
+
+class MockResponse():
+    def __init__(self, url, status=200, location=None):
+        self.url = url
+        self.status_code = status
+        self.headers = {} if location is None else {"location" : location}
+        self.text = ""
+
+def mock_get(url, *args, **kwargs):
+    REQUESTS.append((url, kwargs.get("timeout")))
+    if url == "http://dx.doi.org/10.1/a":
+        return MockResponse(url, 303, "http://publisher.example.com/a")
+    if url.startswith("http://publisher.example.com/broken"):
+        return MockResponse(url, 503)
+    if url.startswith("http://publisher.example.com/down"):
+        raise requests.exceptions.ConnectionError("connection refused")
+    if url.startswith("http://slow.example.com/hang"):
+        raise requests.exceptions.Timeout("timed out")
+    return MockResponse(url)
+
+class MockPlugin(plugin.Plugin):
+    _short_name = "mock"
+    def license_detect(self, record):
+        outbound.get("http://publisher.example.com/a")
+
+class TimeoutPlugin(plugin.Plugin):
+    _short_name = "timeout"
+    def license_detect(self, record):
+        outbound.get("http://slow.example.com/hang")
+
+class TestOutbound(TestCase):
+
+    def setUp(self):
+        config.REDIS_CACHE_HOST = test_host
+        config.REDIS_CACHE_PORT = test_port
+        config.REDIS_CACHE_DB = test_db
+        self.client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+        self.old_get = requests.get
+        requests.get = mock_get
+        del REQUESTS[:]
+
+    def tearDown(self):
+        requests.get = self.old_get
+        self.client.delete(outbound.BREAKERS_KEY, *[outbound.BREAKER_PREFIX + h for h in HOSTS])
+
+    def _open(self, host, seconds=100):
+        self.client.hmset(outbound.BREAKER_PREFIX + host, {"failures" : config.BREAKER_FAILURES, "opened_until" : int(time.time()) + seconds})
+        self.client.sadd(outbound.BREAKERS_KEY, host)
+
+    def test_01_timeouts(self):
+        old_timeouts = config.HTTP_HOST_TIMEOUTS
+        config.HTTP_HOST_TIMEOUTS = {"example.com" : 5, "slow.example.com" : 40}
+        try:
+            assert outbound.timeout("dx.doi.org") == config.HTTP_TIMEOUT
+            assert outbound.timeout("publisher.example.com") == 5
+            assert outbound.timeout("slow.example.com") == 40
+
+            # the plugin's budget cuts the timeouts down as it runs out, and then stops the requests
+            old_budgets = config.PLUGIN_TIME_BUDGETS
+            config.PLUGIN_TIME_BUDGETS = {"mock" : 1}
+            try:
+                with outbound.budget("mock"):
+                    assert outbound.timeout("slow.example.com") <= 1
+                    time.sleep(1.05)
+                    with self.assertRaises(requests.exceptions.Timeout):
+                        outbound.get("http://slow.example.com/a")
+                assert outbound.timeout("slow.example.com") == 40
+            finally:
+                config.PLUGIN_TIME_BUDGETS = old_budgets
+        finally:
+            config.HTTP_HOST_TIMEOUTS = old_timeouts
+        assert REQUESTS == []
+
+    def test_02_redirects(self):
+        resp = outbound.get("http://dx.doi.org/10.1/a")
+        assert resp.url == "http://publisher.example.com/a"
+        assert [r.url for r in resp.history] == ["http://dx.doi.org/10.1/a"]
+        assert [u for u, t in REQUESTS] == ["http://dx.doi.org/10.1/a", "http://publisher.example.com/a"]
+        assert all([t == config.HTTP_TIMEOUT for u, t in REQUESTS])
+
+        assert outbound.get("http://dx.doi.org/10.1/a", allow_redirects=False).status_code == 303
+
+        # each host in the chain has its own breaker
+        self._open("publisher.example.com")
+        with self.assertRaises(outbound.HostUnavailableException):
+            outbound.get("http://dx.doi.org/10.1/a")
+
+    def test_03_breaker_opens(self):
+        for i in range(config.BREAKER_FAILURES - 1):
+            outbound.get("http://publisher.example.com/broken")
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            outbound.get("http://publisher.example.com/down")
+        assert outbound.breakers()["publisher.example.com"]["state"] == "open"
+
+        # no more requests are made to the host, but others are unaffected
+        del REQUESTS[:]
+        with self.assertRaises(outbound.HostUnavailableException) as cm:
+            outbound.get("http://publisher.example.com/a")
+        assert 0 < cm.exception.retry_after <= config.BREAKER_OPEN_TIME
+        outbound.get("http://slow.example.com/a")
+        assert [u for u, t in REQUESTS] == ["http://slow.example.com/a"]
+
+    def test_04_success_resets(self):
+        for i in range(config.BREAKER_FAILURES - 1):
+            outbound.get("http://publisher.example.com/broken")
+        assert outbound.breakers()["publisher.example.com"] == {"state" : "closed", "failures" : config.BREAKER_FAILURES - 1}
+        outbound.get("http://publisher.example.com/a")
+        assert outbound.breakers() == {}
+        assert not self.client.sismember(outbound.BREAKERS_KEY, "publisher.example.com")
+
+    def test_05_half_open(self):
+        # once the breaker has been open for long enough, requests are let through again
+        self._open("publisher.example.com", -1)
+        assert outbound.breakers()["publisher.example.com"]["state"] == "half-open"
+
+        # and a single failure opens it again
+        outbound.get("http://publisher.example.com/broken")
+        assert outbound.breakers()["publisher.example.com"]["state"] == "open"
+
+        # whereas a success closes it
+        self._open("publisher.example.com", -1)
+        outbound.get("http://publisher.example.com/a")
+        assert "publisher.example.com" not in outbound.breakers()
+
+    def test_06_slow(self):
+        old_slow = config.BREAKER_SLOW_RESPONSE
+        config.BREAKER_SLOW_RESPONSE = -1
+        try:
+            for i in range(config.BREAKER_FAILURES):
+                outbound.get("http://slow.example.com/a")
+        finally:
+            config.BREAKER_SLOW_RESPONSE = old_slow
+        assert outbound.breakers()["slow.example.com"]["state"] == "open"
+
+    def test_07_deferred(self):
+        old_license_detect = plugin.PluginFactory.license_detect
+        old_retry = workflow.provider_licence.retry
+        plugin.PluginFactory.license_detect = classmethod(lambda cls, provider: MockPlugin())
+        retries = []
+        def mock_retry(**kwargs):
+            retries.append(kwargs)
+            return Exception("retry")
+        workflow.provider_licence.retry = mock_retry
+        self._open("publisher.example.com")
+        record = {"identifier" : {"id" : "10.1/a", "type" : "doi", "canonical" : "doi:10.1/a"}, "provider" : {"url" : ["http://publisher.example.com/a"]}}
+        try:
+            # in a worker, the task is run again once the breaker is due to close
+            workflow.provider_licence.push_request(called_directly=False, retries=0)
+            try:
+                with self.assertRaises(Exception):
+                    workflow.provider_licence.run(record)
+            finally:
+                workflow.provider_licence.pop_request()
+            assert len(retries) == 1
+            assert 0 < retries[0]["countdown"] <= config.BREAKER_OPEN_TIME * 1.1
+            assert retries[0]["args"] == [record]
+            assert "license" not in record["bibjson"]
+
+            # until it has been put off too many times
+            workflow.provider_licence.push_request(called_directly=False, retries=config.BREAKER_MAX_DEFERRALS)
+            try:
+                result = workflow.provider_licence.run(record)
+            finally:
+                workflow.provider_licence.pop_request()
+            assert len(retries) == 1
+            assert result["failure"] == "unavailable"
+            assert "publisher.example.com" in result["error"]
+            assert "license" not in result["bibjson"]
+        finally:
+            plugin.PluginFactory.license_detect = old_license_detect
+            workflow.provider_licence.retry = old_retry
+
+        # outside a worker, it fails straight away
+        record = {"identifier" : {"id" : "10.1/a", "type" : "doi", "canonical" : "doi:10.1/a"}, "provider" : {"url" : ["http://publisher.example.com/a"]}}
+        plugin.PluginFactory.license_detect = classmethod(lambda cls, provider: MockPlugin())
+        try:
+            assert workflow.provider_licence(record)["failure"] == "unavailable"
+        finally:
+            plugin.PluginFactory.license_detect = old_license_detect
+        assert REQUESTS == []
+
+    def test_08_budget_timeout(self):
+        # a timeout cut short by the plugin's budget is not held against the host
+        old_budgets = config.PLUGIN_TIME_BUDGETS
+        config.PLUGIN_TIME_BUDGETS = {"mock" : 1}
+        try:
+            with outbound.budget("mock"):
+                with self.assertRaises(requests.exceptions.Timeout):
+                    outbound.get("http://slow.example.com/hang")
+        finally:
+            config.PLUGIN_TIME_BUDGETS = old_budgets
+        assert "slow.example.com" not in outbound.breakers()
+
+        # whereas one which had the host's full timeout is
+        with self.assertRaises(requests.exceptions.Timeout):
+            outbound.get("http://slow.example.com/hang")
+        assert outbound.breakers()["slow.example.com"]["failures"] == 1
+
+    def test_09_request_failed(self):
+        old_license_detect = plugin.PluginFactory.license_detect
+        plugin.PluginFactory.license_detect = classmethod(lambda cls, provider: TimeoutPlugin())
+        record = {"identifier" : {"id" : "10.1/b", "type" : "doi", "canonical" : "doi:10.1/b"}, "provider" : {"url" : ["http://slow.example.com/b"]}}
+        try:
+            assert workflow._claim(record)
+            result = workflow.provider_licence(record)
+            assert result["failure"] == "unavailable"
+            assert "license" not in result["bibjson"]
+
+            # the failure is remembered for a while, and the identifier can be claimed again
+            workflow.store_results(result)
+            assert cache.check_negative("doi:10.1/b")["failure"] == "unavailable"
+            assert cache.claim("doi:10.1/b") is not None
+        finally:
+            plugin.PluginFactory.license_detect = old_license_detect
+            self.client.delete(cache.NEGATIVE_PREFIX + "doi:10.1/b", cache.CLAIM_PREFIX + "doi:10.1/b")
+            self.client.zrem(cache.INFLIGHT_KEY, "doi:10.1/b")
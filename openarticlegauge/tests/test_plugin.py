@@ -22,6 +22,10 @@ class ProviderPlugin(plugin.Plugin):
     def license_detect(self, record):
         record['bibjson'] = {"license" : {"url" : "http://license"}}
 
+class VersionedPlugin(ProviderPlugin):
+    _short_name = "versioned"
+    __version__ = "1.2"
+
 class TestPlugin(TestCase):
 
     def setUp(self):
@@ -107,3 +111,14 @@ class TestPlugin(TestCase):
         assert p is None
         
         
+    
+    def test_07_handler_versions(self):
+        config.type_detection = ["openarticlegauge.tests.test_plugin.DetectPlugin"]
+        config.canonicalisers = {}
+        config.provider_detection = {"mine" : ["openarticlegauge.tests.test_plugin.ProviderPlugin"]}
+        config.license_detection = [
+            "openarticlegauge.tests.test_plugin.VersionedPlugin",
+            "openarticlegauge.tests.test_plugin.NoSuchPlugin"
+        ]
+        versions = plugin.PluginFactory.handler_versions()
+        assert versions == {"vanilla_plugin" : "0.0", "versioned" : "1.2"}
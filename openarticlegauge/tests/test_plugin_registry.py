@@ -0,0 +1,145 @@
+from unittest import TestCase
+
+import os, redis, shutil, signal, tempfile, threading, time
+from openarticlegauge import config, plugin, plugin_registry
+
+test_host = "localhost"
+test_port = 6379
+test_db = 3
+
+PUBLISHER = '''
+from openarticlegauge import plugin
+
+class PublisherPlugin(plugin.Plugin):
+    _short_name = __name__.split('.')[-1]
+    __version__ = "%s"
+
+    def capabilities(self):
+        return {"license_detect" : True}
+
+    def supports(self, provider):
+        return "http://publisher" in provider.get("url", [])
+
+class NotAPlugin(object):
+    pass
+'''
+
+class ListedPlugin(plugin.Plugin):
+    _short_name = "listed"
+    __version__ = "1.0"
+
+    def capabilities(self):
+        return {"license_detect" : True}
+
+    def supports(self, provider):
+        return "http://listed" in provider.get("url", [])
+
+class CatchAllPlugin(plugin.Plugin):
+    _short_name = "catch_all"
+
+    def capabilities(self):
+        return {"license_detect" : True, "catch_all" : True}
+
+    def supports(self, provider):
+        return True
+
+class TestPluginRegistry(TestCase):
+
+    def setUp(self):
+        config.REDIS_CACHE_HOST = test_host
+        config.REDIS_CACHE_PORT = test_port
+        config.REDIS_CACHE_DB = test_db
+        self.client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+        self.client.delete(plugin_registry.VERSION_KEY)
+
+        self.dir = tempfile.mkdtemp()
+        self.old = (config.license_detection, config.PLUGIN_DIRECTORIES)
+        config.license_detection = [
+            "openarticlegauge.tests.test_plugin_registry.CatchAllPlugin",
+            "openarticlegauge.tests.test_plugin_registry.ListedPlugin"
+        ]
+        config.PLUGIN_DIRECTORIES = [self.dir]
+        self._write("1.0")
+
+    def tearDown(self):
+        config.license_detection, config.PLUGIN_DIRECTORIES = self.old
+        shutil.rmtree(self.dir)
+        self.client.delete(plugin_registry.VERSION_KEY)
+        plugin_registry._published = 0
+        plugin_registry._reload_signalled = False
+
+    def _write(self, version):
+        with open(os.path.join(self.dir, "publisher.py"), "w") as f:
+            f.write(PUBLISHER % version)
+        # so that the rewritten module isn't mistaken for the compiled old one
+        if os.path.exists(os.path.join(self.dir, "publisher.pyc")):
+            os.remove(os.path.join(self.dir, "publisher.pyc"))
+
+    def test_01_build(self):
+        registry = plugin_registry.build()
+        # the plugins in config come first, then those discovered, then the catch-alls
+        assert [k._short_name for k in registry.license_detection] == ["listed", "publisher", "catch_all"]
+        assert registry.handler_versions["publisher"] == "1.0"
+        assert registry.handler_versions["listed"] == "1.0"
+        assert registry.version == 0
+
+        description = registry.describe()
+        assert description["license_detection"] == ["listed", "publisher", "catch_all"]
+        assert description["version"] == 0
+        assert description["handler_versions"]["publisher"] == "1.0"
+
+    def test_02_factory(self):
+        p = plugin.PluginFactory.license_detect({"url" : ["http://publisher"]})
+        assert p._short_name == "publisher"
+        assert plugin.PluginFactory.license_detect({"url" : ["http://anything"]})._short_name == "catch_all"
+        assert plugin.PluginFactory.canonicalise("no such type") is None
+
+        # changes to the lists in config are picked up
+        config.license_detection = ["openarticlegauge.tests.test_plugin_registry.ListedPlugin"]
+        assert plugin.PluginFactory.license_detect({"url" : ["http://anything"]}) is None
+
+    def test_03_bump(self):
+        registry = plugin_registry.current()
+        self._write("2.0")
+        assert plugin_registry.current() is registry
+
+        # a bump reaches this process through the listener
+        plugin_registry.watch()
+        version = plugin_registry.bump()
+        for i in range(50):
+            if plugin_registry._published >= version:
+                break
+            time.sleep(0.02)
+        new = plugin_registry.current()
+        assert new is not registry
+        assert new.version == version
+        assert plugin.PluginFactory.handler_versions()["publisher"] == "2.0"
+
+    def test_04_pinned(self):
+        plugin_registry.pin()
+        try:
+            registry = plugin_registry.current()
+            self._write("2.0")
+            plugin_registry._published = plugin_registry.bump()
+
+            # a task or request which is already running keeps the plugins it started with
+            assert plugin_registry.current() is registry
+            assert plugin.PluginFactory.handler_versions()["publisher"] == "1.0"
+        finally:
+            plugin_registry.unpin()
+
+        # as do other threads, while it is running
+        seen = []
+        t = threading.Thread(target=lambda: seen.append(plugin_registry.current()))
+        t.start()
+        t.join()
+        assert seen[0] is not registry
+        assert plugin.PluginFactory.handler_versions()["publisher"] == "2.0"
+
+    def test_05_signal(self):
+        plugin_registry.watch()
+        registry = plugin_registry.current()
+        self._write("2.0")
+        os.kill(os.getpid(), getattr(signal, config.PLUGIN_RELOAD_SIGNAL))
+        assert plugin_registry.current() is not registry
+        assert plugin.PluginFactory.handler_versions()["publisher"] == "2.0"
@@ -52,7 +52,7 @@ class MockResponse():
         self.text = None
         self.url = None
         
-def get_doi(url):
+def get_doi(url, *args, **kwargs):
     resp = MockResponse(200)
     if url == "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=23175652&retmode=xml":
         with open(ENTREZ_FILE) as f:
@@ -61,7 +61,7 @@ def get_doi(url):
         resp.url = "http://jb.asm.org/content/195/3/502"
     return resp
 
-def get_icon(url):
+def get_icon(url, *args, **kwargs):
     resp = MockResponse(200)
     if url == "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=23175652&retmode=xml":
         resp.text = ""
@@ -70,7 +70,7 @@ def get_icon(url):
             resp.text = f.read()
     return resp
 
-def get_linkout(url):
+def get_linkout(url, *args, **kwargs):
     resp = MockResponse(200)
     if url == "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=1234567&retmode=xml":
         resp.text = ""
@@ -1,5 +1,6 @@
 from unittest import TestCase
 from openarticlegauge import recordmanager
+import time
 
 class TestRecordManager(TestCase):
 
@@ -27,3 +28,48 @@ class TestRecordManager(TestCase):
         urls.sort()
         record["provider"]["url"].sort()
         assert urls == record["provider"]["url"]
+    
+    def test_03_add_license_last_checked(self):
+        record = {}
+        recordmanager.add_license(record, type="cc-by", date="2013-02-21T11:07:18Z")
+        assert record["bibjson"]["last_checked"] == recordmanager.date_to_epoch("2013-02-21T11:07:18Z")
+        
+        # an older licence does not move the timestamp backwards
+        recordmanager.add_license(record, type="cc-by", date="2012-02-21T11:07:18Z")
+        assert record["bibjson"]["last_checked"] == recordmanager.date_to_epoch("2013-02-21T11:07:18Z")
+        
+        # no date means now, not the time the module was loaded
+        recordmanager.add_license(record, type="cc-by")
+        assert abs(record["bibjson"]["last_checked"] - time.time()) < 5
+        assert record["bibjson"]["license"][2]["provenance"]["date"] is not None
+    
+    def test_04_set_last_checked(self):
+        record = {}
+        recordmanager.set_last_checked(record, 1234.5)
+        assert record["bibjson"]["last_checked"] == 1234
+        
+        recordmanager.set_last_checked(record)
+        assert abs(record["bibjson"]["last_checked"] - time.time()) < 5
+    
+    def test_05_compute_last_checked(self):
+        bibjson = {"license" : [
+            {"provenance" : {"date" : "2012-02-21T11:07:18Z"}},
+            {"provenance" : {"date" : "2013-02-21T11:07:18Z"}},
+            {"provenance" : {"date" : "wibble"}},
+            {"provenance" : {}},
+            {}
+        ]}
+        assert recordmanager.compute_last_checked(bibjson) == recordmanager.date_to_epoch("2013-02-21T11:07:18Z")
+        assert recordmanager.compute_last_checked({"license" : [{}]}) is None
+        assert recordmanager.compute_last_checked({}) is None
+    
+    def test_06_latest_license(self):
+        bibjson = {"license" : [
+            {"type" : "a", "provenance" : {"date" : "2013-02-21T11:07:18Z"}},
+            {"type" : "b", "provenance" : {"date" : "2012-02-21T11:07:18Z"}},
+            {"type" : "c", "provenance" : {"date" : "2013-02-21T11:07:18Z"}}
+        ]}
+        assert recordmanager.latest_license(bibjson)["type"] == "c"
+        assert recordmanager.latest_license({"license" : [{"type" : "a"}, {"type" : "b"}]})["type"] == "b"
+        assert recordmanager.latest_license({"license" : []}) is None
+        assert recordmanager.latest_license({}) is None
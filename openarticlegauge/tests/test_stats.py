@@ -0,0 +1,97 @@
+from unittest import TestCase
+
+import redis, time
+from openarticlegauge import config, stats, models
+
+test_host = "localhost"
+test_port = 6379
+test_db = 3 # as for the cache tests
+
+def bibjson(id, licence_type, handler="plos", version="0.1", date="2013-02-21T11:07:18Z", open_access=True):
+    return {"id" : id, "license" : [{
+        "type" : licence_type,
+        "open_access" : open_access,
+        "provenance" : {
+            "handler" : handler,
+            "handler_version" : version,
+            "date" : date,
+            "source" : "http://www.plosone.org/article/" + id
+        }
+    }]}
+
+class TestStats(TestCase):
+
+    def setUp(self):
+        self.host = config.REDIS_STATS_HOST
+        self.port = config.REDIS_STATS_PORT
+        self.db = config.REDIS_STATS_DB
+        config.REDIS_STATS_HOST = test_host
+        config.REDIS_STATS_PORT = test_port
+        config.REDIS_STATS_DB = test_db
+        self.scroll = models.Record.scroll
+        self.buffered = models.Record.buffered
+        
+    def tearDown(self):
+        client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+        client.delete(stats.COUNTS_KEY, stats.RECORDS_KEY, stats.RECONCILED_KEY,
+                        stats.COUNTS_KEY + stats.REBUILD_SUFFIX, stats.RECORDS_KEY + stats.REBUILD_SUFFIX)
+        config.REDIS_STATS_HOST = self.host
+        config.REDIS_STATS_PORT = self.port
+        config.REDIS_STATS_DB = self.db
+        models.Record.scroll = self.scroll
+        models.Record.buffered = self.buffered
+    
+    def test_01_fields(self):
+        f = stats.fields(bibjson("1", "cc-by"))
+        assert "total" in f
+        assert "type:cc-by" in f
+        assert "open_access:true" in f
+        assert "handler_version:plos@0.1" in f
+        assert "handler_type:plos|cc-by" in f
+        assert "host:www.plosone.org" in f
+        assert "day:2013-02-21" in f
+        
+        assert stats.fields({"id" : "2"}) == []
+    
+    def test_02_count(self):
+        stats.count(bibjson("1", "cc-by"))
+        stats.count(bibjson("2", "cc-by"))
+        stats.count(bibjson("3", "failed-to-obtain-license", handler="bmc", open_access=False))
+        
+        s = stats.summary()
+        assert s["total"] == 3
+        assert s["type"] == {"cc-by" : 2, "failed-to-obtain-license" : 1}
+        assert s["open_access"] == {"true" : 2, "false" : 1}
+        assert s["handler_type"] == {"plos" : {"cc-by" : 2}, "bmc" : {"failed-to-obtain-license" : 1}}
+        assert s["handler_version"]["plos"] == {"0.1" : 2}
+        assert s["reconciled"] is None
+        
+        # storing a record again replaces what it was counted as
+        stats.count(bibjson("1", "cc0", version="0.2"))
+        stats.count(bibjson("2", "cc-by"))
+        s = stats.summary()
+        assert s["total"] == 3
+        assert s["type"] == {"cc-by" : 1, "cc0" : 1, "failed-to-obtain-license" : 1}
+        assert s["handler_version"]["plos"] == {"0.1" : 1, "0.2" : 1}
+    
+    def test_03_reconcile(self):
+        # counts which have drifted are put right
+        stats.count(bibjson("gone", "cc-by"))
+        
+        def mock_scroll(cls, q=None, page_size=100, keepalive="5m"):
+            for i in range(3):
+                yield bibjson(str(i), "cc-by")
+        def mock_buffered(cls):
+            yield bibjson("0", "cc0")
+        models.Record.scroll = classmethod(mock_scroll)
+        models.Record.buffered = classmethod(mock_buffered)
+        
+        old_buffering = config.BUFFERING
+        config.BUFFERING = True
+        assert stats.reconcile() == 4
+        config.BUFFERING = old_buffering
+        
+        s = stats.summary()
+        assert s["total"] == 3
+        assert s["type"] == {"cc-by" : 2, "cc0" : 1}
+        assert abs(s["reconciled"] - time.time()) < 5
@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+import os, tempfile
+from openarticlegauge import settings, storage, config
+
+class TestStorage(TestCase):
+
+    def setUp(self):
+        pass
+        
+    def tearDown(self):
+        pass
+    
+    def test_01_settings(self):
+        s = settings.load(os.path.join(tempfile.mkdtemp(), "no_such.cfg"))
+        assert s["ELASTIC_SEARCH_DB"] == config.ELASTIC_SEARCH_DB
+        assert not s.has_key("module_search_list") # only upper case names are settings
+        
+        path = os.path.join(tempfile.mkdtemp(), "app.cfg")
+        with open(path, "w") as f:
+            f.write("ELASTIC_SEARCH_DB = 'other'\nlower_case = 'ignored'\n")
+        s = settings.load(path)
+        assert s["ELASTIC_SEARCH_DB"] == "other"
+        assert not s.has_key("lower_case")
+    
+    def test_02_redis_pools_shared(self):
+        a = storage.redis_client("localhost", 6379, 3)
+        b = storage.redis_client("localhost", 6379, 3)
+        c = storage.redis_client("localhost", 6379, 4)
+        assert a.connection_pool is b.connection_pool
+        assert a.connection_pool is not c.connection_pool
+    
+    def test_03_no_web_app(self):
+        # the storage layer must not need the web application
+        import openarticlegauge.dao, openarticlegauge.models
+        for module in [openarticlegauge.dao, openarticlegauge.models, storage]:
+            assert not hasattr(module, "app")
@@ -13,16 +13,64 @@ There are other tests for working on specific plugins.
 """
 
 from unittest import TestCase
-from openarticlegauge import config, workflow, models, model_exceptions, cache, plugin
+import time
+from openarticlegauge import config, workflow, models, model_exceptions, cache, plugin, stats
+from celery.exceptions import Ignore
 
 __version__ = "1.0"
 
+REAL_IS_STALE = cache.is_stale
+SEVEN_MONTHS_AGO = int(time.time()) - 7 * 2592000
+
 CACHE = {}
 ARCHIVE = []
+NEGATIVE = {}
+CLAIMS = {}
+RENEWED = []
+COUNTED = []
+TIMEOUTS = {}
+BACK_END = []
+PRIORITIES = []
+BACKED_OFF = []
 
-def mock_cache(key, obj):
+def mock_cache(key, obj, timeout=None):
     global CACHE
     CACHE[key] = obj
+    TIMEOUTS[key] = timeout
+
+def mock_check_negative(key):
+    return NEGATIVE.get(key)
+
+def mock_cache_negative(key, failure_class, error):
+    global NEGATIVE
+    NEGATIVE[key] = {"failure" : failure_class, "error" : error}
+
+def mock_claim(key):
+    if key in CLAIMS:
+        return None
+    CLAIMS[key] = "token-" + key
+    return CLAIMS[key]
+
+def mock_renew_claim(key, token):
+    if CLAIMS.get(key, token) != token:
+        return False
+    CLAIMS[key] = token
+    RENEWED.append(key)
+    return True
+
+def mock_count_request(key): pass
+
+def mock_count(bibjson):
+    COUNTED.append(bibjson)
+
+def mock_back_off_sweep(key):
+    BACKED_OFF.append(key)
+
+def mock_release_claim(key, token):
+    if CLAIMS.get(key, token) != token:
+        return False
+    CLAIMS.pop(key, None)
+    return True
 
 @classmethod
 def mock_store(cls, bibjson):
@@ -68,6 +116,13 @@ def mock_is_stale_false(*args, **kwargs): return False
 
 def mock_null_cache(key): return None
 
+def mock_stale_cache(key):
+    return {"identifier" : {"id" : "10.stale", "type" : "doi", "canonical" : "doi:10.stale"}, "bibjson" : {"title" : "stale", "license" : [{}], "last_checked" : SEVEN_MONTHS_AGO}}
+
+@classmethod
+def mock_stale_archive(cls, key):
+    return {"title" : "stale archive", "license" : [{}], "last_checked" : SEVEN_MONTHS_AGO}
+
 @classmethod
 def mock_check_archive(cls, key):
     if key == "doi:10.none": return None
@@ -107,12 +162,20 @@ class mock_unknown_licence_plugin(plugin.Plugin):
     def license_detect(self, record):
         record['bibjson'] = {}
 
-def mock_back_end(record): pass
+def mock_back_end(record, priority=None): pass
+
+def mock_record_back_end(record, priority=None):
+    BACK_END.append(record['identifier']['canonical'])
+    PRIORITIES.append(priority)
+
+def mock_broken_back_end(record, priority=None):
+    raise IOError("broker unavailable")
 
 def mock_is_stale(bibjson):
     return bibjson["title"] == "stale"
     
-def mock_invalidate(key): pass
+def mock_invalidate(key):
+    CACHE.pop(key, None)
 
 def one(): return "one"
 def two(): return "two"
@@ -140,7 +203,53 @@ class TestWorkflow(TestCase):
         config.module_search_list.append("openarticlegauge.tests.test_workflow")
         current_support_request = 0
         
+        # the negative cache is always mocked out
+        self.check_negative = cache.check_negative
+        self.cache_negative = cache.cache_negative
+        cache.check_negative = mock_check_negative
+        cache.cache_negative = mock_cache_negative
+        NEGATIVE.clear()
+        
+        # as are processing claims
+        self.claim = cache.claim
+        self.renew_claim = cache.renew_claim
+        self.release_claim = cache.release_claim
+        cache.claim = mock_claim
+        cache.renew_claim = mock_renew_claim
+        cache.release_claim = mock_release_claim
+        CLAIMS.clear()
+        del RENEWED[:]
+        
+        # and request counting
+        self.count_request = cache.count_request
+        cache.count_request = mock_count_request
+        
+        # and the licence statistics
+        self.count = stats.count
+        stats.count = mock_count
+        del COUNTED[:]
+        
+        # and the sweeper's back-offs
+        self.back_off_sweep = cache.back_off_sweep
+        self.sweep_backed_off = cache.sweep_backed_off
+        cache.back_off_sweep = mock_back_off_sweep
+        cache.sweep_backed_off = lambda: list(BACKED_OFF)
+        del BACKED_OFF[:]
+        del BACK_END[:]
+        del PRIORITIES[:]
+        
     def tearDown(self):
+        cache.check_negative = self.check_negative
+        cache.cache_negative = self.cache_negative
+        NEGATIVE.clear()
+        cache.claim = self.claim
+        cache.renew_claim = self.renew_claim
+        cache.release_claim = self.release_claim
+        cache.count_request = self.count_request
+        stats.count = self.count
+        cache.back_off_sweep = self.back_off_sweep
+        cache.sweep_backed_off = self.sweep_backed_off
+        CLAIMS.clear()
         for i in range(len(config.module_search_list)):
             if config.module_search_list[i] == "tests.test_workflow":
                 del config.module_search_list[i]
@@ -456,6 +565,7 @@ class TestWorkflow(TestCase):
         assert "license" in record['bibjson']
         assert record['bibjson']['license'][0]['type'] == "failed-to-obtain-license"
         assert "identifier" in record["bibjson"]
+        assert "last_checked" in record["bibjson"]
         
         del CACHE['doi:10.1']
         del ARCHIVE[0]
@@ -522,3 +632,486 @@ class TestWorkflow(TestCase):
         
         
         
+    
+    def test_15_negative_cache_raw(self):
+        config.type_detection = ["mock_doi_type", "mock_pmid_type"]
+        config.canonicalisers = {"doi" : "mock_doi_canon", "pmid" : "mock_pmid_canon"}
+        
+        # an identifier of unknown type is an error, and is remembered
+        rs = workflow.lookup([{"id" : "abcd"}])
+        assert len(rs.errors) == 1
+        assert NEGATIVE["raw::abcd"]["failure"] == "unknown_type"
+        
+        # an identifier which fails validation is remembered under the type it was supplied with
+        rs = workflow.lookup([{"id" : "12345", "type" : "doi"}])
+        assert len(rs.errors) == 1
+        assert NEGATIVE["raw:doi:12345"]["failure"] == "invalid_identifier"
+        
+        # the second time round, the answer comes from the negative cache without
+        # any type detection being done
+        config.type_detection = []
+        rs = workflow.lookup([{"id" : "abcd"}])
+        assert len(rs.errors) == 1
+        assert rs.errors[0]["error"] == NEGATIVE["raw::abcd"]["error"]
+        assert not rs.errors[0]["identifier"].has_key("type")
+        
+        # whatever the client sends is an error for that identifier, not for the whole request
+        config.type_detection = ["mock_doi_type", "mock_pmid_type"]
+        rs = workflow.lookup([{"id" : 12345}, {"id" : "efgh", "type" : None}])
+        assert len(rs.errors) == 2
+        assert rs.errors[0]["error"] == "the identifier must be a string"
+        assert NEGATIVE["raw::12345"]["failure"] == "unknown_type"
+        assert NEGATIVE["raw::efgh"]["failure"] == "unknown_type"
+    
+    def test_16_negative_cache_canonical(self):
+        config.type_detection = ["mock_doi_type", "mock_pmid_type"]
+        config.canonicalisers = {"doi" : "mock_doi_canon", "pmid" : "mock_pmid_canon"}
+        cache.check_cache = mock_queue_cache
+        NEGATIVE["doi:10.unresolvable"] = {"failure" : "unresolvable", "error" : "unable to resolve"}
+        
+        rs = workflow.lookup([{"id" : "10.unresolvable"}])
+        assert len(rs.errors) == 1
+        assert len(rs.processing) == 0
+        assert rs.errors[0]["error"] == "unable to resolve"
+        assert rs.errors[0]["identifier"]["canonical"] == "doi:10.unresolvable"
+    
+    def test_17_unresolvable_not_stored(self):
+        global CACHE
+        global ARCHIVE
+        
+        cache.cache = mock_cache
+        cache.invalidate = mock_invalidate
+        models.Record.store = mock_store
+        config.provider_detection = {"doi" : ["mock_no_provider"]}
+        
+        record = {'identifier' : {"id" : "10.1", "type" : "doi", "canonical" : "doi:10.1"}, "queued" : True}
+        record = workflow.detect_provider(record)
+        assert record.has_key("error")
+        
+        record = workflow.provider_licence(record)
+        record = workflow.store_results(record)
+        
+        assert "queued" not in record
+        assert not CACHE.has_key("doi:10.1")
+        assert len(ARCHIVE) == 0
+        assert NEGATIVE["doi:10.1"]["failure"] == "unresolvable"
+        assert "doi:10.1" not in CLAIMS
+    
+    def test_18_concurrent_lookups_claim(self):
+        config.type_detection = ["mock_doi_type", "mock_pmid_type"]
+        config.canonicalisers = {"doi" : "mock_doi_canon", "pmid" : "mock_pmid_canon"}
+        cache.check_cache = mock_null_cache
+        cache.cache = mock_cache
+        models.Record.check_archive = mock_null_archive
+        old_back_end = workflow._start_back_end
+        workflow._start_back_end = mock_record_back_end
+        
+        # two requests which both miss the cache (as if they arrived together) only
+        # start the processing once, but are both told that the item is processing
+        rs1 = workflow.lookup([{"id" : "10.claimed"}])
+        rs2 = workflow.lookup([{"id" : "10.claimed"}])
+        assert len(rs1.processing) == 1
+        assert len(rs2.processing) == 1
+        assert BACK_END == ["doi:10.claimed"]
+        
+        # once the result has been stored, the identifier can be claimed again
+        models.Record.store = mock_store
+        workflow.store_results({'identifier' : {"id" : "10.claimed", "type" : "doi", "canonical" : "doi:10.claimed"}, "queued" : True, "claim" : CLAIMS["doi:10.claimed"]})
+        assert "doi:10.claimed" not in CLAIMS
+        workflow.lookup([{"id" : "10.claimed"}])
+        assert BACK_END == ["doi:10.claimed", "doi:10.claimed"]
+        
+        del CACHE["doi:10.claimed"]
+        del ARCHIVE[:]
+        workflow._start_back_end = old_back_end
+    
+    def test_19_claim_released_on_back_end_failure(self):
+        config.type_detection = ["mock_doi_type", "mock_pmid_type"]
+        config.canonicalisers = {"doi" : "mock_doi_canon", "pmid" : "mock_pmid_canon"}
+        cache.check_cache = mock_null_cache
+        cache.cache = mock_cache
+        models.Record.check_archive = mock_null_archive
+        old_back_end = workflow._start_back_end
+        workflow._start_back_end = mock_broken_back_end
+        
+        with self.assertRaises(IOError):
+            workflow.lookup([{"id" : "10.broken"}])
+        assert "doi:10.broken" not in CLAIMS
+        
+        del CACHE["doi:10.broken"]
+        workflow._start_back_end = old_back_end
+    
+    def test_20_queued_lease(self):
+        config.type_detection = ["mock_doi_type", "mock_pmid_type"]
+        config.canonicalisers = {"doi" : "mock_doi_canon", "pmid" : "mock_pmid_canon"}
+        config.provider_detection = {"doi" : ["mock_detect_provider"]}
+        config.license_detection = ["mock_licence_plugin"]
+        cache.check_cache = mock_null_cache
+        cache.cache = mock_cache
+        models.Record.check_archive = mock_null_archive
+        models.Record.store = mock_store
+        old_back_end = workflow._start_back_end
+        workflow._start_back_end = mock_back_end
+        
+        # the queued marker is written as a short lease, not for the full cache timeout
+        workflow.lookup([{"id" : "10.lease"}])
+        assert CACHE["doi:10.lease"]["queued"]
+        assert TIMEOUTS["doi:10.lease"] == config.QUEUED_LEASE_TIMEOUT
+        
+        # each stage of the chain renews the lease
+        record = {'identifier' : {"id" : "10.lease", "type" : "doi", "canonical" : "doi:10.lease"}, "queued" : True, "claim" : CLAIMS["doi:10.lease"]}
+        record = workflow.detect_provider(record)
+        record = workflow.provider_licence(record)
+        assert RENEWED == ["doi:10.lease", "doi:10.lease"]
+        assert TIMEOUTS["doi:10.lease"] == config.QUEUED_LEASE_TIMEOUT
+        assert "claim" not in CACHE["doi:10.lease"]
+        
+        # and the final result is cached for the full timeout
+        record = workflow.store_results(record)
+        assert "queued" not in CACHE["doi:10.lease"]
+        assert TIMEOUTS["doi:10.lease"] is None
+        
+        del CACHE["doi:10.lease"]
+        del ARCHIVE[:]
+        workflow._start_back_end = old_back_end
+    
+    def test_21_reap_orphaned_claims(self):
+        old_orphaned = cache.orphaned_claims
+        cache.orphaned_claims = lambda: ["doi:10.orphan"]
+        assert workflow.reap_orphaned_claims() == ["doi:10.orphan"]
+        cache.orphaned_claims = old_orphaned
+    
+    def test_22_get_priority(self):
+        assert workflow.get_priority(1) == "interactive"
+        assert workflow.get_priority(config.INTERACTIVE_MAX_BATCH) == "interactive"
+        assert workflow.get_priority(config.INTERACTIVE_MAX_BATCH + 1) == "bulk"
+        
+        # clients can ask for the bulk lane, but can't jump into the interactive lane with a big batch
+        assert workflow.get_priority(1, "bulk") == "bulk"
+        assert workflow.get_priority(config.INTERACTIVE_MAX_BATCH + 1, "interactive") == "bulk"
+        
+        with self.assertRaises(model_exceptions.LookupException):
+            workflow.get_priority(1, "urgent")
+    
+    def test_23_queue_names(self):
+        assert workflow._queue("detect_provider", "interactive") == "detect_provider"
+        assert workflow._queue("detect_provider", "bulk") == "detect_provider_bulk"
+    
+    def test_24_lookup_priority(self):
+        config.type_detection = ["mock_doi_type", "mock_pmid_type"]
+        config.canonicalisers = {"doi" : "mock_doi_canon", "pmid" : "mock_pmid_canon"}
+        cache.check_cache = mock_null_cache
+        cache.cache = mock_cache
+        models.Record.check_archive = mock_null_archive
+        old_back_end = workflow._start_back_end
+        workflow._start_back_end = mock_record_back_end
+        
+        workflow.lookup([{"id" : "10.single"}])
+        assert PRIORITIES == ["interactive"]
+        
+        del PRIORITIES[:]
+        workflow.lookup([{"id" : "10.batch" + str(i)} for i in range(config.INTERACTIVE_MAX_BATCH + 1)])
+        assert len(PRIORITIES) == config.INTERACTIVE_MAX_BATCH + 1
+        assert set(PRIORITIES) == set(["bulk"])
+        
+        del PRIORITIES[:]
+        workflow.lookup([{"id" : "10.requested"}], "bulk")
+        assert PRIORITIES == ["bulk"]
+        
+        CACHE.clear()
+        workflow._start_back_end = old_back_end
+    
+    def test_25_serve_stale_from_cache(self):
+        config.type_detection = ["mock_doi_type", "mock_pmid_type"]
+        config.canonicalisers = {"doi" : "mock_doi_canon", "pmid" : "mock_pmid_canon"}
+        config.provider_detection = {"doi" : ["mock_detect_provider"]}
+        config.license_detection = ["mock_licence_plugin"]
+        cache.check_cache = mock_stale_cache
+        cache.is_stale = REAL_IS_STALE
+        cache.cache = mock_cache
+        cache.invalidate = mock_invalidate
+        models.Record.store = mock_store
+        old_back_end = workflow._start_back_end
+        workflow._start_back_end = mock_record_back_end
+        
+        # the stale copy is served straight away, flagged as stale, and a refresh is started
+        rs = workflow.lookup([{"id" : "10.stale"}])
+        assert len(rs.results) == 1
+        assert len(rs.processing) == 0
+        assert rs.results[0]["title"] == "stale"
+        assert rs.results[0]["stale"]
+        assert BACK_END == ["doi:10.stale"]
+        
+        # while the refresh is running, the stale copy is served without starting another,
+        # and nothing has been written to the cache
+        rs = workflow.lookup([{"id" : "10.stale"}])
+        assert rs.results[0]["stale"]
+        assert BACK_END == ["doi:10.stale"]
+        assert not CACHE.has_key("doi:10.stale")
+        
+        # when the refresh completes, the fresh record goes into the cache and the claim is released
+        record = {"identifier" : {"id" : "10.stale", "type" : "doi", "canonical" : "doi:10.stale"}, "refresh" : True, "claim" : CLAIMS["doi:10.stale"]}
+        record = workflow.detect_provider(record)
+        assert not CACHE.has_key("doi:10.stale")
+        record = workflow.provider_licence(record)
+        record = workflow.store_results(record)
+        assert "refresh" not in CACHE["doi:10.stale"]
+        assert "stale" not in CACHE["doi:10.stale"]["bibjson"]
+        assert CACHE["doi:10.stale"]["bibjson"]["title"] == "mytitle"
+        assert "doi:10.stale" not in CLAIMS
+        
+        CACHE.clear()
+        del ARCHIVE[:]
+        workflow._start_back_end = old_back_end
+    
+    def test_26_serve_stale_from_archive(self):
+        config.type_detection = ["mock_doi_type", "mock_pmid_type"]
+        config.canonicalisers = {"doi" : "mock_doi_canon", "pmid" : "mock_pmid_canon"}
+        cache.check_cache = mock_null_cache
+        cache.is_stale = REAL_IS_STALE
+        models.Record.check_archive = mock_stale_archive
+        old_back_end = workflow._start_back_end
+        workflow._start_back_end = mock_record_back_end
+        
+        rs = workflow.lookup([{"id" : "10.stale"}])
+        assert len(rs.results) == 1
+        assert rs.results[0]["title"] == "stale archive"
+        assert rs.results[0]["stale"]
+        assert BACK_END == ["doi:10.stale"]
+        
+        # too old to serve, so the client has to wait
+        old_max_age = config.STALE_MAX_AGE
+        config.STALE_MAX_AGE = 3600
+        CLAIMS.clear()
+        rs = workflow.lookup([{"id" : "10.stale"}])
+        assert len(rs.results) == 0
+        assert len(rs.processing) == 1
+        config.STALE_MAX_AGE = old_max_age
+        
+        CACHE.clear()
+        workflow._start_back_end = old_back_end
+    
+    def test_27_failed_refresh_keeps_stale(self):
+        cache.cache = mock_cache
+        cache.invalidate = mock_invalidate
+        models.Record.store = mock_store
+        CACHE["doi:10.stale"] = mock_stale_cache("doi:10.stale")
+        CLAIMS["doi:10.stale"] = "token-doi:10.stale"
+        
+        record = {"identifier" : {"id" : "10.stale", "type" : "doi", "canonical" : "doi:10.stale"}, "refresh" : True, "error" : "unable to resolve", "claim" : "token-doi:10.stale"}
+        record = workflow.store_results(record)
+        assert CACHE["doi:10.stale"]["bibjson"]["title"] == "stale"
+        assert len(NEGATIVE) == 0
+        assert len(ARCHIVE) == 0
+        assert "doi:10.stale" not in CLAIMS
+        assert BACKED_OFF == ["doi:10.stale"]
+        
+        CACHE.clear()
+    
+    def test_28_in_sweep_window(self):
+        old_window = config.SWEEP_WINDOW
+        
+        config.SWEEP_WINDOW = (1, 6)
+        assert workflow._in_sweep_window(1)
+        assert workflow._in_sweep_window(5)
+        assert not workflow._in_sweep_window(6)
+        assert not workflow._in_sweep_window(0)
+        
+        # windows can span midnight
+        config.SWEEP_WINDOW = (22, 2)
+        assert workflow._in_sweep_window(23)
+        assert workflow._in_sweep_window(1)
+        assert not workflow._in_sweep_window(12)
+        
+        config.SWEEP_WINDOW = None
+        assert workflow._in_sweep_window(12)
+        
+        config.SWEEP_WINDOW = old_window
+    
+    def test_29_sweep_stale(self):
+        def archived(n):
+            return {"id" : "doi:10." + n, "identifier" : [{"id" : "10." + n, "type" : "doi", "canonical" : "doi:10." + n}]}
+        
+        queries = []
+        def mock_checked_before(cls, timestamp, size=10, ids=None, exclude=None):
+            queries.append((timestamp, size, ids))
+            if ids is not None:
+                return 1, [archived("popular")]
+            return 25, [archived("old1"), archived("popular"), archived("claimed"), {"id" : "noidentifier"}, archived("old2")]
+        
+        sweep_stats = {}
+        def mock_update_sweep_stats(stats):
+            sweep_stats.update(stats)
+        
+        old_checked_before = models.Record.checked_before
+        old_most_requested = cache.most_requested
+        old_update_sweep_stats = cache.update_sweep_stats
+        old_window = config.SWEEP_WINDOW
+        old_batch_size = config.SWEEP_BATCH_SIZE
+        old_back_end = workflow._start_back_end
+        models.Record.checked_before = classmethod(mock_checked_before)
+        cache.most_requested = lambda n: ["doi:10.popular"]
+        cache.update_sweep_stats = mock_update_sweep_stats
+        workflow._start_back_end = mock_record_back_end
+        config.SWEEP_WINDOW = None
+        config.SWEEP_BATCH_SIZE = 3
+        CLAIMS["doi:10.claimed"] = "token-doi:10.claimed"
+        
+        stats = workflow.sweep_stale()
+        
+        # records which are nearly stale are looked for, popular ones first
+        timestamp, size, ids = queries[0]
+        assert abs(timestamp - (time.time() - config.licence_stale_time + config.SWEEP_LEAD_TIME)) < 5
+        assert ids == ["doi:10.popular"]
+        
+        # each is sent only once, in the bulk lane, skipping any already being processed, up to the batch size
+        assert BACK_END == ["doi:10.popular", "doi:10.old1", "doi:10.old2"], BACK_END
+        assert set(PRIORITIES) == set(["bulk"])
+        assert stats["last_enqueued"] == 3
+        assert stats["last_skipped"] == 2
+        assert stats["backlog"] == 22
+        assert sweep_stats["total_enqueued"] == 3
+        
+        # outside the window, nothing happens
+        del BACK_END[:]
+        config.SWEEP_WINDOW = ((time.gmtime().tm_hour + 1) % 24, (time.gmtime().tm_hour + 2) % 24)
+        stats = workflow.sweep_stale()
+        assert stats["last_status"] == "outside window"
+        assert BACK_END == []
+        
+        models.Record.checked_before = old_checked_before
+        cache.most_requested = old_most_requested
+        cache.update_sweep_stats = old_update_sweep_stats
+        config.SWEEP_WINDOW = old_window
+        config.SWEEP_BATCH_SIZE = old_batch_size
+        workflow._start_back_end = old_back_end
+    
+    def test_30_outdated_handler(self):
+        def bibjson(handler, version):
+            return {"last_checked" : int(time.time()), "license" : [
+                {"type" : "cc-by", "provenance" : {"date" : "2012-02-21T11:07:18Z", "handler" : "plos", "handler_version" : "0.1"}},
+                {"type" : "cc-by", "provenance" : {"date" : "2013-02-21T11:07:18Z", "handler" : handler, "handler_version" : version}}
+            ]}
+        
+        old_versions = plugin.PluginFactory.handler_versions
+        old_obsolete = workflow.OBSOLETE_HANDLER_VERSIONS
+        cache.is_stale = REAL_IS_STALE
+        plugin.PluginFactory.handler_versions = classmethod(lambda cls: {"plos" : "0.2", "bmc" : "0.10"})
+        workflow.OBSOLETE_HANDLER_VERSIONS = set([("bmc", "0.10")])
+        
+        # only the most recent licence counts, and versions are compared as versions, not strings
+        assert workflow._is_stale(bibjson("plos", "0.1"))
+        assert not workflow._is_stale(bibjson("plos", "0.2"))
+        assert not workflow._is_stale(bibjson("plos", "0.3"))
+        assert workflow._is_stale(bibjson("bmc", "0.9"))
+        
+        # unregistered handlers are left alone, unless marked obsolete
+        assert not workflow._is_stale(bibjson("oup", "0.1"))
+        assert not workflow._is_stale(bibjson("", ""))
+        assert workflow._is_stale(bibjson("bmc", "0.10"))
+        
+        # an outdated record is fresh enough to serve while it is refreshed
+        assert workflow._is_servable_stale(bibjson("plos", "0.1"))
+        
+        plugin.PluginFactory.handler_versions = old_versions
+        workflow.OBSOLETE_HANDLER_VERSIONS = old_obsolete
+    
+    def test_31_store_counts_stats(self):
+        cache.cache = mock_cache
+        models.Record.store = mock_store
+        
+        record = {"identifier" : {"id" : "10.counted", "type" : "doi", "canonical" : "doi:10.counted"}, "queued" : True}
+        workflow.store_results(record)
+        assert len(COUNTED) == 1
+        assert COUNTED[0] is ARCHIVE[0]
+        
+        # records in error are not stored, so not counted
+        del COUNTED[:]
+        workflow.store_results({"identifier" : {"id" : "10.error", "type" : "doi", "canonical" : "doi:10.error"}, "error" : "unresolvable"})
+        assert COUNTED == []
+        
+        # a failure in the statistics doesn't stop the record being stored
+        old_count = stats.count
+        def broken_count(bibjson):
+            raise IOError("statistics unavailable")
+        stats.count = broken_count
+        CLAIMS["doi:10.uncounted"] = "token"
+        try:
+            workflow.store_results({"identifier" : {"id" : "10.uncounted", "type" : "doi", "canonical" : "doi:10.uncounted"}, "queued" : True, "claim" : "token"})
+        finally:
+            stats.count = old_count
+        assert "queued" not in CACHE["doi:10.uncounted"]
+        assert "doi:10.uncounted" not in CLAIMS
+        
+        CACHE.clear()
+        del ARCHIVE[:]
+    
+    def test_32_claim_taken_over(self):
+        cache.cache = mock_cache
+        models.Record.store = mock_store
+        
+        # the first chain's claim lapsed while its task waited on the queue, and another lookup claimed the identifier
+        first = {'identifier' : {"id" : "10.lapsed", "type" : "doi", "canonical" : "doi:10.lapsed"}, "queued" : True, "claim" : "first"}
+        CLAIMS["doi:10.lapsed"] = "second"
+        
+        # so the first chain stops, rather than taking the claim back
+        with self.assertRaises(Ignore):
+            workflow.detect_provider(first)
+        assert CLAIMS["doi:10.lapsed"] == "second"
+        assert RENEWED == []
+        
+        # and if it had already got as far as storing its result, it doesn't release the other chain's claim
+        workflow.store_results(first)
+        assert CLAIMS["doi:10.lapsed"] == "second"
+        
+        second = {'identifier' : {"id" : "10.lapsed", "type" : "doi", "canonical" : "doi:10.lapsed"}, "queued" : True, "claim" : "second"}
+        workflow.store_results(second)
+        assert "doi:10.lapsed" not in CLAIMS
+        
+        CACHE.clear()
+        del ARCHIVE[:]
+    
+    def test_33_sweep_failed_refresh(self):
+        def archived(n):
+            return {"id" : "doi:10." + n, "identifier" : [{"id" : "10." + n, "type" : "doi", "canonical" : "doi:10." + n}]}
+        
+        # the oldest record due for refresh is one which can't be refreshed, e.g. as its provider is down
+        due = [archived("failing"), archived("old1"), archived("old2")]
+        def mock_checked_before(cls, timestamp, size=10, ids=None, exclude=None):
+            found = [d for d in due if d["id"] not in (exclude or [])]
+            return len(found), found[:size]
+        
+        old_checked_before = models.Record.checked_before
+        old_most_requested = cache.most_requested
+        old_update_sweep_stats = cache.update_sweep_stats
+        old_window = config.SWEEP_WINDOW
+        old_batch_size = config.SWEEP_BATCH_SIZE
+        old_back_end = workflow._start_back_end
+        models.Record.checked_before = classmethod(mock_checked_before)
+        cache.most_requested = lambda n: []
+        cache.update_sweep_stats = lambda stats: None
+        workflow._start_back_end = mock_record_back_end
+        config.SWEEP_WINDOW = None
+        config.SWEEP_BATCH_SIZE = 1
+        
+        workflow.sweep_stale()
+        assert BACK_END == ["doi:10.failing"]
+        
+        # its refresh fails, so its last_checked is left as it was
+        refresh = {"identifier" : {"id" : "10.failing", "type" : "doi", "canonical" : "doi:10.failing"}, "refresh" : True,
+                   "error" : "unable to resolve", "claim" : CLAIMS["doi:10.failing"]}
+        workflow.store_results(refresh)
+        assert "doi:10.failing" not in CLAIMS
+        
+        # but the next sweep moves on to the rest of the backlog, rather than trying it again
+        stats = workflow.sweep_stale()
+        assert BACK_END == ["doi:10.failing", "doi:10.old1"]
+        assert stats["backed_off"] == 1
+        assert stats["backlog"] == 1
+        
+        models.Record.checked_before = old_checked_before
+        cache.most_requested = old_most_requested
+        cache.update_sweep_stats = old_update_sweep_stats
+        config.SWEEP_WINDOW = old_window
+        config.SWEEP_BATCH_SIZE = old_batch_size
+        workflow._start_back_end = old_back_end
@@ -0,0 +1,26 @@
+'''
+Operational state of the OAG back end, for administrators.
+
+/admin/breakers -- the circuit breakers on the hosts which plugins fetch from (see outbound.py)
+/admin/plugins -- the plugins registered in this web process, and the version of the registry (see plugin_registry.py)
+'''
+
+from flask import Blueprint, make_response
+
+from openarticlegauge import outbound, plugin_registry, codec
+
+blueprint = Blueprint('admin', __name__)
+
+@blueprint.route('/breakers', methods=['GET'])
+@blueprint.route('/breakers.json', methods=['GET'])
+def breakers():
+    resp = make_response( codec.dumps(outbound.breakers()) )
+    resp.mimetype = "application/json"
+    return resp
+
+@blueprint.route('/plugins', methods=['GET'])
+@blueprint.route('/plugins.json', methods=['GET'])
+def plugins():
+    resp = make_response( codec.dumps(plugin_registry.current().describe()) )
+    resp.mimetype = "application/json"
+    return resp
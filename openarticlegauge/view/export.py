@@ -0,0 +1,44 @@
+'''
+Export of the archive as a stream of compressed NDJSON (see export.py).
+
+Parameters:
+q -- a query string to select the records to export (or source, an Elasticsearch query as json)
+fields -- a comma separated list of the fields to export, with dots for nested fields
+compression -- gzip, zstd or none
+'''
+
+import urllib2
+
+from flask import Blueprint, request, abort, Response
+
+from openarticlegauge.core import app
+from openarticlegauge import export, codec
+
+blueprint = Blueprint('export', __name__)
+
+@blueprint.route('/', methods=['GET'])
+def export_records():
+    # the export gives out the same records as the query pass-through, so is subject to the same control
+    if 'record' in app.config['NO_QUERY_VIA_API']:
+        abort(401)
+
+    compression = request.values.get('compression', app.config['EXPORT_COMPRESSION'])
+    if compression not in export.compressions():
+        abort(400)
+
+    q = None
+    if 'q' in request.values:
+        q = export.query_string(request.values['q'])
+    elif 'source' in request.values:
+        try:
+            q = codec.loads(urllib2.unquote(request.values['source']))
+        except ValueError:
+            abort(400)
+
+    fields = None
+    if request.values.get('fields'):
+        fields = [f.strip() for f in request.values['fields'].split(',') if f.strip() != '']
+
+    resp = Response(export.stream(fields, q, compression, app.config['EXPORT_PAGE_SIZE']), mimetype=export.MIMETYPES[compression])
+    resp.headers['Content-Disposition'] = 'attachment; filename=records' + export.EXTENSIONS[compression]
+    return resp
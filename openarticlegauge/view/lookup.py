@@ -1,8 +1,7 @@
 from flask import Blueprint, request, make_response, render_template, abort
 
-import json
-
-from openarticlegauge import workflow
+from openarticlegauge import workflow, config
+from openarticlegauge import codec
 from openarticlegauge import util
 
 blueprint = Blueprint('lookup', __name__)
@@ -37,10 +36,24 @@ def api_lookup(path='',ids=[]):
     if len(idlist) > 1000:
         abort(400)
 
+    # clients may ask for "interactive" or "bulk" processing (see config.PRIORITY_QUEUE_SUFFIXES)
+    priority = request.values.get("priority")
+    if priority is not None and priority not in config.PRIORITY_QUEUE_SUFFIXES:
+        abort(400)
+
+    # json lookups by GET can be cached and revalidated, as long as they aren't jsonp (which drops
+    # the status and headers)
+    cacheable = request.method == 'GET' and givejson and len(idlist) > 0 and not request.args.get('callback')
+
     if idlist:
-        results = workflow.lookup(idlist).json()
+        resultset = workflow.lookup(idlist, priority)
+        if cacheable:
+            etag = resultset.etag()
+            if etag in request.if_none_match:
+                return _cache_headers(make_response("", 304), etag, resultset.max_age())
+        results = resultset.json()
     else:
-        results = json.dumps({})
+        results = codec.dumps({})
 
     if request.method == 'GET' and not givejson:
         if path:
@@ -51,5 +64,15 @@ def api_lookup(path='',ids=[]):
     else:
         resp = make_response( results )
         resp.mimetype = "application/json"
+        if cacheable:
+            _cache_headers(resp, etag, resultset.max_age())
         return resp
 
+def _cache_headers(resp, etag, max_age):
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = max_age
+    # the same url gives html or json depending on what the client accepts
+    resp.headers['Vary'] = 'Accept'
+    return resp
+
@@ -3,17 +3,22 @@ An elasticsearch query pass-through.
 Has auth control, so it is better than exposing your ES index directly.
 '''
 
-import json, urllib2
+import urllib2, json
 
 from flask import Blueprint, request, abort, make_response
 
 import openarticlegauge.models as models
 from openarticlegauge.core import app
 import openarticlegauge.util as util
+from openarticlegauge import codec
+from openarticlegauge.lrucache import LRUCache
 
 
 blueprint = Blueprint('query', __name__)
 
+# search results, serialised, keyed by the type searched and the query
+results_cache = LRUCache(app.config['QUERY_CACHE_MAX_ITEMS'], app.config['QUERY_CACHE_TIMEOUT'])
+
 
 # pass queries direct to index. POST only for receipt of complex query objects
 @blueprint.route('/<path:path>', methods=['GET','POST'])
@@ -27,7 +32,7 @@ def query(path='Record'):
     klass = getattr(models, subpath[0].capitalize() + subpath[1:] )
     
     if len(pathparts) > 1 and pathparts[1] == '_mapping':
-        resp = make_response( json.dumps(klass().query(endpoint='_mapping')) )
+        resp = make_response( codec.dumps(klass().query(endpoint='_mapping')) )
     elif len(pathparts) == 2 and pathparts[1] not in ['_mapping','_search']:
         if request.method == 'POST':
             abort(401)
@@ -49,7 +54,7 @@ def query(path='Record'):
         elif 'q' in request.values:
             qs = {'query': {'query_string': { 'query': request.values['q'] }}}
         elif 'source' in request.values:
-            qs = json.loads(urllib2.unquote(request.values['source']))
+            qs = codec.loads(urllib2.unquote(request.values['source']))
         else: 
             qs = ''
         for item in request.values:
@@ -61,7 +66,15 @@ def query(path='Record'):
         #    terms = {'visible':True,'accessible':True}
         #else:
         terms = ''
-        resp = make_response( json.dumps(klass().query(q=qs, terms=terms)) )
+        resp = make_response( _search(klass, subpath, qs, terms) )
     resp.mimetype = "application/json"
     return resp
 
+def _search(klass, subpath, qs, terms):
+    search = lambda: codec.dumps(klass().query(q=qs, terms=terms))
+    if app.config['QUERY_CACHE_TIMEOUT'] <= 0 or subpath.lower() in app.config['NO_QUERY_CACHE']:
+        return search()
+    # identical queries get the same key, however their keys are ordered
+    key = json.dumps([subpath.lower(), qs, terms], sort_keys=True)
+    return results_cache.get_or_compute(key, search)
+
@@ -0,0 +1,27 @@
+'''
+Licence statistics, as kept up to date by the stats module, and the hit ratios of the cache in
+this web process.
+'''
+
+from flask import Blueprint, make_response
+
+from openarticlegauge import stats, codec, cache
+from openarticlegauge import util
+
+blueprint = Blueprint('stats', __name__)
+
+@blueprint.route('/', methods=['GET'])
+@blueprint.route('.json', methods=['GET'])
+@util.jsonp
+def licence_stats():
+    resp = make_response( codec.dumps(stats.summary()) )
+    resp.mimetype = "application/json"
+    return resp
+
+@blueprint.route('/cache', methods=['GET'])
+@blueprint.route('/cache.json', methods=['GET'])
+@util.jsonp
+def cache_stats():
+    resp = make_response( codec.dumps(cache.tier_stats()) )
+    resp.mimetype = "application/json"
+    return resp
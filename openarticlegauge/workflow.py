@@ -14,25 +14,37 @@ reaches either completion or causes an error.  The record object in full is:
         "canonical" : "<canonical form of the identifier>"
     },
     "queued" : True/False,
+    "refresh" : True/False, <whether this is a background refresh of a stale record which is still being served>,
+    "claim" : "<token of the claim on the identifier held by the processing of this record (see cache.claim)>",
+    "stale" : True/False, <whether the bibjson being served is stale>,
     "provider" : {
         "url" : ["<provider url, e.g. dereferenced doi>", "..."],
         "doi" : "<provider doi>"
     },
-    "bibjson" : {<bibjson object - see http://bibjson.org>}
+    "bibjson" : {<bibjson object - see http://bibjson.org>},
+    "error" : "<error message, if the identifier could not be processed>",
+    "failure" : "<class of the error, for the negative cache (see config.NEGATIVE_CACHE_TIMEOUTS); unresolvable if omitted>"
 }
 
 """
 
 from celery import chain
-from openarticlegauge import models, model_exceptions, config, cache, plugin, recordmanager
-import logging
+from celery.exceptions import Ignore
+from celery.signals import worker_init, worker_process_init, task_prerun, task_postrun
+from openarticlegauge import models, model_exceptions, config, cache, plugin, plugin_registry, recordmanager, stats, outbound
+import logging, time, random, requests
+from distutils.version import LooseVersion
 from openarticlegauge.slavedriver import celery
 
 LOG_FORMAT = '%(asctime)-15s %(message)s'
 logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
 log = logging.getLogger(__name__)
 
-def lookup(bibjson_ids):
+# the handler versions which have been marked obsolete, against which licences are checked on every
+# read.  Worked out once, at startup
+OBSOLETE_HANDLER_VERSIONS = set([tuple(pair) for pair in config.OBSOLETE_HANDLER_VERSIONS])
+
+def lookup(bibjson_ids, priority=None):
     """
     Take a list of bibjson id objects
     {
@@ -43,6 +55,8 @@ def lookup(bibjson_ids):
     
     arguments:
     bibjson_ids -- a list of bibjson id objects with optional type parameter
+    priority -- the priority class ("interactive" or "bulk", see config.PRIORITY_QUEUE_SUFFIXES) with which
+        to process any identifiers that need it.  If omitted, it is chosen by the size of the batch
     
     returns:
     a models.ResultSet object with results, errors and a list of identifiers waiting to be processed
@@ -54,6 +68,9 @@ def lookup(bibjson_ids):
     log.debug("looking up ids: " + str(bibjson_ids))
     rs = models.ResultSet(bibjson_ids)
     
+    # decide which lane any processing should go in
+    priority = get_priority(len(bibjson_ids), priority)
+    
     # now run through each passed id, and either obtain a cached copy or 
     # inject it into the asynchronous back-end
     for bid in bibjson_ids:
@@ -61,8 +78,21 @@ def lookup(bibjson_ids):
         record = { "identifier" : bid }
         log.debug("initial record " + str(record))
         
+        # the key under which any failure to process the identifier as supplied is remembered
+        raw_key = _raw_negative_key(bid)
+        
         # trap any lookup errors
         try:
+            # the plugins can only work with identifiers which are strings
+            if bid.has_key("id") and not isinstance(bid["id"], basestring):
+                raise model_exceptions.LookupException("the identifier must be a string")
+            
+            # Step 0: if this identifier recently failed, give the same answer straight away
+            if _check_negative_cache(record, raw_key):
+                log.debug("loaded from negative cache " + str(record))
+                rs.add_result_record(record)
+                continue
+            
             # Step 1: identifier type detection/verification
             _detect_verify_type(record)
             log.debug("type detected record " + str(record))
@@ -75,6 +105,15 @@ def lookup(bibjson_ids):
             _canonicalise_identifier(record)
             log.debug("canonicalised record " + str(record))
             
+            # count the request, so that popular identifiers can be kept fresh (see sweep_stale)
+            cache.count_request(record['identifier']['canonical'])
+            
+            # Step 2a: if the identifier recently failed to resolve, give the same answer straight away
+            if _check_negative_cache(record, record['identifier']['canonical']):
+                log.debug("loaded from negative cache " + str(record))
+                rs.add_result_record(record)
+                continue
+            
             # Step 3: check the cache for an existing record
             cached_copy = _check_cache(record)
             log.debug("cached record " + str(cached_copy))
@@ -87,6 +126,11 @@ def lookup(bibjson_ids):
                 elif cached_copy.has_key('bibjson'):
                     record['bibjson'] = cached_copy['bibjson']
                 log.debug("loaded from cache " + str(record))
+                
+                # Step 3a: if the cached copy is stale, serve it anyway, but refresh it in the background
+                if record.get("stale", False):
+                    _refresh(record, priority)
+                
                 rs.add_result_record(record)
                 log.debug(str(bid) + " added to result, continuing ...")
                 continue
@@ -100,6 +144,11 @@ def lookup(bibjson_ids):
             if archived_bibjson is not None:
                 record['bibjson'] = archived_bibjson
                 log.debug("loaded from archive " + str(archived_bibjson))
+                
+                # Step 4a: if the archived copy is stale, serve it anyway, but refresh it in the background
+                if record.get("stale", False):
+                    _refresh(record, priority)
+                
                 rs.add_result_record(record)
                 continue
 
@@ -116,17 +165,30 @@ def lookup(bibjson_ids):
                 continue
                         
             # Step 6: if we get to here, we need to set the state of the record
-            # queued, and then cache it.
+            # queued.  The identifier is claimed atomically, so if several requests
+            # for it arrive together only one of them goes on to process it; the
+            # others just report it as being processed
             record['queued'] = True
+            if not _claim(record):
+                log.debug("already claimed for processing " + str(record))
+                rs.add_result_record(record)
+                continue
+            
             _update_cache(record)
             log.debug("caching record " + str(record))
             
             # Step 7: the record needs the licence looked up on it, so we inject
             # it into the asynchronous lookup workflow
-            _start_back_end(record)
+            try:
+                _start_back_end(record, priority)
+            except:
+                # don't hold the claim if the work never got started
+                _release_claim(record)
+                raise
             
         except model_exceptions.LookupException as e:
             record['error'] = e.message
+            _cache_lookup_failure(record, raw_key)
         
         # write the resulting record into the result set
         rs.add_result_record(record)
@@ -134,6 +196,96 @@ def lookup(bibjson_ids):
     # finish by returning the result set
     return rs
 
+def get_priority(batch_size, requested=None):
+    """
+    Decide the priority class with which to process a batch of identifiers
+    
+    arguments:
+    batch_size -- the number of identifiers in the batch
+    requested -- the priority class asked for by the client, if any
+    
+    returns:
+    "interactive" or "bulk".  A batch larger than config.INTERACTIVE_MAX_BATCH is always bulk,
+        whatever was requested
+    
+    raises:
+    LookupException if the requested priority class is not known
+    
+    """
+    if requested is not None and requested not in config.PRIORITY_QUEUE_SUFFIXES:
+        raise model_exceptions.LookupException("unknown priority " + str(requested))
+    
+    if batch_size > config.INTERACTIVE_MAX_BATCH:
+        return "bulk"
+    if requested is not None:
+        return requested
+    return "interactive"
+
+def _queue(stage, priority):
+    """
+    get the name of the Celery queue for the given stage of processing in the given priority lane
+    
+    arguments:
+    stage -- the name of the stage, which is the name of the queue in the interactive lane (e.g. "detect_provider")
+    priority -- the priority class (see config.PRIORITY_QUEUE_SUFFIXES)
+    
+    """
+    return stage + config.PRIORITY_QUEUE_SUFFIXES.get(priority, "")
+
+def _raw_negative_key(bibjson_id):
+    """
+    get the key under which failures to process the identifier, as supplied by the client, are
+    recorded in the negative cache
+    
+    arguments:
+    bibjson_id -- the bibjson id object, before any type detection or canonicalisation
+    
+    returns:
+    the key, or None if the identifier has no id
+    
+    """
+    if not bibjson_id.has_key("id"):
+        return None
+    # clients can send anything, so this must not fail whatever the id and type are
+    return u"raw:" + unicode(bibjson_id.get("type") or "") + u":" + unicode(bibjson_id["id"])
+
+def _check_negative_cache(record, key):
+    """
+    check the negative cache for a recent failure to process the identifier.  If one is
+    found, the record's error is set to the error that was reported at the time
+    
+    arguments:
+    record -- an OAG record object, see the module documentation for details
+    key -- the negative cache key; either the canonical identifier or the raw key (see _raw_negative_key)
+    
+    returns:
+    True if a failure was found, False if not
+    
+    """
+    if key is None:
+        return False
+    failure = cache.check_negative(key)
+    if failure is None:
+        return False
+    record['error'] = failure.get("error")
+    return True
+
+def _cache_lookup_failure(record, key):
+    """
+    remember in the negative cache that the identifier could not be looked up.  The failure is
+    classed as "unknown_type" if no type could be determined for the identifier, and
+    "invalid_identifier" otherwise (see config.NEGATIVE_CACHE_TIMEOUTS)
+    
+    arguments:
+    record -- an OAG record object with an error, see the module documentation for details
+    key -- the raw negative cache key (see _raw_negative_key)
+    
+    """
+    if key is None:
+        return
+    failure_class = "invalid_identifier" if record['identifier'].get("type") is not None else "unknown_type"
+    cache.cache_negative(key, failure_class, record['error'])
+
 def _check_archive(record):
     """
     check the record archive for a copy of the bibjson record
@@ -141,8 +293,11 @@ def _check_archive(record):
     arguments:
     record -- an OAG record object, see the module documentation for details
     
+    If the archived copy is stale, but not so stale that it can't be served (see config.STALE_MAX_AGE), it is
+    returned anyway and record['stale'] is set
+    
     returns:
-    - None if there is nothing for this record in the archive
+    - None if there is nothing for this record in the archive, or it is too stale to serve
     - a bibjson record if one is found
     
     """
@@ -164,6 +319,10 @@ def _check_archive(record):
     # if there is archived bibjson, then we need to check whether it is stale
     # or not
     if _is_stale(archived_bibjson):
+        if _is_servable_stale(archived_bibjson):
+            log.debug(record['identifier']['canonical'] + " is in the archive, and is stale but can still be served")
+            record['stale'] = True
+            return archived_bibjson
         log.debug(record['identifier']['canonical'] + " is in the archive, but is stale")
         return None
         
@@ -185,9 +344,102 @@ def _update_cache(record):
     if not record['identifier'].has_key('canonical'):
         raise model_exceptions.LookupException("can't create/update anything in the cache without a canonical id")
     
-    # update or create the cache
-    cache.cache(record['identifier']['canonical'], record)
+    # the claim token belongs to this processing of the record only, so it isn't cached
+    if record.has_key("claim"):
+        record = dict([(k, v) for k, v in record.iteritems() if k != "claim"])
+    
+    # update or create the cache.  A queued record is only a lease on the cache entry, which
+    # lapses unless processing keeps renewing it (see _renew_lease)
+    if record.get("queued", False):
+        cache.cache(record['identifier']['canonical'], record, config.QUEUED_LEASE_TIMEOUT)
+    else:
+        cache.cache(record['identifier']['canonical'], record)
+    
+def _claim(record):
+    """
+    claim the record for processing, so that no other request starts processing it
+    at the same time
+    
+    arguments:
+    record -- an OAG record object, see the module documentation for details
+    
+    The token of the claim is kept in the record, so that only the processing of this record can
+    renew or release it
+    
+    returns:
+    True if the claim was made, False if the record is already being processed
+    
+    """
+    if not record['identifier'].has_key('canonical'):
+        raise model_exceptions.LookupException("can't claim a record without a canonical id")
+    
+    token = cache.claim(record['identifier']['canonical'])
+    if token is None:
+        return False
+    record['claim'] = token
+    return True
+
+def _renew_lease(record):
+    """
+    renew the lease on the claim and the queued marker for a record which is being processed,
+    so that they don't lapse while processing is still alive.  A record which is being refreshed
+    has no queued marker (the stale copy stays in the cache), so only its claim is renewed
+    
+    arguments:
+    record -- an OAG record object, see the module documentation for details
+    
+    If the claim lapsed (e.g. the task waited on its queue for longer than config.QUEUED_LEASE_TIMEOUT)
+    and another request has claimed the identifier since, then that request is processing it, so this
+    processing is stopped: the rest of the chain of tasks does not run
+    
+    """
+    if not record.get("identifier", {}).has_key("canonical"):
+        return
+    if not record.get("queued", False) and not record.get("refresh", False):
+        return
+    if not cache.renew_claim(record['identifier']['canonical'], record.get('claim')):
+        log.debug(str(record['identifier']) + ": claimed by another request, so no longer processing it here")
+        raise Ignore()
+    if record.get("queued", False):
+        _update_cache(record)
+
+def _refresh(record, priority="interactive"):
+    """
+    start a background refresh of a record whose stale copy is being served.  Only one refresh of
+    any identifier runs at a time.  Nothing is written to the cache until the refresh completes, so
+    the stale copy continues to be served in the meantime
+    
+    arguments:
+    record -- an OAG record object, see the module documentation for details
+    priority -- the priority class in which to do the refresh
+    
+    returns:
+    True if a refresh was started, False if the record is already being processed
     
+    """
+    refresh = {"identifier" : record['identifier'], "refresh" : True}
+    if not _claim(refresh):
+        log.debug("already being processed, so not refreshing " + str(record['identifier']))
+        return False
+    
+    try:
+        _start_back_end(refresh, priority)
+    except:
+        _release_claim(refresh)
+        raise
+    return True
+
+def _release_claim(record):
+    """
+    release the claim on the record made by _claim.  If the claim lapsed and has been taken by another
+    request since, it is theirs, and is left alone
+    
+    arguments:
+    record -- an OAG record object, see the module documentation for details
+    
+    """
+    cache.release_claim(record['identifier']['canonical'], record.pop('claim', None))
+
 def _invalidate_cache(record):
     """
     invalidate any cache object associated with the passed record
@@ -206,13 +458,48 @@ def _invalidate_cache(record):
 
 def _is_stale(bibjson):
     """
-    Do a stale check on the bibjson object.
+    Do a stale check on the bibjson object.  As well as being too old (see cache.is_stale), a record
+    is stale if its licence was applied by an out of date version of a plugin (see _is_outdated)
     
     arguments:
     bibjson -- the bibjson record to carry out the stale check on
     
     """
-    return cache.is_stale(bibjson)
+    return cache.is_stale(bibjson) or _is_outdated(bibjson)
+
+def _is_outdated(bibjson):
+    """
+    Check whether the most recent licence on the bibjson object was applied by a version of a
+    plugin older than the one currently registered, or by a version marked obsolete in
+    config.OBSOLETE_HANDLER_VERSIONS
+    
+    arguments:
+    bibjson -- the bibjson record to check
+    
+    """
+    licence = recordmanager.latest_license(bibjson)
+    if licence is None:
+        return False
+    
+    handler = licence.get("provenance", {}).get("handler")
+    version = licence.get("provenance", {}).get("handler_version")
+    if (handler, version) in OBSOLETE_HANDLER_VERSIONS:
+        return True
+    
+    current = plugin.PluginFactory.handler_versions().get(handler)
+    if current is None or version is None or version == "":
+        return False
+    return LooseVersion(str(version)) < LooseVersion(str(current))
+
+def _is_servable_stale(bibjson):
+    """
+    Check whether a stale bibjson object may still be served while it is refreshed
+    
+    arguments:
+    bibjson -- the stale bibjson record
+    
+    """
+    return cache.is_servable_stale(bibjson)
 
 def _check_cache(record):
     """
@@ -222,8 +509,11 @@ def _check_cache(record):
     arguments:
     record -- an OAG record object, see the module documentation for details
     
+    If the cached record is stale, but not so stale that it can't be served (see config.STALE_MAX_AGE), it is
+    returned anyway and record['stale'] is set
+    
     returns:
-    - None if nothing in the cache or the cached record is found to be stale
+    - None if nothing in the cache or the cached record is found to be too stale to serve
     - OAG record object if one is found
     
     """
@@ -253,6 +543,10 @@ def _check_cache(record):
         # if it does, we need to see if the record is stale.  If so, we remember that fact,
         # and we'll deal with updating stale items later (once we've checked bibserver)
         if _is_stale(cached_copy['bibjson']):
+            if _is_servable_stale(cached_copy['bibjson']):
+                log.debug(record['identifier']['canonical'] + " is in the cache, and is stale but can still be served")
+                record['stale'] = True
+                return cached_copy
             log.debug(record['identifier']['canonical'] + " is in the cache but is a stale record")
             _invalidate_cache(record)
             return None
@@ -308,7 +602,7 @@ def _detect_verify_type(record):
     for p in plugins:
         p.type_detect_verify(record['identifier'])
     
-def _start_back_end(record):
+def _start_back_end(record, priority="interactive"):
     """
     kick off the asynchronous licence lookup process.  There is no need for this to return
     anything, although a handle on the asynchronous request object is provided for convenience of
@@ -316,13 +610,18 @@ def _start_back_end(record):
     
     arguments:
     record -- an OAG record object, see the module documentation for details
+    priority -- the priority class, which determines the queues that each stage is sent to
     
     returns:
     AsyncRequest object from the Celery framework
     
     """
-    log.debug("injecting record into asynchronous processing chain: " + str(record))
-    ch = chain(detect_provider.s(record), provider_licence.s(), store_results.s())
+    log.debug("injecting record into asynchronous processing chain (" + priority + "): " + str(record))
+    ch = chain(
+        detect_provider.s(record).set(queue=_queue("detect_provider", priority)),
+        provider_licence.s().set(queue=_queue("provider_licence", priority)),
+        store_results.s().set(queue=_queue("store_results", priority))
+    )
     r = ch.apply_async()
     return r
 
@@ -330,6 +629,21 @@ def _start_back_end(record):
 # Celery Tasks
 ############################################################################    
 
+# each worker process listens for reloads of the plugins, and each task runs to the end with the
+# plugins it started with (see plugin_registry)
+@worker_init.connect
+@worker_process_init.connect
+def _watch_plugins(**kwargs):
+    plugin_registry.watch()
+
+@task_prerun.connect
+def _pin_plugins(**kwargs):
+    plugin_registry.pin()
+
+@task_postrun.connect
+def _unpin_plugins(**kwargs):
+    plugin_registry.unpin()
+
 @celery.task(name="openarticlegauge.workflow.detect_provider")
 def detect_provider(record):
     """
@@ -339,6 +653,9 @@ def detect_provider(record):
     arguments:
     record -- an OAG record object, see the module documentation for details
     
+    If a host that a plugin needs is unavailable (see outbound), the record is put off until later (see _defer),
+    and if a request the plugin makes fails, the record is put in error (see _request_failed)
+    
     returns:
     the passed in record with the 'provider' field added if possible
     
@@ -353,12 +670,27 @@ def detect_provider(record):
     if not record['identifier'].has_key("type"):
         return record
     
+    # Step 1a: let everyone know we're still working on it
+    _renew_lease(record)
+    
     # Step 2: get the provider plugins that are relevant, and
     # apply each one until a provider string is added
     plugins = plugin.PluginFactory.detect_provider(record['identifier']["type"])
-    for p in plugins:
-        log.debug("applying plugin " + str(p._short_name))
-        p.detect_provider(record)
+    try:
+        for p in plugins:
+            log.debug("applying plugin " + str(p._short_name))
+            with outbound.budget(p._short_name):
+                p.detect_provider(record)
+    except outbound.HostUnavailableException as e:
+        return _defer(detect_provider, record, e)
+    except requests.exceptions.RequestException as e:
+        return _request_failed(record, e)
+    
+    # Step 3: if no provider could be found, the licence can't be determined, so
+    # flag the record as being in error.  store_results will deal with it
+    if len(record.get("provider", {}).get("url", [])) == 0:
+        log.debug("unable to resolve " + str(record['identifier']) + " to a provider")
+        record['error'] = "unable to resolve the identifier to a provider"
     
     # we have to return the record, so that the next step in the chain
     # can deal with it
@@ -378,6 +710,9 @@ def provider_licence(record):
     arguments:
     record -- an OAG record object, see the module documentation for details
     
+    If the provider's site is unavailable (see outbound), the record is put off until later (see _defer),
+    and if a request the plugin makes fails, the record is put in error (see _request_failed)
+    
     returns:
     the passed in record object with the record['bibjson']['license'] field added or appended to with
         a new licence
@@ -388,6 +723,12 @@ def provider_licence(record):
     if not record.has_key("provider"):
         log.debug("record has no provider, so unable to look for licence: " + str(record))
         return record
+    if record.get("error") is not None:
+        log.debug("record is in error, so not looking for licence: " + str(record))
+        return record
+    
+    # Step 1a: let everyone know we're still working on it
+    _renew_lease(record)
     
     # Step 2: get the plugin that will run for the given provider
     p = plugin.PluginFactory.license_detect(record["provider"])
@@ -400,7 +741,13 @@ def provider_licence(record):
     if "bibjson" not in record:
         # if the record doesn't have a bibjson element, add a blank one
         record['bibjson'] = {}
-    p.license_detect(record)
+    try:
+        with outbound.budget(p._short_name):
+            p.license_detect(record)
+    except outbound.HostUnavailableException as e:
+        return _defer(provider_licence, record, e)
+    except requests.exceptions.RequestException as e:
+        return _request_failed(record, e)
     
     # was the plugin able to detect a licence?
     # if not, we need to add an unknown licence for this provider
@@ -439,49 +786,147 @@ def store_results(record):
     arguments:
     record -- an OAG record object, see the module documentation for details
     
+    If the identifier could not be resolved to a provider, nothing is stored; instead the
+    failure is remembered in the negative cache for a short while (see config.NEGATIVE_CACHE_TIMEOUTS)
+    so that it is retried later.
+    
     returns:
     passed in record object, with the queued status removed and any other internal changes
         necessary to prepare it for storage
     
     """
+    # Step 0: if the identifier could not be resolved, there is nothing to store, so just
+    # take it off the queue and remember the failure.  If this was a refresh, though, keep
+    # serving what we already had, and try again next time it is looked up
+    if record.get("error") is not None and record.get("refresh", False):
+        log.debug(str(record['identifier']) + ": refresh failed, so keeping the existing record: " + record['error'])
+        # its last_checked is unchanged, so without this the sweeper would pick it again straight away
+        cache.back_off_sweep(record['identifier']['canonical'])
+        _release_claim(record)
+        del record["refresh"]
+        return record
+    
+    if record.get("error") is not None:
+        log.debug(str(record['identifier']) + ": not storing, as the record is in error: " + record['error'])
+        cache.cache_negative(record['identifier']['canonical'], record.pop("failure", "unresolvable"), record['error'])
+        _invalidate_cache(record)
+        _release_claim(record)
+        if record.has_key("queued"):
+            del record["queued"]
+        return record
+    
     # Step 1: ensure that a licence was applied, and if not apply one
-    if "bibjson" not in record:
-        # no bibjson record, so add a blank one
-        log.debug("record does not have a bibjson record.")
-        record['bibjson'] = {}
-        
-    if "license" not in record['bibjson'] or len(record['bibjson'].get("license", [])) == 0:
-        # the bibjson record does not contain a license list OR the license list is of zero length
-        log.debug("Licence could not be detected, therefore adding 'unknown' licence to " + str(record['bibjson']))
-        recordmanager.add_license(record,
-            url=config.unknown_url,
-            type="failed-to-obtain-license",
-            open_access=False,
-            error_message="unable to detect licence",
-            category="failure",
-            provenance_description="no plugin was found that would try to detect a licence.  This entry records that the license is therefore unknown",
-        )
-        # describe_license_fail(record, "none", "unable to detect licence", "", config.unknown_url)
+    _ensure_license(record)
+    
+    # Step 1a: record that the licence has just been checked, which is what makes
+    # later stale checks on this record a single comparison
+    recordmanager.set_last_checked(record)
         
     # Step 2: unqueue the record
     if record.has_key("queued"):
         log.debug(str(record['identifier']) + ": removing this item from the queue")
         del record["queued"]
+    if record.has_key("refresh"):
+        del record["refresh"]
     
     # Step 3: update the archive
     _add_identifier_to_bibjson(record['identifier'], record['bibjson'])
     log.debug(str(record['identifier']) + ": storing this item in the archive")
     models.Record.store(record['bibjson'])
     
+    # Step 3a: count it in the licence statistics.  These are a side channel, kept in their own
+    # database, so a failure there mustn't stop the record being stored; the counts are repaired
+    # when they are next reconciled (see stats.reconcile)
+    try:
+        stats.count(record['bibjson'])
+    except Exception as e:
+        log.error(str(record['identifier']) + ": unable to count this item in the statistics: " + str(e))
+    
     # Step 4: update the cache
     log.debug(str(record['identifier']) + ": storing this item in the cache")
     _update_cache(record)
     
+    # Step 5: now that the result is available, let the identifier be claimed again
+    _release_claim(record)
+    
     # we have to return the record so that the next step in the chain can
     # deal with it (if such a step exists)
     log.debug("yielded result " + str(record))
     return record
 
+def _defer(task, record, e):
+    """
+    put off processing the record, as a host it needs is unavailable (see outbound), by running the
+    task again once the host's breaker is due to close.  The rest of the chain of tasks follows on from
+    the task as usual.  If the record has been put off too many times already (config.BREAKER_MAX_DEFERRALS),
+    or the task was not sent to a worker (e.g. by bulk_lookup), then processing it fails instead
+    
+    arguments:
+    task -- the task which was processing the record
+    record -- an OAG record object, see the module documentation for details
+    e -- the outbound.HostUnavailableException raised for the host
+    
+    returns:
+    the record, in error, if processing it has failed
+    
+    """
+    if task.request.called_directly or task.request.retries >= config.BREAKER_MAX_DEFERRALS:
+        log.debug(str(record['identifier']) + ": giving up, as " + e.host + " is unavailable")
+        record['error'] = "unable to reach " + e.host + ", please try again later"
+        record['failure'] = "unavailable"
+        return record
+    
+    # spread the records out a little, so that they don't all arrive together when the breaker closes
+    countdown = e.retry_after + random.uniform(0, config.BREAKER_OPEN_TIME / 10.0)
+    log.debug(str(record['identifier']) + ": " + e.host + " is unavailable, so trying again in " + str(int(countdown)) + "s")
+    raise task.retry(args=[record], countdown=countdown, max_retries=config.BREAKER_MAX_DEFERRALS)
+
+def _request_failed(record, e):
+    """
+    fail processing the record, as a request made by a plugin failed (it timed out, the connection was
+    refused, the plugin's time budget ran out, and so on).  store_results then remembers the failure in
+    the negative cache, so that the identifier is tried again later, and lets it be claimed again
+    
+    arguments:
+    record -- an OAG record object, see the module documentation for details
+    e -- the requests exception raised for the request
+    
+    returns:
+    the record, in error
+    
+    """
+    log.debug(str(record['identifier']) + ": giving up, as a request failed: " + str(e))
+    record['error'] = "unable to complete a request to the provider, please try again later"
+    record['failure'] = "unavailable"
+    return record
+
+def _ensure_license(record):
+    """
+    ensure that the record has at least one licence, by adding a "failed-to-obtain-license"
+    licence if no plugin applied one
+    
+    arguments:
+    record -- an OAG record object, see the module documentation for details
+    
+    """
+    if "bibjson" not in record:
+        # no bibjson record, so add a blank one
+        log.debug("record does not have a bibjson record.")
+        record['bibjson'] = {}
+        
+    if "license" not in record['bibjson'] or len(record['bibjson'].get("license", [])) == 0:
+        # the bibjson record does not contain a license list OR the license list is of zero length
+        log.debug("Licence could not be detected, therefore adding 'unknown' licence to " + str(record['bibjson']))
+        recordmanager.add_license(record,
+            url=config.unknown_url,
+            type="failed-to-obtain-license",
+            open_access=False,
+            error_message="unable to detect licence",
+            category="failure",
+            provenance_description="no plugin was found that would try to detect a licence.  This entry records that the license is therefore unknown",
+        )
+        # describe_license_fail(record, "none", "unable to detect licence", "", config.unknown_url)
+
 def _add_identifier_to_bibjson(identifier, bibjson):
     """
     Take the supplied bibjson identifier object and ensure that it has been added
@@ -526,3 +971,116 @@ def _add_identifier_to_bibjson(identifier, bibjson):
     
     
     
+
+@celery.task(name="openarticlegauge.workflow.reap_orphaned_claims")
+def reap_orphaned_claims():
+    """
+    Celery task which reports on identifiers whose processing died before it completed (e.g. the worker
+    was killed, the task hit its time limit or the broker lost the message), and so never released its
+    claim.  This should be promoted onto a processing queue by Celery Beat (see the celeryconfig).
+    
+    The identifiers need no further attention: their claim and queued marker will have lapsed, so the
+    next lookup of each one will send it for processing again.
+    
+    returns:
+    the list of orphaned identifiers (canonical form)
+    
+    """
+    orphans = cache.orphaned_claims()
+    if len(orphans) > 0:
+        log.warn("processing of " + str(len(orphans)) + " identifiers died before completing; they will be processed again on their next lookup: " + ", ".join(orphans))
+    return orphans
+
+@celery.task(name="openarticlegauge.workflow.sweep_stale")
+def sweep_stale():
+    """
+    Celery task which refreshes archived records before they become stale, so that the work is spread out
+    at a controlled rate (and at off-peak times) rather than arriving in bursts on the request path.  This
+    should be promoted onto a processing queue by Celery Beat (see the celeryconfig).
+    
+    Each run sends up to config.SWEEP_BATCH_SIZE records whose licence will become stale within
+    config.SWEEP_LEAD_TIME through the normal processing chain in the bulk lane, most requested records
+    first and then oldest first, leaving out any whose refresh failed recently (see cache.back_off_sweep).
+    It does nothing outside the hours in config.SWEEP_WINDOW.  Statistics about the sweep, including the
+    backlog of records due for refresh, are kept in the cache (see cache.sweep_stats).
+    
+    returns:
+    a dictionary of statistics about this run
+    
+    """
+    now = int(time.time())
+    stats = {"last_run" : now}
+    
+    if config.SWEEP_BATCH_SIZE <= 0 or not _in_sweep_window(time.gmtime(now).tm_hour):
+        stats["last_status"] = "outside window"
+        cache.update_sweep_stats(stats)
+        return stats
+    
+    threshold = now - config.licence_stale_time + config.SWEEP_LEAD_TIME
+    backed_off = cache.sweep_backed_off()
+    
+    # Step 1: popular records first
+    popular = cache.most_requested(config.SWEEP_POPULAR_ITEMS)
+    candidates = []
+    if len(popular) > 0:
+        total, candidates = models.Record.checked_before(threshold, config.SWEEP_BATCH_SIZE, ids=popular, exclude=backed_off)
+    
+    # Step 2: then the oldest of everything else, which also tells us the size of the backlog
+    backlog, oldest = models.Record.checked_before(threshold, config.SWEEP_BATCH_SIZE, exclude=backed_off)
+    seen = set([c.get("id") for c in candidates])
+    candidates += [o for o in oldest if o.get("id") not in seen]
+    
+    # Step 3: send them for refreshing
+    enqueued = 0
+    skipped = 0
+    for bibjson in candidates:
+        if enqueued >= config.SWEEP_BATCH_SIZE:
+            break
+        identifier = _archive_identifier(bibjson)
+        if identifier is None:
+            skipped += 1
+            continue
+        if _refresh({"identifier" : identifier}, "bulk"):
+            enqueued += 1
+        else:
+            skipped += 1
+    
+    stats.update({
+        "last_status" : "swept",
+        "last_enqueued" : enqueued,
+        "last_skipped" : skipped,
+        "backlog" : max(backlog - enqueued, 0),
+        "backed_off" : len(backed_off),
+        "total_enqueued" : enqueued,
+        "total_runs" : 1
+    })
+    cache.update_sweep_stats(stats)
+    log.info("sweeper sent " + str(enqueued) + " records for refreshing, skipped " + str(skipped) + "; " + str(stats["backlog"]) + " records are still due for refresh")
+    return stats
+
+def _in_sweep_window(hour):
+    """
+    check whether the given hour of the day (UTC) is within config.SWEEP_WINDOW
+    
+    """
+    if config.SWEEP_WINDOW is None:
+        return True
+    start, end = config.SWEEP_WINDOW
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+def _archive_identifier(bibjson):
+    """
+    get the identifier object from an archived bibjson record which the record is stored under
+    
+    returns:
+    a bibjson identifier object with a type and a canonical form, or None if there isn't one
+    
+    """
+    for identifier in bibjson.get("identifier", []):
+        if identifier.get("canonical") is None or identifier.get("type") is None:
+            continue
+        if bibjson.get("id") is None or identifier["canonical"].replace("/", "_") == bibjson["id"]:
+            return identifier
+    return None